@@ -0,0 +1,121 @@
+""" Generator of synthetic `My Clippings.txt` files, with the same structure as the ones written by the kindle.
+
+The libraries have thousands of books (some with non-ASCII titles and authors), and their entries mix highlights
+(some spanning several lines), notes and bookmarks, all in chronological order.
+
+    python benchmarks/clippings_generator.py OUT_DIR [--books 1000] [--entries 50000] [--seed 0]
+
+The file is written to `OUT_DIR/documents/My Clippings.txt`, so OUT_DIR can be used as the kindle's location.
+"""
+from datetime import datetime, timedelta
+import argparse
+import os
+import random
+
+WORDS = ['time', 'light', 'river', 'memory', 'silence', 'machine', 'garden', 'city', 'winter', 'letter', 'stone', 'mirror',
+         'voice', 'shadow', 'ocean', 'friend', 'history', 'reason', 'dream', 'window', 'empire', 'night', 'road', 'fire',
+         'coração', 'saudade', 'über', 'straße', 'élan', 'niño', 'łąka', 'время', 'свобода', '時間', '記憶', '사랑', 'αλήθεια']
+AUTHORS = ['Jane Austen', 'Machado de Assis', 'Fyodor Dostoevsky', 'Clarice Lispector', 'Haruki Murakami', 'Gabriel García Márquez',
+           'Stanisław Lem', 'Chimamanda Ngozi Adichie', 'Jorge Luis Borges', 'Ursula K. Le Guin', 'Франц Кафка', '夏目 漱石']
+
+
+def sentence(rng:random.Random, words:int) -> str:
+    """ A random sentence
+
+    Args:
+        rng (random.Random)
+        words (int): How many words it has
+
+    Returns:
+        str
+    """
+    text = ' '.join(rng.choice(WORDS) for _ in range(words))
+    return text[0].upper() + text[1:] + '.'
+
+def book_titles(rng:random.Random, books:int) -> list:
+    """ Random book titles, with their authors as the kindle writes them
+
+    Args:
+        rng (random.Random)
+        books (int): How many titles
+
+    Returns:
+        list
+    """
+    titles = []
+    for number in range(books):
+        title = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 5))).title()
+        titles.append('{} {} ({})'.format(title, number, rng.choice(AUTHORS)))
+    return titles
+
+def entries(rng:random.Random, books:int, count:int):
+    """ Random clippings entries, in chronological order
+
+    Args:
+        rng (random.Random)
+        books (int): How many books the entries are spread through
+        count (int): How many entries
+
+    Yields:
+        str: Each entry, including its separator
+    """
+    titles = book_titles(rng, books)
+    added_on = datetime(2015, 1, 1)
+
+    # Some books are read much more than others
+    weights = [1 / (rank + 1) for rank in range(books)]
+
+    for title in rng.choices(titles, weights=weights, k=count):
+        added_on += timedelta(seconds=rng.randint(1, 7200))
+        page = rng.randint(1, 600)
+        location = page * 15 + rng.randint(0, 14)
+        # Written as the kindles do, without padding the day and the hour
+        date = '{:%A, %B} {}, {:%Y} {}:{:%M:%S %p}'.format(added_on, added_on.day, added_on, added_on.hour % 12 or 12, added_on)
+        kind = rng.random()
+
+        if kind < 0.8:
+            # Highlights, some of them spanning several paragraphs
+            end = location + rng.randint(0, 6)
+            lines = [sentence(rng, rng.randint(5, 60)) for _ in range(1 if rng.random() < 0.9 else rng.randint(2, 4))]
+            metadata = '- Your Highlight on page {} | Location {}-{} | Added on {}'.format(page, location, end, date)
+        elif kind < 0.95:
+            lines = [sentence(rng, rng.randint(3, 25))]
+            metadata = '- Your Note on page {} | Location {} | Added on {}'.format(page, location, date)
+        else:
+            lines = ['']
+            metadata = '- Your Bookmark on page {} | Location {} | Added on {}'.format(page, location, date)
+
+        yield '\r\n'.join([title, metadata, ''] + lines) + '\r\n==========\r\n'
+
+def generate(path:str, books:int, count:int, seed:int = 0) -> str:
+    """ Write a synthetic clippings file
+
+    Args:
+        path (str): The directory used as the kindle's location
+        books (int): How many books
+        count (int): How many entries
+        seed (int, optional): Seed of the random generator. Defaults to 0.
+
+    Returns:
+        str: The path to the `My Clippings.txt` file
+    """
+    rng = random.Random(seed)
+    os.makedirs(os.path.join(path, 'documents'), exist_ok=True)
+    file_name = os.path.join(path, 'documents', 'My Clippings.txt')
+
+    with open(file_name, 'w', encoding='utf-8-sig', newline='') as f:
+        for entry in entries(rng, books, count):
+            f.write(entry)
+
+    return file_name
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('out', help='The directory used as the kindle location')
+    parser.add_argument('--books', type=int, default=1000)
+    parser.add_argument('--entries', type=int, default=50000)
+    parser.add_argument('--seed', type=int, default=0)
+    options = parser.parse_args()
+
+    print(generate(options.out, options.books, options.entries, options.seed))
@@ -0,0 +1,178 @@
+""" Benchmark of the local stages of `booknote upload`, run against a synthetic clippings file.
+
+Stages:
+    parse           Highlights.get_kindle_highlights, a full scan of the clippings file
+    parse+dedup     TimeCapsule.get_kindle_highlights, with half of the entries already in the kindle.log
+    group           booknote.pipeline.book_batches, separating the new highlights in per-book batches
+    upload          TimeCapsule.upload_highlights of the new highlights to the in-memory FakeNotionBackend
+    stream          TimeCapsule.upload_highlights straight from TimeCapsule.iter_kindle_highlights, parsing while uploading
+    sources         TimeCapsule.get_kindle_highlights of the library plus three smaller devices, parsed in parallel processes
+                    (their peak memory is not measured, since tracemalloc only sees the main process)
+
+The wall time and peak memory (measured with tracemalloc, in a separate run) of each stage are compared against the
+stored baseline (`benchmarks/baseline.json`), and the script fails if any of them regressed more than the tolerance.
+
+    python benchmarks/pipeline.py [--size small|medium|large] [--tolerance 0.25] [--save-baseline]
+"""
+from contextlib import redirect_stdout
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.clippings_generator import generate
+from booknote.backends import FakeNotionBackend
+from booknote.highlight_journal import HighlightJournal
+from booknote.kindle_highlights import Highlights
+from booknote.pipeline import book_batches
+
+BASELINE = os.path.join(ROOT, 'benchmarks', 'baseline.json')
+
+# (books, entries) of each library size
+SIZES = {'small': (200, 5000),
+         'medium': (1000, 50000),
+         'large': (3000, 300000)}
+
+
+def measure(stage, memory:bool = True) -> dict:
+    """ Run a stage, measuring its wall time and (in a second run) its peak memory
+
+    Args:
+        stage (callable): The stage, called without arguments
+        memory (bool, optional): Rather or not to measure the peak memory. Defaults to True.
+
+    Returns:
+        dict: The `seconds` and `peak mb` of the stage
+    """
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        start = time.perf_counter()
+        stage()
+        result = {'seconds': time.perf_counter() - start}
+
+        if memory:
+            tracemalloc.start()
+            stage()
+            result['peak mb'] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+            tracemalloc.stop()
+
+    return result
+
+def run(size:str, memory:bool = True) -> dict:
+    """ Generate a library of the given size and run every stage on it, in an isolated home directory
+
+    Args:
+        size (str): One of `SIZES`
+        memory (bool, optional): Rather or not to measure the peak memory. Defaults to True.
+
+    Returns:
+        dict: The measurements of each stage
+    """
+    books, entries = SIZES[size]
+    results = {}
+
+    with tempfile.TemporaryDirectory() as home:
+        # TimeCapsule always works under ~/.config/booknote, so the home directory is swapped for the temporary one
+        os.environ['HOME'] = home
+        config_dir = os.path.join(home, '.config', 'booknote')
+        os.makedirs(config_dir)
+
+        kindle = os.path.join(home, 'kindle')
+        generate(kindle, books, entries)
+        with open(os.path.join(config_dir, 'config.json'), 'w') as f:
+            f.write(json.dumps({'notion.v2token': '', 'notion.page': 'benchmark', 'kindle.location': kindle, 'kindle.log': os.path.join(config_dir, 'kindle.log')}))
+
+        from booknote.booknote import TimeCapsule
+
+        results['parse'] = measure(lambda: Highlights().get_kindle_highlights(kindle), memory)
+
+        # Half of the library was already uploaded
+        with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            highlights = Highlights().get_kindle_highlights(kindle)
+        HighlightJournal(os.path.join(config_dir, 'kindle.log')).append(highlights[::2])
+
+        capsule = TimeCapsule()
+        results['parse+dedup'] = measure(lambda: capsule.get_kindle_highlights(only_new=True), memory)
+
+        with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            new_highlights = capsule.get_kindle_highlights(only_new=True)
+        results['group'] = measure(lambda: list(book_batches(new_highlights)), memory)
+        results['upload'] = measure(lambda: capsule.upload_highlights(new_highlights, backend=FakeNotionBackend()), memory)
+
+        # The whole pipeline, without the parsed highlights held in memory beforehand
+        del highlights, new_highlights
+        results['stream'] = measure(lambda: capsule.upload_highlights(capsule.iter_kindle_highlights(only_new=True), backend=FakeNotionBackend()), memory)
+
+        # Other devices of the household, each with a quarter of the library
+        devices = [kindle] + [generate(os.path.join(home, 'device {}'.format(number)), books, entries // 4, seed=number) for number in range(1, 4)]
+        results['sources'] = measure(lambda: capsule.get_kindle_highlights(only_new=False, sources=devices), False)
+
+    return results
+
+def compare(results:dict, baseline:dict, tolerance:float) -> bool:
+    """ Print the results next to the baseline
+
+    Args:
+        results (dict): The measurements of each stage
+        baseline (dict): The baseline measurements of each stage (may be empty)
+        tolerance (float): How much slower (or bigger) than the baseline a stage can be, e.g. 0.25 for 25%
+
+    Returns:
+        bool: `True` if any stage regressed
+    """
+    regressed = False
+    print('{:<12} {:>10} {:>10} {:>8}   {:>10} {:>10} {:>8}'.format('stage', 'seconds', 'baseline', 'ratio', 'peak mb', 'baseline', 'ratio'))
+
+    for stage, result in results.items():
+        row = [stage]
+        status = 'ok'
+        for metric in ('seconds', 'peak mb'):
+            value = result.get(metric)
+            reference = baseline.get(stage, {}).get(metric)
+            ratio = value / reference if value is not None and reference else None
+            if ratio is not None and ratio > 1 + tolerance:
+                status = 'REGRESSION'
+            row += [value, reference, ratio]
+
+        regressed = regressed or status != 'ok'
+        print('{:<12} {:>10} {:>10} {:>8}   {:>10} {:>10} {:>8}  {}'.format(row[0], *('-' if value is None else '{:.3f}'.format(value) for value in row[1:]), status))
+
+    return regressed
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', choices=SIZES, default='small')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed regression over the baseline, e.g. 0.25 for 25%%')
+    parser.add_argument('--no-memory', action='store_true', help='Skip the peak memory measurements (and their second run)')
+    parser.add_argument('--save-baseline', action='store_true', help='Store the results as the new baseline for this size')
+    options = parser.parse_args()
+
+    books, entries = SIZES[options.size]
+    print('Library: {} books, {} entries'.format(books, entries))
+    results = run(options.size, not options.no_memory)
+
+    try:
+        with open(BASELINE, 'r') as f:
+            baselines = json.loads(f.read())
+    except (OSError, ValueError):
+        baselines = {}
+
+    regressed = compare(results, baselines.get(options.size, {}), options.tolerance)
+
+    if options.save_baseline:
+        baselines[options.size] = results
+        with open(BASELINE, 'w') as f:
+            f.write(json.dumps(baselines, indent=4, sort_keys=True))
+        print('Baseline saved to {}'.format(BASELINE))
+        return 0
+
+    return 1 if regressed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,227 @@
+""" Check of `booknote upload --reconcile` against the in-memory stand-in for Notion, on a synthetic library.
+
+The library is uploaded, the kindle.log is deleted and the page is messed up, covering each branch of the reconciliation:
+
+    hashed          groups matched by the hash in their quote block, restored if their quote was edited on the page
+    legacy          groups without a hash (uploaded before the hashes were stored), matched by their text or only by their quote
+    duplicate       groups of a highlight that is already on the page, deleted
+    stale           groups of a highlight that was extended on the kindle afterwards, deleted (and its new version created)
+    missing         highlights deleted from the page, created again
+    prune           groups not in the local history, kept unless `prune` is set
+
+After each reconciliation the counters of the capsule and the highlights left on the page are checked, for both the flat layout
+(the quotes follow their title block) and the nested one (the quotes are inside a toggle).
+
+    python benchmarks/reconcile.py [--books 30] [--entries 600] [--seed 0]
+"""
+from collections import Counter
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.clippings_generator import generate
+from booknote.backends import FakeNotionBackend
+from booknote.booknote import TimeCapsule
+from booknote.clipping import HIGHLIGHT, parse_metadata
+from booknote.reconcile import HASH_PROPERTY, block_hash, fetch_sections, highlight_groups, location_text
+from booknote.title_index import block_title
+
+LAYOUTS = {'flat': 'SubheaderBlock', 'nested': 'ToggleBlock'}
+
+
+class PersistentBackend(FakeNotionBackend):
+    """ The stand-in for Notion, but uploading to it as if it was Notion itself (so the local files are written) """
+
+    dry_run = False
+
+def page_groups(capsule:TimeCapsule, backend:PersistentBackend) -> list:
+    """ The highlights on the page, as the reconciliation finds them
+
+    Args:
+        capsule (TimeCapsule)
+        backend (PersistentBackend)
+
+    Returns:
+        list: The groups of each highlight (see `highlight_groups`), in the order of the page
+    """
+    sections = fetch_sections(backend, backend.get_record(capsule.page_id), capsule.header_type, capsule.nested)
+    return [group for blocks in sections.values() for group in highlight_groups(blocks, capsule.quote_type, capsule.location_type)]
+
+def group_text(group:dict) -> tuple:
+    return block_title(group['quote']), block_title(group['location'])
+
+def reconcile(capsule:TimeCapsule, backend:PersistentBackend, prune:bool = False) -> tuple:
+    """ Reconcile the page from scratch, as if the kindle.log was lost
+
+    Args:
+        capsule (TimeCapsule)
+        backend (PersistentBackend)
+        prune (bool, optional): Defaults to False.
+
+    Returns:
+        tuple: The counters of the reconciliation, the requests it made and how long it took
+    """
+    os.remove(capsule.kindle_log)
+    capsule.journal = None
+
+    start = time.perf_counter()
+    requests = capsule.reconcile_highlights(backend=backend, prune=prune)
+    elapsed = time.perf_counter() - start
+
+    return (capsule.uploaded, capsule.updated, capsule.deleted, capsule.unknown), requests, elapsed
+
+def mess_up(capsule:TimeCapsule, backend:PersistentBackend, clippings:str, rng:random.Random) -> tuple:
+    """ Change the page (and the kindle) so every branch of the reconciliation has something to do
+
+    Args:
+        capsule (TimeCapsule)
+        backend (PersistentBackend)
+        clippings (str): The path to the `My Clippings.txt` file
+        rng (random.Random)
+
+    Returns:
+        tuple: The counters expected from the reconciliation, and the text of the groups not in the local history
+    """
+    records = {record['hash']: record for record in map(json.loads, open(capsule.kindle_log, encoding='utf-8'))}
+    groups = [group for group in page_groups(capsule, backend) if block_title(group['quote'])]
+    deleted, edited, legacy, relocated, duplicated = [groups[position:position + count] for position, count in zip(range(0, 50, 10), (5, 3, 8, 1, 2))]
+    stale = [group for group in groups[50:] if parse_metadata(records[block_hash(group['quote'])]['book location'])[0] == HIGHLIGHT][:1]
+
+    def content(group:dict) -> list:
+        return backend.records[group['parent']]['content']
+
+    def blocks(group:dict) -> list:
+        return [group[block]['id'] for block in ('quote', 'location', 'divider') if block in group]
+
+    # Missing: their blocks are taken out of the page
+    for group in deleted:
+        for block_id in blocks(group):
+            content(group).remove(block_id)
+
+    # Hashed: their quote is edited on the page, so it is restored
+    for group in edited:
+        backend.records[group['quote']['id']]['properties']['title'] = [['edited on Notion']]
+
+    # Legacy: they lose their hash, and are matched by their text (or only by their quote, when the location is written differently)
+    for group in legacy + relocated:
+        del backend.records[group['quote']['id']]['properties'][HASH_PROPERTY]
+    for group in relocated:
+        backend.records[group['location']['id']]['properties']['title'] = [['Location {}'.format(rng.randint(1, 9999))]]
+
+    # Duplicate: their blocks are copied right after them
+    for group in duplicated:
+        copies = []
+        for block_id in blocks(group):
+            copy = json.loads(json.dumps(backend.records[block_id]))
+            copy['id'] = block_id + '-copy'
+            backend.records[copy['id']] = copy
+            copies.append(copy['id'])
+        position = content(group).index(blocks(group)[-1]) + 1
+        content(group)[position:position] = copies
+
+    # Stale: the kindle gets a more recent clipping covering the whole range of a highlight already on the page
+    for group in stale:
+        record = records[block_hash(group['quote'])]
+        _, page, start, end, _ = parse_metadata(record['book location'])
+        with open(clippings, 'a', encoding='utf-8') as f:
+            f.write('{}\r\n- Your Highlight on page {} | Location {}-{} | Added on Monday, January 1, 2035 10:00:00 AM\r\n\r\n{} (extended)\r\n==========\r\n'
+                    .format(record['book title'], page, start, end, record['quote']))
+
+    # Prune: a highlight that is not known locally, added right after another one
+    foreign = groups[-1]
+    position = content(foreign).index(blocks(foreign)[-1]) + 1
+    for block_id, block_type, title in (('foreign-quote', capsule.quote_type, 'Written on Notion'), ('foreign-location', capsule.location_type, 'Nowhere')):
+        backend.records[block_id] = {'id': block_id, 'type': block_type, 'alive': True, 'properties': {'title': [[title]]}}
+        content(foreign).insert(position, block_id)
+        position += 1
+
+    expected = (len(deleted) + len(stale), len(edited) + len(relocated), len(duplicated) + len(stale), 1)
+    return expected, [('Written on Notion', 'Nowhere')]
+
+def check(name:str, counters:tuple, expected:tuple, on_page:Counter, wanted:Counter, requests:int, elapsed:float) -> bool:
+    """ Print the result of a reconciliation
+
+    Returns:
+        bool: Rather or not it is the expected one
+    """
+    ok = counters == expected and on_page == wanted
+    print('[{}] {:<8} created {} updated {} deleted {} unknown {}   {:>5} requests {:>8.3f} s'.format('ok' if ok else 'FAIL', name, *counters, requests, elapsed))
+    if counters != expected:
+        print('       expected created {} updated {} deleted {} unknown {}'.format(*expected))
+    if on_page != wanted:
+        print('       {} highlights missing from the page, {} unexpected ones'.format(sum((wanted - on_page).values()), sum((on_page - wanted).values())))
+    return ok
+
+def run(layout:str, books:int, entries:int, seed:int) -> bool:
+    """ Upload a library, then reconcile it with the page in each state
+
+    Args:
+        layout (str): One of `LAYOUTS`
+        books (int)
+        entries (int)
+        seed (int)
+
+    Returns:
+        bool: Rather or not every check passed
+    """
+    rng = random.Random(seed)
+
+    with tempfile.TemporaryDirectory() as home:
+        kindle = os.path.join(home, 'kindle')
+        clippings = generate(kindle, books, entries, seed)
+        config = {'notion.page': 'reconcile', 'kindle.location': kindle, 'kindle.log': os.path.join(home, 'kindle.log')}
+        style = {'title': {'color': 'pink', 'block.type': LAYOUTS[layout]},
+                 'quote': {'color': 'default', 'block.type': 'QuoteBlock'},
+                 'annotation': {'color': 'gray', 'block.type': 'BulletedListBlock'}}
+
+        capsule = TimeCapsule(config, style, home)
+        backend = PersistentBackend()
+        capsule.upload_highlights(capsule.iter_kindle_highlights(), backend=backend)
+
+        def on_page() -> Counter:
+            return Counter(group_text(group) for group in page_groups(capsule, backend))
+
+        def logged() -> Counter:
+            return Counter((record['quote'], location_text(record)) for record in map(json.loads, open(capsule.kindle_log, encoding='utf-8')))
+
+        print('{} layout: {} highlights uploaded'.format(layout, capsule.uploaded))
+        counters, requests, elapsed = reconcile(capsule, backend)
+        passed = check('noop', counters, (0, 0, 0, 0), on_page(), logged(), requests, elapsed)
+
+        expected, foreign = mess_up(capsule, backend, clippings, rng)
+        counters, requests, elapsed = reconcile(capsule, backend)
+        passed = check('messed', counters, expected, on_page(), logged() + Counter(foreign), requests, elapsed) and passed
+
+        counters, requests, elapsed = reconcile(capsule, backend)
+        passed = check('again', counters, (0, 0, 0, 1), on_page(), logged() + Counter(foreign), requests, elapsed) and passed
+
+        counters, requests, elapsed = reconcile(capsule, backend, prune=True)
+        passed = check('prune', counters, (0, 0, 1, 1), on_page(), logged(), requests, elapsed) and passed
+
+        capsule.close()
+
+    return passed
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--books', type=int, default=30, help='How many books in the library')
+    parser.add_argument('--entries', type=int, default=600, help='How many entries in the clippings file')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the library and of the changes made to the page')
+    options = parser.parse_args()
+
+    passed = True
+    for layout in LAYOUTS:
+        passed = run(layout, options.books, options.entries, options.seed) and passed
+
+    return 0 if passed else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
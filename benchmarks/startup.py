@@ -0,0 +1,84 @@
+""" Startup time benchmark for the CLI commands that only touch the local files.
+
+Each command is run several times in a fresh interpreter (with a temporary home directory, so the user's files are never touched),
+and the median wall time is checked against a budget. It also checks that importing the CLI does not load the Notion stack.
+
+    python benchmarks/startup.py [--runs 10] [--budget-ms 250]
+"""
+from statistics import median
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+COMMANDS = {'config': ['config', 'kindle.location', '/media/Kindle'],
+            'setstyle': ['setstyle', 'title', 'color', 'pink'],
+            'list': ['list', 'config'],
+            'compact': ['compact'],
+            'help': ['--help']}
+
+# Packages pulled in by `notion.client`, none of them should be imported by the local commands
+NETWORK_STACK = ['notion', 'requests', 'bs4', 'commonmark', 'tzlocal', 'dictdiffer']
+
+
+def run_command(args:list, env:dict) -> float:
+    """ Run a CLI command in a new interpreter
+
+    Args:
+        args (list): The command's arguments
+        env (dict): The environment of the process
+
+    Returns:
+        float: The wall time in milliseconds
+    """
+    start = time.perf_counter()
+    subprocess.run([sys.executable, os.path.join(ROOT, 'booknote_cli.py')] + args, env=env, cwd=ROOT, check=True, stdout=subprocess.DEVNULL)
+    return (time.perf_counter() - start) * 1000
+
+def imported_network_modules(env:dict) -> list:
+    """ Import the CLI in a new interpreter and list which packages of the Notion stack were loaded
+
+    Args:
+        env (dict): The environment of the process
+
+    Returns:
+        list: The names of the loaded packages
+    """
+    code = 'import sys, booknote_cli; print(" ".join(sorted(set(m.split(".")[0] for m in sys.modules))))'
+    output = subprocess.run([sys.executable, '-c', code], env=env, cwd=ROOT, check=True, capture_output=True, text=True).stdout
+    return [module for module in output.split() if module in NETWORK_STACK]
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=10, help='How many times each command is run')
+    parser.add_argument('--budget-ms', type=float, default=250, help='Maximum median wall time for each command')
+    options = parser.parse_args()
+
+    failed = False
+    with tempfile.TemporaryDirectory() as home:
+        os.makedirs(os.path.join(home, '.config', 'booknote'))
+        env = dict(os.environ, HOME=home)
+
+        loaded = imported_network_modules(env)
+        if loaded:
+            print('[FAIL] importing the CLI loads: {}'.format(', '.join(loaded)))
+            failed = True
+
+        # The first run creates the config files, so it is not measured
+        run_command(COMMANDS['help'], env)
+
+        for name, args in COMMANDS.items():
+            times = [run_command(args, env) for _ in range(options.runs)]
+            status = 'ok' if median(times) <= options.budget_ms else 'FAIL'
+            failed = failed or status == 'FAIL'
+            print('[{}] {:<10} median {:7.1f} ms   min {:7.1f} ms   budget {:.0f} ms'.format(status, name, median(times), min(times), options.budget_ms))
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
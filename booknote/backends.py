@@ -0,0 +1,441 @@
+from booknote.scheduler import RequestScheduler
+import logging
+import random
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+
+def copy_record(value):
+    """ Deep copy of a record (or operation argument), which only holds dicts, lists and immutable values
+
+    Args:
+        value
+
+    Returns:
+        The copy
+    """
+    if isinstance(value, dict):
+        return {key: copy_record(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [copy_record(item) for item in value]
+    return value
+
+class NotionRequestError(Exception):
+    """ A request to the Notion API failed
+
+    Args:
+        message (str): What went wrong
+        status_code (int, optional): The HTTP status of the response, `None` if there was no response. Defaults to None.
+        retry_after (float, optional): Seconds Notion asked to wait before sending another request. Defaults to None.
+    """
+
+    def __init__(self, message:str, status_code:int = None, retry_after:float = None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+class NotionBackend:
+    """ The calls to the Notion API used by the upload. The records loaded (and changed) through it are kept in memory,
+    so the upload can follow the page's structure without asking Notion again.
+
+    Subclasses implement `login`, `_get_records` and `_submit`, this class keeps the local records in sync and counts the requests.
+    All the requests go through the `scheduler`, which paces them and retries the ones that fail with a transient error.
+    """
+
+    # Dry runs do not reach Notion, so the upload must not record anything as uploaded
+    dry_run = False
+
+    def __init__(self):
+        self.records = {}
+        self.records_lock = threading.Lock()
+        self.requests = 0
+        self.endpoints = {}
+        self.retries = 0
+        self.requests_lock = threading.Lock()
+        self.user_id = None
+        self.scheduler = RequestScheduler(on_retry=self.__count_retry)
+
+        # Where the last block of each chain of `listAfter` operations was inserted, as a hint to find it without searching the whole list
+        self.positions = {}
+
+    def login(self) -> None:
+        """ Authenticate with Notion, setting the `user_id`
+
+        Raises:
+            NotionRequestError
+
+        Returns:
+            None
+        """
+        raise NotImplementedError
+
+    def get_page(self, url_or_id:str) -> dict:
+        """ Load the record of a page (but not of its children)
+
+        Args:
+            url_or_id (str): The url or id of the page
+
+        Raises:
+            NotionRequestError
+
+        Returns:
+            dict: The page's record, `None` if it was not found
+        """
+        return self.load_records([self.page_id(url_or_id)])[0]
+
+    def page_id(self, url_or_id:str) -> str:
+        """ Extract the id of a page from its url
+
+        Args:
+            url_or_id (str)
+
+        Returns:
+            str
+        """
+        return str(uuid.UUID(url_or_id.split('#')[-1].split('/')[-1].split('&p=')[-1].split('?')[0].split('-')[-1]))
+
+    def load_records(self, block_ids:list) -> list:
+        """ Request the records of the blocks in bulk
+
+        Args:
+            block_ids (list)
+
+        Raises:
+            NotionRequestError
+
+        Returns:
+            list: The records, in the same order as the ids (`None` for the ones not found)
+        """
+        records = []
+        for position in range(0, len(block_ids), 100):
+            records += self.scheduler.call(self._get_records, block_ids[position:position + 100])
+
+        with self.records_lock:
+            for record in records:
+                if record:
+                    self.records[record['id']] = record
+
+        return records
+
+    def clear_records(self) -> None:
+        """ Forget the records loaded so far (e.g. between the syncs of a long lived session), so they are requested again when needed
+
+        Returns:
+            None
+        """
+        with self.records_lock:
+            self.records = {}
+            self.positions = {}
+
+    def get_record(self, block_id:str) -> dict:
+        """ The local copy of a block's record, without any request
+
+        Args:
+            block_id (str)
+
+        Returns:
+            dict: The record, `None` if it was never loaded
+        """
+        return self.records.get(block_id)
+
+    def submit_transaction(self, operations:list) -> None:
+        """ Send the operations to Notion as a single transaction, and then apply them to the local records
+
+        Args:
+            operations (list): The operations, as built by `booknote.notion_batch.build_operation`
+
+        Raises:
+            NotionRequestError
+
+        Returns:
+            None
+        """
+        self.scheduler.call(self._submit, operations)
+
+        # The operations are applied one transaction at a time, so the concurrent uploads do not overwrite each other's changes
+        with self.records_lock:
+            for operation in operations:
+                self.__apply_operation(operation)
+
+    def _count_request(self, endpoint:str) -> None:
+        """ Count a request to an endpoint (each retry counts as another request)
+
+        Args:
+            endpoint (str)
+
+        Returns:
+            None
+        """
+        with self.requests_lock:
+            self.requests += 1
+            self.endpoints[endpoint] = self.endpoints.get(endpoint, 0) + 1
+
+        logger.debug('%s request to %s', type(self).__name__, endpoint)
+
+    def __count_retry(self) -> None:
+        with self.requests_lock:
+            self.retries += 1
+
+    def _get_records(self, block_ids:list) -> list:
+        raise NotImplementedError
+
+    def _submit(self, operations:list) -> None:
+        raise NotImplementedError
+
+    def __apply_operation(self, operation:dict) -> None:
+        """ Apply an operation to the local records, the same way Notion does
+
+        Args:
+            operation (dict)
+
+        Returns:
+            None
+        """
+        if operation['table'] != 'block':
+            return
+
+        record = self.records.setdefault(operation['id'], {'id': operation['id']})
+        path = list(operation['path'])
+        command = operation['command']
+        args = operation['args']
+
+        # Descend down the path until it is consumed (or, for a `set`, there is only one key left)
+        while len(path) > 1 or (path and command != 'set'):
+            record = record.setdefault(path.pop(0), [] if 'list' in command else {})
+
+        if command == 'update':
+            record.update(args)
+        elif command == 'set' and path:
+            record[path[0]] = copy_record(args)
+        elif command == 'set':
+            record.clear()
+            record.update(copy_record(args))
+        elif command == 'listAfter':
+            # Blocks are mostly added after the current last child or after the last block of a chain of insertions (e.g. a book's section),
+            # neither of which needs a search through the whole list
+            after = args.get('after')
+            position = len(record) if after is None or (record and record[-1] == after) else self.__position_after(record, after)
+
+            record.insert(position, args['id'])
+            self.positions.pop(after, None)
+            self.positions[args['id']] = position
+        elif command == 'listBefore':
+            position = record.index(args['before']) if 'before' in args and args['before'] in record else 0
+            record.insert(position, args['id'])
+        elif command == 'listRemove' and args['id'] in record:
+            record.remove(args['id'])
+
+    def __position_after(self, record:list, after:str) -> int:
+        """ Find where a block placed after the `after` child goes. Blocks are only ever pushed further down the list by the insertions
+        before them, so the search starts from where `after` was inserted
+
+        Args:
+            record (list): The list of children
+            after (str): The id of the sibling
+
+        Returns:
+            int: The position of the new block, the end of the list if `after` is not in it
+        """
+        hint = self.positions.get(after)
+        try:
+            if hint is not None and hint < len(record):
+                return record.index(after, hint) + 1
+        except ValueError:
+            pass
+
+        try:
+            return record.index(after) + 1
+        except ValueError:
+            return len(record)
+
+class NotionClientBackend(NotionBackend):
+    """ Backend talking to the Notion API through `notion.client.NotionClient`, which is only imported once the login happens.
+
+    Args:
+        token_v2 (str): The v2 token for authentication
+    """
+
+    def __init__(self, token_v2:str):
+        super().__init__()
+        self.token_v2 = token_v2
+        self.client = None
+
+    def login(self) -> None:
+        self.client = self.scheduler.call(self.__client)
+        self.user_id = self.client.current_user.id
+
+    def page_id(self, url_or_id:str) -> str:
+        from notion.utils import extract_id
+        return extract_id(url_or_id)
+
+    def _get_records(self, block_ids:list) -> list:
+        requests = [{'table': 'block', 'id': block_id} for block_id in block_ids]
+        results = self.__post('getRecordValues', {'requests': requests}).json()['results']
+        return [result.get('value') for result in results]
+
+    def _submit(self, operations:list) -> None:
+        self.__post('submitTransaction', {'operations': operations})
+
+    def __post(self, endpoint:str, data:dict):
+        """ Send a request to the API
+
+        Args:
+            endpoint (str)
+            data (dict): The json body of the request
+
+        Raises:
+            NotionRequestError
+
+        Returns:
+            requests.Response
+        """
+        from requests import RequestException
+
+        self._count_request(endpoint)
+        try:
+            return self.client.post(endpoint, data)
+        except RequestException as e:
+            raise self.__request_error(e)
+
+    def __client(self):
+        """ Create the client, which already loads the user's content
+
+        Raises:
+            NotionRequestError
+
+        Returns:
+            notion.client.NotionClient
+        """
+        from notion.client import NotionClient
+        from requests import RequestException
+        from urllib3.util.retry import Retry
+
+        # The client does not retry anything on its own, the scheduler does
+        self._count_request('loadUserContent')
+        try:
+            return NotionClient(token_v2 = self.token_v2, client_specified_retry = Retry(0))
+        except RequestException as e:
+            raise self.__request_error(e)
+
+    def __request_error(self, error:Exception) -> NotionRequestError:
+        """ Translate an error from `requests` to a `NotionRequestError`, keeping the response's status
+
+        Args:
+            error (RequestException)
+
+        Returns:
+            NotionRequestError
+        """
+        from requests import HTTPError
+
+        # The client raises the bad requests (400) itself, without the response
+        response = getattr(error, 'response', None)
+        if response is None:
+            return NotionRequestError(str(error), 400 if isinstance(error, HTTPError) else None)
+
+        try:
+            retry_after = float(response.headers.get('Retry-After'))
+        except (TypeError, ValueError):
+            retry_after = None
+
+        return NotionRequestError(str(error), response.status_code, retry_after)
+
+class FakeNotionBackend(NotionBackend):
+    """ In-process stand-in for Notion, used for dry runs and benchmarks. Every page it is asked for exists (empty at first),
+    and every call is recorded in `calls` as `(endpoint, size)`.
+
+    Args:
+        latency (float, optional): Seconds each request takes. Defaults to 0.
+        failure_rate (float, optional): Probability of a request failing. Defaults to 0.
+        fail_on (tuple, optional): The (1-based) numbers of the requests that must fail. Defaults to ().
+        status_code (int, optional): The status of the injected failures. Defaults to 500.
+        seed (int, optional): Seed of the failures' random generator, to make them reproducible. Defaults to None.
+        rate_limit (float, optional): How many requests are allowed per second, the others are rate limited (429). Defaults to None (no limit).
+    """
+
+    dry_run = True
+
+    def __init__(self, latency:float = 0, failure_rate:float = 0, fail_on:tuple = (), status_code:int = 500, seed:int = None, rate_limit:float = None):
+        super().__init__()
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.fail_on = set(fail_on)
+        self.status_code = status_code
+        self.random = random.Random(seed)
+        self.rate_limit = rate_limit
+        self.accepted = []
+        self.calls = []
+
+    def login(self) -> None:
+        self.scheduler.call(self.__request, 'loadUserContent', 1)
+        self.user_id = 'dry-run-user'
+
+    def page_id(self, url_or_id:str) -> str:
+        try:
+            return super().page_id(url_or_id)
+        except ValueError:
+            return url_or_id
+
+    def get_page(self, url_or_id:str) -> dict:
+        page_id = self.page_id(url_or_id)
+        with self.records_lock:
+            self.records.setdefault(page_id, {'id': page_id, 'type': 'page', 'alive': True, 'content': [], 'properties': {'title': [['BookNote']]}})
+        return super().get_page(page_id)
+
+    def clear_records(self) -> None:
+        # The records are the stand-in's own copy of the pages, so there is nothing to forget
+        pass
+
+    def _get_records(self, block_ids:list) -> list:
+        self.__request('getRecordValues', len(block_ids))
+        return [copy_record(self.records.get(block_id)) for block_id in block_ids]
+
+    def _submit(self, operations:list) -> None:
+        self.__request('submitTransaction', len(operations))
+
+    def summary(self) -> dict:
+        """ How many requests were made to each endpoint
+
+        Returns:
+            dict
+        """
+        endpoints = {}
+        for endpoint, _ in self.calls:
+            endpoints[endpoint] = endpoints.get(endpoint, 0) + 1
+        return endpoints
+
+    def __request(self, endpoint:str, size:int) -> None:
+        """ Simulate a request, waiting for the latency and failing when asked to
+
+        Args:
+            endpoint (str): The endpoint being called
+            size (int): How many records or operations it holds
+
+        Raises:
+            NotionRequestError: If the request was chosen to fail, or it went over the rate limit
+
+        Returns:
+            None
+        """
+        self._count_request(endpoint)
+        with self.requests_lock:
+            self.calls.append((endpoint, size))
+            number = len(self.calls)
+            fail = number in self.fail_on or self.random.random() < self.failure_rate
+
+            # The requests accepted in the last second count towards the limit
+            if self.rate_limit is not None:
+                now = time.monotonic()
+                self.accepted = [accepted for accepted in self.accepted if accepted > now - 1]
+                if len(self.accepted) >= self.rate_limit:
+                    raise NotionRequestError('Rate limited on request {} ({})'.format(number, endpoint), 429)
+                self.accepted.append(now)
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        if fail:
+            raise NotionRequestError('Injected failure on request {} ({})'.format(number, endpoint), self.status_code)
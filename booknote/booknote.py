@@ -1,27 +1,82 @@
-from notion.client import NotionClient
-from notion.block import BulletedListBlock, DividerBlock,HeaderBlock , SubheaderBlock, SubsubheaderBlock, QuoteBlock, TextBlock, TodoBlock, PageBlock, CalloutBlock, ToggleBlock
-from booknote.kindle_highlights import Highlights
+from booknote.kindle_highlights import Highlights, clippings_file, find_clippings_files, parse_clippings_file
+from booknote.highlight_journal import HighlightJournal, highlight_hash
+from booknote.title_index import TitleIndex, block_title, save_title_indexes
+from booknote.page_snapshot import PageSnapshot
+from booknote.pipeline import book_batches, deduplicate, group_by_book, overlapping, superseded
+from booknote.reconcile import HASH_PROPERTY, block_hash, diff_book, fetch_sections, highlight_groups, location_text
+from booknote.backends import NotionClientBackend, NotionRequestError
+from booknote.metrics import Metrics
+from booknote.scheduler import is_transient
+from booknote.transaction_queue import TransactionQueue
 
 from sys import platform
+import threading
+import logging
 import json
 import os 
 
+logger = logging.getLogger(__name__)
+
 class NotionCredentialError(Exception):
     pass
 
 class TimeCapsule:
+    """ The highlights of a kindle (or several) and the Notion page they are uploaded to.
+
+    By default the config, the style and the state (the `kindle.log`, the indexes, the snapshots...) are all kept in `~/.config/booknote`,
+    and the config and style files are read (or created) right away. To embed it in another program (e.g. a service syncing the highlights
+    of many users, see `booknote.session_pool`), the config and the style can be given as dicts and the state can be kept in a directory
+    of its own, in which case nothing is read or written until it is needed.
+
+    Args:
+        config (dict, optional): The config variables (see `booknote config --help`), the missing ones take their default value. Defaults to None (i.e the `config.json`).
+        style (dict, optional): The style of each element, as in the `style.json`. Defaults to None (i.e the `style.json`, or the default style if the config was given).
+        state_dir (str, optional): Where the state files are kept. Defaults to None (i.e `~/.config/booknote`).
+    """
 
-    def __init__(self):
+    def __init__(self, config:dict = None, style:dict = None, state_dir:str = None):
         # Set basic path variables for the config files
         base_path = os.path.expanduser("~")
+        self.state_dir = state_dir or base_path + '/.config/booknote'
         self.config_file = base_path + '/.config/booknote/config.json'
         self.style_file  = base_path + '/.config/booknote/style.json'
-        self.kindle_log  =  base_path + '/.config/booknote/kindle.log'
-
-        # Set variables for future comparison
-        self.logged_highlights = []
-        self.kindle_highlights = []
-        self.new_highlights = []
+        self.kindle_log  =  self.state_dir + '/kindle.log'
+        self.checkpoint_file = self.state_dir + '/clippings.checkpoint'
+        self.index_file = self.state_dir + '/titles.index'
+        self.shards_file = self.state_dir + '/shards.index'
+        self.snapshot_dir = self.state_dir + '/snapshots'
+        self.progress_file = self.state_dir + '/upload.progress'
+        self.queue_file = self.state_dir + '/upload.queue'
+        self.search_file = self.state_dir + '/search.db'
+
+        # Set variables for future comparison (the journal and the notion session are kept between uploads)
+        self.journal = None
+        self.backend = None
+        self.search_index = None
+        self.title_indexes = {}
+        self.queue = None
+        self.metrics = Metrics()
+        self.measured_backend = None
+        self.uploaded = 0
+        self.clippings_checkpoints = {}
+        self.missing_sources = []
+        self.resumed = 0
+        self.replayed = 0
+        self.queued = 0
+        self.superseded = 0
+        self.stale = []
+        self.updated = 0
+        self.deleted = 0
+        self.unknown = 0
+
+        # The config and style given explicitly are only kept in memory
+        self.explicit = config is not None
+        if self.explicit:
+            self.config_values = self.__default_config()
+            self.config_values.update(config)
+            self.kindle_log = self.config_values['kindle.log']
+            self.style_values = dict(style) if style is not None else self.__default_style()
+            return
 
         # Load the necessary information
         try:
@@ -31,14 +86,17 @@ class TimeCapsule:
         except:
             self.__generate_config_file()
         
-        try:
-            self.style_values = self.__load_file(self.style_file)
-        except:
-            self.__generate_style_file()
+        if style is not None:
+            self.style_values = dict(style)
+        else:
+            try:
+                self.style_values = self.__load_file(self.style_file)
+            except:
+                self.__generate_style_file()
         
-        # Also check if the kindle file was created, if not create it
+        # Also check if the kindle file was created, if not create it (empty journal)
         if (not os.path.exists(self.kindle_log)):
-            self.__write_file(self.kindle_log, [])
+            open(self.kindle_log, 'a').close()
         
     def config(self,name:str, value:str) -> None:
         """Change the value for one of the configuration's variables. 
@@ -52,6 +110,14 @@ class TimeCapsule:
             None
         """
 
+        # A config given explicitly is only changed in memory
+        if self.explicit:
+            self.config_values[name] = value
+            if name == 'kindle.log':
+                self.kindle_log = value
+                self.journal = None
+            return
+
         # First and foremost we need to check if we the config file is already in our system
         if (not self.__file_exists(self.config_file)):
             self.__generate_config_file()
@@ -80,6 +146,11 @@ class TimeCapsule:
             None
         """
 
+        # A style given explicitly is only changed in memory
+        if self.explicit:
+            self.style_values[element][variable] = value
+            return
+
         # First and foremost we need to check if we the style file is already in our system
         if (not self.__file_exists(self.style_file)):
             self.__generate_style_file()
@@ -106,6 +177,27 @@ class TimeCapsule:
         """
         return os.path.exists(path_to_file)
         
+    def __default_config(self) -> dict:
+        """ The default values of the config variables
+
+        Returns:
+            dict
+        """
+        return {'notion.v2token':'',
+                'notion.page':'',
+                'kindle.location': '/Volumes/Kindle' if platform=='darwin' else '/media/Kindle',
+                'kindle.log': self.kindle_log}
+
+    def __default_style(self) -> dict:
+        """ The default style of each element
+
+        Returns:
+            dict
+        """
+        return {'title': {'color':'pink', 'block.type':'SubheaderBlock'},
+                'quote': {'color':'default', 'block.type':'QuoteBlock'},
+                'annotation': {'color':'gray', 'block.type':'BulletedListBlock'}}
+
     def __generate_config_file(self) -> None:
         """Generates a config.json file in the `self.config_file` location with all default values
 
@@ -113,12 +205,10 @@ class TimeCapsule:
             None
         """
             
-        data = {'notion.v2token':'',
-                'notion.page':'',
-                'kindle.location': '/Volumes/Kindle' if platform=='darwin' else '/media/Kindle',
-                'kindle.log': self.kindle_log}
+        data = self.__default_config()
 
         self.__write_file(file_name = self.config_file, data = data, overwrite=True)
+        self.config_values = data
 
     def __generate_style_file(self) -> None:
         """Generates a style.json file in the `self.style_file` location with all default values
@@ -127,11 +217,10 @@ class TimeCapsule:
             None
         """
             
-        data = {'title': {'color':'pink', 'block.type':'SubheaderBlock'},
-                'quote': {'color':'default', 'block.type':'QuoteBlock'},
-                'annotation': {'color':'gray', 'block.type':'BulletedListBlock'}}
+        data = self.__default_style()
 
         self.__write_file(file_name = self.style_file, data = data, overwrite=True)
+        self.style_values = data
          
     def __load_file(self, file_name:str) -> dict:
         """ Load a json file
@@ -163,173 +252,1112 @@ class TimeCapsule:
         with open(file_name, mode) as f:
             f.write(json.dumps(data, indent=4))
 
-    def get_kindle_highlights(self, only_new:bool = True)->list:
-        """ Load and parse the `My Clippings.txt` file from the user's kindle. It can either return only the new entries or all of them
+    def get_kindle_highlights(self, only_new:bool = True, sources:list = None, keep_all:bool = False)->list:
+        """ Load and parse the `My Clippings.txt` file from the user's kindle. It can either return only the new entries or all of them.
+        When only the new entries are requested, the file is parsed incrementally from the checkpoint saved in the last upload.
 
         Args:
             only_new (bool, optional): All entries or only the new ones. Defaults to True.
+            sources (list, optional): Kindles mount points, clippings files or glob patterns to read from. Defaults to None (i.e the `kindle.location`).
+            keep_all (bool, optional): Also keep the highlights that were extended or edited afterwards. Defaults to False.
 
         Returns:
             list: Highlights from the user's kindle
         """
-        
-        # Get the data from the kindle .txt file 
-        kindle = Highlights()
-        self.kindle_highlights = kindle.get_kindle_highlights(self.config_values['kindle.location'])
-
-        # Read the log file, create an populate with empty json if does not exist
-        if (not self.__file_exists(self.kindle_log)):
-            self.logged_highlights = []
-            self.__write_file(self.kindle_log, self.logged_highlights)
-        else:
-            self.logged_highlights = self.__load_file(self.kindle_log)
+        return list(self.iter_kindle_highlights(only_new, sources, keep_all))
 
-        # If the argument `only_new` is set to true, we first need to parse the data before uploading to notion 
-        # So we first need to load the data from the last kindle check
-        if only_new:
-            # only keep the new data during the list comprehention 
-            self.new_highlights = [highlight for highlight in self.kindle_highlights if highlight not in self.logged_highlights] 
+    def iter_kindle_highlights(self, only_new:bool = True, sources:list = None, keep_all:bool = False):
+        """ Stream the highlights from the user's kindle, as `get_kindle_highlights` does but without holding them all in memory.
+        When there is more than one clippings file, they are parsed in parallel (one process each) and merged in the order of the sources.
+        The checkpoints of the clippings files are only known once all highlights were read.
 
-            # Return only the new highlight 
-            return self.new_highlights
-        
-        # Else return all the highlight 
-        return self.kindle_highlights 
+        The highlights that were extended or edited afterwards are dropped (unless `keep_all` is set). That can only be known once all of
+        them were read, so the new highlights are held in memory before the first one is released. The ones uploaded by an earlier sync
+        that were extended or edited since are kept in `stale`, so the upload can replace them on the page.
+
+        Args:
+            only_new (bool, optional): All entries or only the new ones. Defaults to True.
+            sources (list, optional): Kindles mount points, clippings files or glob patterns to read from. Defaults to None (i.e the `kindle.location`).
+            keep_all (bool, optional): Also keep the highlights that were extended or edited afterwards. Defaults to False.
+
+        Yields:
+            Clipping: Each highlight from the user's kindle
+        """
+
+        # The stages are timed in the metrics of the upload consuming them
+        metrics = self.metrics
+
+        # Load the index of the log file (it is created if it does not exist, and migrated if still in the old json format)
+        if self.journal is None:
+            with metrics.stage('dedup'):
+                self.__open_journal()
+
+        # Find the clippings file of each source. A single missing source keeps failing as before, since there would be nothing to upload
+        sources = sources or [self.config_values['kindle.location']]
+        files, self.missing_sources = find_clippings_files(sources)
+        if not files and len(sources) == 1:
+            files = [clippings_file(sources[0])]
+
+        # Only resume from the last checkpoints if we are looking for new entries and the log still holds the old ones,
+        # otherwise we need a full scan of the files
+        saved = self.__load_checkpoints() if only_new and len(self.journal) else {}
+        checkpoints = [saved.get(file_name) for file_name in files]
+
+        # Get the data from the kindle .txt files
+        logger.info('Reading %s', ', '.join(files))
+        highlights = metrics.timed(self.__parse_sources(files, checkpoints), 'parse')
+
+        # Drop the entries repeated in the files themselves (e.g. a kindle and an exported copy of its clippings), and if the argument
+        # `only_new` is set to true the ones already uploaded as well
+        highlights = metrics.timed(deduplicate(highlights, self.journal.index if only_new else frozenset()), 'dedup')
+
+        # Only keep the latest version of the highlights that were extended or edited
+        self.superseded = 0
+        self.stale = []
+        if not keep_all:
+            highlights = metrics.timed(self.__drop_superseded(highlights, metrics), 'overlaps')
+
+        yield from highlights
+
+    def __drop_superseded(self, highlights, metrics:Metrics):
+        """ Drop the highlights covered by a more recent highlight of the same book (see `superseded`), counting them in `superseded`.
+        The highlights of the same books in the `kindle.log` are compared as well, and the ones a new highlight supersedes are kept in `stale`
+
+        Args:
+            highlights (iterable)
+            metrics (Metrics): The metrics to count them in
+
+        Yields:
+            Clipping: Each highlight that was not superseded, in the same order
+        """
+        highlights = list(highlights)
+
+        # The logged highlights go first, since they are older than the new ones. Those that were already superseded before (e.g. they
+        # were uploaded with `--keep-all`) are left as they are
+        logged = self.__logged_highlights(highlights)
+        dropped = superseded(logged + highlights)
+        if logged:
+            before = superseded(logged)
+            self.stale = [logged[position] for position in sorted(dropped) if position < len(logged) and position not in before]
+            dropped = {position - len(logged) for position in dropped if position >= len(logged)}
+
+        self.superseded = len(dropped)
+        metrics.count('superseded', len(dropped))
+        if dropped:
+            logger.info('Skipping %d highlights that were extended or edited afterwards', len(dropped))
+
+        for position, highlight in enumerate(highlights):
+            if position not in dropped:
+                yield highlight
+
+    def __logged_highlights(self, highlights:list) -> list:
+        """ The records of the `kindle.log` overlapping the location range of a highlight of the same book (see `overlapping`),
+        but not the records of the highlights themselves, in the order they were logged
+
+        Args:
+            highlights (list)
+
+        Returns:
+            list
+        """
+        if not highlights or not len(self.journal):
+            return []
+
+        digests = {highlight_hash(highlight) for highlight in highlights}
+        return [record for record in overlapping(highlights, self.journal.records()) if highlight_hash(record) not in digests]
+
+    def __parse_sources(self, files:list, checkpoints:list):
+        """ Parse the clippings files, saving the checkpoint reached in each one of them in `clippings_checkpoints`
+
+        Args:
+            files (list): The paths to the clippings files
+            checkpoints (list): The checkpoint saved for each file (`None` for a full scan)
+
+        Yields:
+            Clipping: Each highlight, in the order of the files
+        """
+        self.clippings_checkpoints = {}
+
+        # A single file is streamed, there is nothing to gain from another process
+        if len(files) == 1:
+            kindle = Highlights()
+            yield from kindle.iter_kindle_highlights(files[0], checkpoints[0])
+            self.clippings_checkpoints[files[0]] = kindle.checkpoint
+            return
+
+        from concurrent.futures import ProcessPoolExecutor
+
+        # Otherwise all of them are parsed at the same time, so it takes about as long as the largest one
+        with ProcessPoolExecutor(max_workers=min(len(files), os.cpu_count() or 1)) as executor:
+            for file_name, (highlights, checkpoint) in zip(files, executor.map(parse_clippings_file, files, checkpoints)):
+                yield from highlights
+                self.clippings_checkpoints[file_name] = checkpoint
+
+    def __open_search_index(self):
+        """ Open the search index the first time it is needed, keeping it open for the next uploads
+
+        Returns:
+            SearchIndex: `None` if it could not be opened (e.g. the SQLite library was built without FTS5)
+        """
+        if self.search_index is None:
+            import sqlite3
+            from booknote.search_index import SearchIndex
+
+            try:
+                self.search_index = SearchIndex(self.search_file)
+            except sqlite3.Error as e:
+                logger.warning('The search index could not be opened (%s), the highlights will not be indexed', e)
+
+        return self.search_index
+
+    def __index_journal(self) -> None:
+        """ Add the records appended to the `kindle.log` by the upload to the search index, so they can be searched right away.
+        Only the new records are read (see `SearchIndex.sync_journal`), so the highlights already indexed are not gone through again
 
-    def upload_highlights(self, highlights:list)-> None:
-        """ Upload to Notion the `highlights` from the kindle
+        Returns:
+            None
+        """
+        index = self.__open_search_index()
+        if index is not None:
+            index.sync_journal(self.kindle_log)
+
+    def search_highlights(self, query:str, book:str = None, since = None, until = None, limit:int = 20, marks:tuple = ('[', ']')) -> list:
+        """ Search the highlights in the local index, catching up with the `kindle.log` first. It does not need the kindle nor Notion
 
         Args:
-            highlights (list): All the highlights to be uploaded
+            query (str): The terms to look for, in the FTS5 query syntax (e.g. `freedom NOT fear`, `"exact phrase"` or `empir*`)
+            book (str, optional): Only the highlights of the books whose title contains it. Defaults to None.
+            since (date, optional): Only the highlights added on or after that day. Defaults to None.
+            until (date, optional): Only the highlights added on or before that day. Defaults to None.
+            limit (int, optional): Maximum number of results. Defaults to 20.
+            marks (tuple, optional): What goes around the matched terms in the snippets. Defaults to ('[', ']').
 
         Raises:
-            NotionCredentialError: If there is an error with notion's authorization on sign-in
+            sqlite3.Error: If the index could not be opened
+
+        Returns:
+            list: The results, the best matches first (see `SearchIndex.search`)
+        """
+        from booknote.search_index import SearchIndex
+
+        if self.search_index is None:
+            self.__ensure_state_dir()
+            self.search_index = SearchIndex(self.search_file)
+
+        self.search_index.sync_journal(self.kindle_log)
+        return self.search_index.search(query, book, since, until, limit, marks)
+
+    def iter_upload_batches(self, only_new:bool = True, batch_size:int = 100, sources:list = None, keep_all:bool = False):
+        """ Stream the highlights from the user's kindle already separated in per-book batches, ready to be uploaded.
+        With `keep_all`, only a bounded number of highlights is held in memory at once, no matter the size of the clippings file.
+        Otherwise all the new highlights are held in memory, to find the ones that were extended or edited afterwards.
+
+        Args:
+            only_new (bool, optional): All entries or only the new ones. Defaults to True.
+            batch_size (int, optional): Maximum number of highlights in a batch. Defaults to 100.
+            sources (list, optional): Kindles mount points, clippings files or glob patterns to read from. Defaults to None (i.e the `kindle.location`).
+            keep_all (bool, optional): Also keep the highlights that were extended or edited afterwards. Defaults to False.
+
+        Yields:
+            tuple: The book's title and a list of its highlights
+        """
+        return book_batches(self.iter_kindle_highlights(only_new, sources, keep_all), batch_size)
+
+    def __load_checkpoints(self) -> dict:
+        """ Load the checkpoints saved for each clippings file, an empty dict if there are none (or they are unreadable)
+
+        Returns:
+            dict: The checkpoints indexed by the path to the clippings file
+        """
+        try:
+            return self.__load_file(self.checkpoint_file)
+        except (OSError, ValueError):
+            return {}
+
+    def __save_checkpoints(self) -> None:
+        """ Save the checkpoints reached by the last parse of the clippings files
 
         Returns:
             None
         """
-        
+        checkpoints = self.__load_checkpoints()
+        checkpoints.update(self.clippings_checkpoints)
+        self.__write_file(self.checkpoint_file, checkpoints)
+
+    def upload_highlights(self, highlights, jobs:int = 1, backend = None)-> int:
+        """ Upload to Notion the `highlights` from the kindle.
+        The highlights are consumed as a stream and uploaded in per-book batches, so they can come straight from `iter_kindle_highlights`.
+        Each highlight is recorded in the progress journal as soon as its blocks are confirmed by Notion, so if the upload is interrupted
+        the next one resumes from where it stopped, skipping the highlights that already made it. The transaction that interrupted it
+        (failing even after being retried) is kept in the `upload.queue`, and sent again as it was before anything else in the next upload.
+
+        Args:
+            highlights (iterable): All the highlights to be uploaded
+            jobs (int, optional): How many books are uploaded in parallel. Defaults to 1.
+            backend (NotionBackend, optional): Where to upload the highlights, e.g. a `FakeNotionBackend` for a dry run. Defaults to None (i.e Notion itself).
+
+        Raises:
+            NotionCredentialError: If there is an error with notion's authorization on sign-in
+            NotionRequestError: If a request to Notion failed, even after being retried
+
+        Returns:
+            int: How many requests were sent to Notion by this upload
+        """
+        # Every upload has its own metrics, even when it fails
+        self.metrics = Metrics()
+        try:
+            return self.__upload(highlights, jobs, backend)
+        finally:
+            self.__finish_metrics()
+
+    def __upload(self, highlights, jobs:int, backend) -> int:
+        """ The upload itself, see `upload_highlights`
+
+        Returns:
+            int: How many requests were sent to Notion by this upload
+        """
         # To upload the highlights to notion we first need to initialize the notion API, if it fails 
-        self.__initialize_notion_api()
+        self.__initialize_notion_api(backend)
+        self.__ensure_state_dir()
+
+        # Skip the highlights confirmed by an upload that was interrupted (a dry run neither resumes nor records anything)
+        self.progress_lock = threading.Lock()
+        self.progress = None
+        self.resumed = 0
+        self.replayed = 0
+        self.queued = 0
+        self.uploaded = 0
+        self.deleted = 0
+
+        # A single queue for the whole upload, so the workers that fail at the same time share its lock
+        self.queue = TransactionQueue(self.queue_file)
+        if not self.backend.dry_run:
+            self.progress = HighlightJournal(self.progress_file)
+            self.__replay_transactions()
+        highlights = self.__skip_confirmed(highlights)
+
+        # Separate each highlight by their book as they come, and upload each batch of quotes
+        self.__populate_notion(self.metrics.timed(book_batches(highlights), 'grouping'), jobs)
+
+        # Once their new version is on the page, the highlights uploaded before that were extended or edited since are removed from it
+        stale, self.stale = self.stale, []
+        if stale:
+            with self.metrics.stage('block removal'):
+                self.__remove_stale(stale)
+            self.metrics.count('deleted', self.deleted)
+        if self.resumed:
+            logger.info('Resumed the last upload, skipped %d highlights already in Notion', self.resumed)
+        if self.backend.dry_run:
+            return self.backend.requests - self.requests_before
+
+        with self.metrics.stage('save'):
+            self.__save_page()
+
+            # And at last we can save the confirmed highlights (including the ones from the upload it resumed) to the kindle file,
+            # and where to resume the parsing from on the next sync
+            if self.journal is None:
+                self.__open_journal()
+            self.journal.append(self.progress.records())
+            self.__save_checkpoints()
+
+            # Now that everything is in the log, the progress journal of this upload is no longer needed
+            os.remove(self.progress_file)
+
+        with self.metrics.stage('index'):
+            self.__index_journal()
+
+        return self.backend.requests - self.requests_before
+
+    def __save_page(self) -> None:
+        """ Save the index of the titles of each page the upload touched (the target page or its shards), and add the blocks created
+        on them to their snapshot (so they never need to be requested)
 
-    
-        # First need to separate each highlight by their book
-        # We first get all the book titles form each and every entry  
-        book_titles = [entry['book title'] for entry in highlights]
+        Returns:
+            None
+        """
+        save_title_indexes(self.index_file, [(titles, self.__page_content(page_id)) for page_id, (titles, _, _) in self.targets.items()])
 
-        # Then we create a dictionary with the titles as keys (there will be no repetition) with the value of an empty list
-        ordered_highlights = dict.fromkeys(book_titles, [])
-        
-        # Now we can populate every list with a quote
-        for key in ordered_highlights:
-            ordered_highlights[key] = [entry for entry in highlights if entry['book title'] == key]
-        
+        for page_id, (_, snapshot, initial_content) in self.targets.items():
+            created = [self.backend.get_record(block_id) for block_id in self.__page_content(page_id) if block_id not in initial_content]
+            snapshot.append(created, self.backend.get_record(page_id).get('last_edited_time'))
+
+        if self.shards is not None:
+            self.shards.save(self.__page_content())
 
-        # Now that we have the quotes separated by their book title, we can upload the data 
-        self.__populate_notion(ordered_highlights)
+    def reconcile_highlights(self, sources:list = None, jobs:int = 1, backend = None, keep_all:bool = False, prune:bool = False) -> int:
+        """ Bring the Notion page up to date with all the highlights known locally (see `__local_highlights`), instead of only appending the new ones.
+        The highlights already on the page are matched to the local ones by the hash stored in their blocks (see `diff_book`), so only the
+        missing highlights are created, and only the blocks that differ are updated or deleted. It is meant to recover from a lost or corrupted
+        `kindle.log`, which is rebuilt with every highlight on the page.
 
-        # And at last we can save the data to the kindle file 
-        self.__write_file(self.kindle_log, self.kindle_highlights)
+        Args:
+            sources (list, optional): Kindles mount points, clippings files or glob patterns to read from. Defaults to None (i.e the `kindle.location`).
+            jobs (int, optional): How many books are uploaded in parallel. Defaults to 1.
+            backend (NotionBackend, optional): Where the page is, e.g. a `FakeNotionBackend` for a dry run. Defaults to None (i.e Notion itself).
+            keep_all (bool, optional): Also keep the highlights that were extended or edited afterwards. Defaults to False.
+            prune (bool, optional): Also delete the highlights on the page that are not known locally. Defaults to False.
+
+        Raises:
+            NotionCredentialError: If there is an error with notion's authorization on sign-in
+            NotionRequestError: If a request to Notion failed, even after being retried (running it again picks up from there)
+
+        Returns:
+            int: How many requests were sent to Notion
+        """
+        self.metrics = Metrics()
+        try:
+            return self.__reconcile(sources, jobs, backend, keep_all, prune)
+        finally:
+            self.__finish_metrics()
+
+    def __reconcile(self, sources:list, jobs:int, backend, keep_all:bool, prune:bool) -> int:
+        """ The reconciliation itself, see `reconcile_highlights`
+
+        Returns:
+            int: How many requests were sent to Notion
+        """
+        from booknote.notion_batch import BlockBatch
+
+        self.__initialize_notion_api(backend)
+        self.__ensure_state_dir()
+        self.progress = None
+        self.progress_lock = threading.Lock()
+        self.queue = TransactionQueue(self.queue_file)
+        self.resumed = self.replayed = self.queued = self.uploaded = 0
+        self.updated = self.deleted = self.unknown = 0
+
+        # Every local highlight, split between the ones that belong on the page and the ones that were extended or edited afterwards
+        highlights = list(self.metrics.timed(self.__local_highlights(sources), 'parse'))
+        dropped = superseded(highlights) if not keep_all else set()
+        self.superseded = len(dropped)
+        wanted = group_by_book(highlight for position, highlight in enumerate(highlights) if position not in dropped)
+        stale = group_by_book(highlights[position] for position in dropped)
+
+        self.__load_style()
+        with self.metrics.stage('children fetch'):
+            # When the books are sharded, every shard is compared (but not the other child pages)
+            pages = [self.page]
+            if self.__load_shards(wanted) is not None:
+                pages = [page for page in self.backend.load_records(self.shards.pages()) if page]
+
+            sections = {}
+            for page in pages:
+                for title, blocks in fetch_sections(self.backend, page, self.header_type, self.nested).items():
+                    sections.setdefault(title, []).extend(blocks)
+
+        # The changes to the highlights already on the page are sent first, so the new ones go after what is left of each section
+        missing = []
+        batch = BlockBatch(self.backend)
+        with self.metrics.stage('reconcile'):
+            for title in list(wanted) + [title for title in sections if title not in wanted]:
+                groups = highlight_groups(sections.get(title, []), self.quote_type, self.location_type)
+                updates, deletes, new, unknown = diff_book(groups, wanted.get(title, []), stale.get(title, []), prune)
+
+                for group, highlight in updates:
+                    batch.update_block(group['quote']['id'], {'title': [[highlight['quote']]], HASH_PROPERTY: [[highlight_hash(highlight)]]})
+                    batch.update_block(group['location']['id'], {'title': [[location_text(highlight)]]})
+                    batch.end_group()
+                for group in deletes:
+                    for block in ('quote', 'location', 'divider'):
+                        if block in group:
+                            batch.remove_block(group[block]['id'], group['parent'])
+                    batch.end_group()
+
+                missing += [(title, new[position:position + 100]) for position in range(0, len(new), 100)]
+                self.updated += len(updates)
+                self.deleted += len(deletes)
+                self.unknown += unknown
+            batch.flush()
+
+        # The queue and the progress of an interrupted upload would only add the highlights that are created here again
+        if not self.backend.dry_run:
+            self.queue.replace([])
+
+        # The title index is built from the records just requested (and changed), so nothing else needs to be requested
+        records = [self.backend.get_record(block_id) for block_id in self.__page_content()] if self.shards is None else None
+        self.__populate_notion(iter(missing), jobs, records)
+        self.uploaded = sum(len(quotes) for _, quotes in missing)
+        self.metrics.count('updated', self.updated)
+        self.metrics.count('deleted', self.deleted)
+        self.metrics.count('superseded', self.superseded)
+        if self.unknown:
+            logger.info('Kept %d highlights on the page that are not in the local history', self.unknown)
+        if self.backend.dry_run:
+            return self.backend.requests - self.requests_before
+
+        with self.metrics.stage('save'):
+            self.__save_page()
+
+            # Every highlight that belongs on the page is there now, so the log holds all of them
+            self.journal.append([highlight for quotes in wanted.values() for highlight in quotes])
+            self.__save_checkpoints()
+            if os.path.exists(self.progress_file):
+                os.remove(self.progress_file)
+
+        with self.metrics.stage('index'):
+            self.__index_journal()
+
+        return self.backend.requests - self.requests_before
+
+    def __remove_stale(self, stale:list) -> None:
+        """ Remove from the page the blocks of logged highlights that were superseded by the ones just uploaded, counting them in `deleted`.
+        They are found in their book's section by the hash stored in their quote block, or by their text if they were uploaded before the
+        hashes were stored
 
-    def __initialize_notion_api(self) -> None:
+        Args:
+            stale (list): The records of the superseded highlights
+
+        Raises:
+            NotionRequestError
+
+        Returns:
+            None
+        """
+        from booknote.notion_batch import BlockBatch
+
+        batch = BlockBatch(self.backend)
+        for title, records in group_by_book(stale).items():
+            digests = {highlight_hash(record) for record in records}
+            texts = {(record['quote'], location_text(record)) for record in records}
+
+            for group in highlight_groups(self.__section(title), self.quote_type, self.location_type):
+                if block_hash(group['quote']) in digests or (block_hash(group['quote']) is None and (block_title(group['quote']), block_title(group['location'])) in texts):
+                    for block in ('quote', 'location', 'divider'):
+                        if block in group:
+                            batch.remove_block(group[block]['id'], group['parent'])
+                    batch.end_group()
+                    self.deleted += 1
+        batch.flush()
+
+        if self.deleted:
+            logger.info('Removed %d highlights from the page that were extended or edited afterwards', self.deleted)
+
+    def __section(self, title:str) -> list:
+        """ Request the blocks of a book's section of the page (or of its shard), as `fetch_sections` does but without the other books
+
+        Args:
+            title (str): The book's title
+
+        Raises:
+            NotionRequestError
+
+        Returns:
+            list: The records of the section (in order) and the id of their parent, empty if the book is not on the page
+        """
+        page_id = self.page_id if self.shards is None else self.shards.page(self.shards.books.get(title))
+        if page_id not in self.targets or title not in self.targets[page_id][0]:
+            return []
+
+        titles = self.targets[page_id][0]
+        if self.nested:
+            header = self.backend.load_records([titles.header(title)])[0] or {}
+            return [(record, header['id']) for record in self.backend.load_records(header.get('content') or []) if record]
+
+        # The blocks between its title block and the last block of its section
+        content = self.__page_content(page_id)
+        start, end = content.index(titles.header(title)), content.index(titles.section_end(title))
+        return [(record, page_id) for record in self.backend.load_records(content[start + 1:end + 1]) if record]
+
+    def __replay_transactions(self) -> None:
+        """ Send the transactions queued by the last upload, in the order they failed, confirming their highlights.
+        It happens before anything else is uploaded, since the next blocks of their books are placed after theirs
+
+        Raises:
+            NotionRequestError: If one of them fails again, it is kept in the queue along with the ones after it
+
+        Returns:
+            None
+        """
+        entries = self.queue.entries()
+        if not entries:
+            return
+
+        logger.info('Replaying %d transactions that failed in the last upload', len(entries))
+        with self.metrics.stage('replay'):
+            for position, entry in enumerate(entries):
+                try:
+                    self.backend.submit_transaction(entry['operations'])
+                except NotionRequestError:
+                    self.queue.replace(entries[position:])
+                    raise
+
+                self.__confirm_highlights(entry['highlights'])
+                self.replayed += len(entry['highlights'])
+
+            self.queue.replace([])
+
+    def __queue_transaction(self, operations:list, highlights:list, error:NotionRequestError) -> None:
+        """ Keep a transaction that failed in the `upload.queue`, so it is replayed by the next upload. To be used as the batches' `on_failure`.
+        Only the transient errors are worth replaying (a dry run does not keep anything)
+
+        Args:
+            operations (list): The operations of the transaction
+            highlights (list): The highlights whose blocks it creates
+            error (NotionRequestError)
+
+        Returns:
+            None
+        """
+        if self.backend.dry_run or not is_transient(error):
+            return
+
+        self.queue.append(operations, highlights)
+        with self.progress_lock:
+            self.queued += len(highlights)
+        logger.warning('A transaction with %d highlights failed (%s), it will be sent again on the next upload', len(highlights), error)
+
+    def __finish_metrics(self) -> None:
+        """ Stop the clock of the upload's metrics and add its counters, including the requests made to each endpoint
+
+        Returns:
+            None
+        """
+        self.metrics.stop()
+        self.metrics.count('highlights', self.uploaded)
+        self.metrics.count('resumed', self.resumed)
+        self.metrics.count('replayed', self.replayed)
+
+        backend = self.measured_backend
+        if backend is None:
+            return
+
+        self.metrics.count('requests', backend.requests - self.requests_before)
+        self.metrics.count('retries', backend.retries - self.retries_before)
+        self.metrics.count('rate limited', backend.scheduler.throttled - self.throttled_before)
+        for endpoint, requests in backend.endpoints.items():
+            if requests > self.endpoints_before.get(endpoint, 0):
+                self.metrics.count('requests: ' + endpoint, requests - self.endpoints_before.get(endpoint, 0))
+
+    def __skip_confirmed(self, highlights):
+        """ Drop the highlights already confirmed by an interrupted upload, counting how many were skipped and how many go through
+
+        Args:
+            highlights (iterable)
+
+        Yields:
+            dict: Each highlight still to be uploaded
+        """
+        confirmed = set(self.progress.index) if self.progress is not None else set()
+
+        for highlight in highlights:
+            if confirmed and highlight_hash(highlight) in confirmed:
+                self.resumed += 1
+                continue
+
+            self.uploaded += 1
+            yield highlight
+
+    def __confirm_highlights(self, highlights:list) -> None:
+        """ Record in the progress journal the highlights whose blocks were confirmed by Notion. To be used as the batches' `on_flush`
+
+        Args:
+            highlights (list)
+
+        Returns:
+            None
+        """
+        if self.progress is None:
+            return
+
+        with self.progress_lock:
+            self.progress.append(highlights)
+
+    def export_highlights(self, out:str, file_format:str = 'md', jobs:int = 4, sources:list = None) -> tuple:
+        """ Export all the highlights to local files, one for each book, skipping the books that did not change since the last export.
+        The highlights come from the `kindle.log` and from the kindle itself (if it is connected), so the ones not uploaded yet are included.
+
+        Args:
+            out (str): The output directory
+            file_format (str, optional): `md`, `json` or `csv`. Defaults to 'md'.
+            jobs (int, optional): How many files are written in parallel. Defaults to 4.
+            sources (list, optional): Kindles mount points, clippings files or glob patterns to read from. Defaults to None (i.e the `kindle.location`).
+
+        Returns:
+            tuple: How many files were written and how many were skipped
+        """
+        from booknote.export import Exporter
+
+        exporter = Exporter(out, file_format, self.style_values, jobs)
+        return exporter.export(group_by_book(self.__local_highlights(sources)))
+
+    def __local_highlights(self, sources:list = None):
+        """ All the highlights known locally: the ones on the kindle (fully parsed, if it is connected) followed by the ones in the `kindle.log`
+
+        Args:
+            sources (list, optional): Kindles mount points, clippings files or glob patterns to read from. Defaults to None (i.e the `kindle.location`).
+
+        Yields:
+            Clipping or dict: Each highlight, only once
+        """
+        from itertools import chain
+
+        if self.journal is None:
+            self.__open_journal()
+
+        # The kindles that are not connected are simply left out, what was uploaded from them is in the log anyway
+        files, self.missing_sources = find_clippings_files(sources or [self.config_values['kindle.location']])
+        highlights = chain(self.__parse_sources(files, [None] * len(files)) if files else [], self.journal.records())
+
+        return deduplicate(highlights)
+
+    def compact_log(self) -> tuple:
+        """ Compact the `kindle.log` journal, dropping duplicated and corrupted records
+
+        Returns:
+            tuple: The number of records kept and dropped
+        """
+        self.__ensure_state_dir()
+        return HighlightJournal(self.kindle_log).compact()
+
+    def close(self) -> None:
+        """ Close the files kept open between uploads (i.e the search index)
+
+        Returns:
+            None
+        """
+        if self.search_index is not None:
+            self.search_index.close()
+            self.search_index = None
+
+    def __open_journal(self) -> HighlightJournal:
+        """ Load the index of the `kindle.log`, keeping it for the next uploads (it is created if it does not exist, and migrated if still
+        in the old json format)
+
+        Returns:
+            HighlightJournal
+        """
+        self.__ensure_state_dir()
+        self.journal = HighlightJournal(self.kindle_log)
+        return self.journal
+
+    def __ensure_state_dir(self) -> None:
+        """ Create the directories of the state files, if they do not exist yet
+
+        Returns:
+            None
+        """
+        for directory in {self.state_dir, os.path.dirname(self.kindle_log)}:
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory, exist_ok=True)
+
+    def __initialize_notion_api(self, backend = None) -> None:
         """ Initialize the notion connection
 
+        Args:
+            backend (NotionBackend, optional): The backend to connect through. Defaults to None (i.e Notion itself).
+
         Raises:
             NotionCredentialError: If there is an error during authentication
+            NotionRequestError: If Notion could not be reached, even after retrying
 
         Returns:
             None
         """
+        # The notion stack is only imported by the backend once it logs in, and the session is kept for the next uploads
+        if backend is None:
+            backend = self.backend or NotionClientBackend(self.config_values['notion.v2token'])
+        self.measured_backend = backend
+        self.requests_before = backend.requests
+        self.retries_before = backend.retries
+        self.throttled_before = backend.scheduler.throttled
+        self.endpoints_before = dict(backend.endpoints)
+
         try:
-            self.client = NotionClient(token_v2 = self.config_values['notion.v2token'])
-            self.page = self.client.get_block(self.config_values['notion.page'])
-        except:
+            # Only the page's own record is requested (again, since it might have been edited between uploads),
+            # its children are loaded later if the title index needs to be rebuilt
+            # A backend shared with other capsules (see `booknote.session_pool`) might already be logged in
+            if backend is not self.backend and backend.user_id is None:
+                with self.metrics.stage('login'):
+                    backend.login()
+            with self.metrics.stage('children fetch'):
+                self.page = backend.get_page(self.config_values['notion.page'])
+        except NotionRequestError as e:
+            # Only a rejected token is a problem with the credentials, the other errors (e.g. no connection) are reported as they are
+            if e.status_code in (401, 403):
+                raise NotionCredentialError() from e
+            raise
+        except ValueError as e:
+            # The url of the page could not be parsed
+            raise NotionCredentialError() from e
+
+        if self.page is None:
             raise NotionCredentialError()
 
-    def __populate_notion(self, highlights:dict) -> None:
-        """ Populate the target Notion page with the `highlights` according to the styles specified in the `styles.json` file
+        self.backend = backend
+        self.page_id = self.page['id']
+
+    def __page_content(self, page_id:str = None) -> list:
+        """ The ids of the children of a page, as currently known locally
 
         Args:
-            highlights (dict)
+            page_id (str, optional): Defaults to None (i.e the target page).
+
+        Returns:
+            list
+        """
+        record = self.backend.get_record(page_id or self.page_id)
+        return (record or {}).get('content') or []
+
+    def __load_style(self) -> None:
+        """ Set the types and colors of the blocks from the `style.json`
 
         Returns:
             None
         """
+        # Set the types of blocks (as notion names them)
+        types = {'HeaderBlock': 'header', 'SubheaderBlock': 'sub_header', 'SubsubheaderBlock': 'sub_sub_header', 'QuoteBlock': 'quote', 'TextBlock': 'text', 'PageBlock': 'page','BulletedListBlock': 'bulleted_list' ,'TodoBlock': 'to_do', 'CalloutBlock': 'callout', 'ToggleBlock': 'toggle'}
         
-        # Set the types of blocks
-        types = {'HeaderBlock': HeaderBlock, 'SubheaderBlock': SubheaderBlock, 'SubsubheaderBlock': SubsubheaderBlock, 'QuoteBlock': QuoteBlock, 'TextBlock': TextBlock, 'PageBlock': PageBlock,'BulletedListBlock':BulletedListBlock ,'TodoBlock': TodoBlock, 'CalloutBlock': CalloutBlock, 'ToggleBlock': ToggleBlock}
-        
-        header_type = types[self.style_values['title']['block.type']]
-        location_type = types[self.style_values['annotation']['block.type']]
-        quote_type = types[self.style_values['quote']['block.type']]
+        self.header_type = types[self.style_values['title']['block.type']]
+        self.location_type = types[self.style_values['annotation']['block.type']]
+        self.quote_type = types[self.style_values['quote']['block.type']]
+        self.divider_type = 'divider'
         
         # Set the color of the blocks 
-        header_color = self.style_values['title']['color']
-        location_color = self.style_values['annotation']['color']
-        quote_color = self.style_values['quote']['color']
+        self.header_color = self.style_values['title']['color']
+        self.location_color = self.style_values['annotation']['color']
+        self.quote_color = self.style_values['quote']['color']
 
-        # Get a list of all title already on the page 
-        notion_titles = []
-        for child in self.page.children:
-            try:
-                notion_titles.append(child.title)
-            except:
-                continue 
+        # If the header is either a page or a toggle, the quotes go inside of it, otherwise they follow it on the page itself
+        self.nested = self.style_values['title']['block.type'] == 'ToggleBlock' or self.style_values['title']['block.type'] == 'PageBlock'
 
-        print(notion_titles)
+    def __populate_notion(self, batches, jobs:int = 1, records:list = None) -> None:
+        """ Populate the target Notion page with the `batches` of highlights according to the styles specified in the `styles.json` file.
+        The blocks are created directly under their final parent and sent in bulk transactions, and different books can be uploaded in parallel.
 
-        for title in highlights:
-            
-            # First we need to check rather or not the book already has an entry 
-            if title not in notion_titles:
-                # Since there are no previous entries, we can simply add the title and the quote at the end of the page
-                header_block = self.page.children.add_new(header_type, title=title, color=header_color)
-                for quote in highlights[title]:
-                    quote_block = self.page.children.add_new(quote_type, title=quote['quote'], color=quote_color)
-                    page_info_block = self.page.children.add_new(location_type, title=quote['book location'].replace('-',''), color=location_color)
-                    divider_block = self.page.children.add_new(DividerBlock)
+        Args:
+            batches (iterable): The per-book batches, as tuples of the book's title and a list of its highlights
+            jobs (int, optional): How many books are uploaded at the same time. Defaults to 1.
+            records (list, optional): The records of the page's children, if they were already requested. Defaults to None.
 
-                    # Now, if the header block is either a page or a toggle, move the blocks to the correct location 
-                    if self.style_values['title']['block.type'] == 'ToggleBlock' or self.style_values['title']['block.type'] == 'PageBlock':
-                        quote_block.move_to(header_block, "last-child")
-                        page_info_block.move_to(header_block, "last-child")
-                        divider_block.move_to(header_block, "last-child")
+        Returns:
+            None
+        """
+        from booknote.notion_batch import BlockBatch
+        from concurrent.futures import ThreadPoolExecutor
+
+        self.__load_style()
+
+        # Load the index of the titles already on the page, it is only rebuilt if the page changed since the last upload.
+        # When the books are sharded, the index of each shard is only loaded once a book goes to it. They are shared by all the workers
+        # so they are guarded by a lock
+        self.titles_lock = threading.Lock()
+        self.targets = {}
+        self.jobs = jobs
+        with self.metrics.stage('children fetch'):
+            if self.__load_shards() is None:
+                self.__load_target(self.page_id, records)
+
+        # A single worker can share one batch across all books, keeping the number of transactions to a minimum
+        if jobs <= 1:
+            batch = BlockBatch(self.backend, on_flush=self.__confirm_highlights, on_failure=self.__queue_transaction)
+            for title, quotes in batches:
+                with self.metrics.stage('block creation'):
+                    self.__upload_book(title, quotes, batch)
+            with self.metrics.stage('block creation'):
+                batch.flush()
+            return
+
+        # Otherwise each batch is uploaded by a worker (with its own block batch). Only a few batches are in flight at once,
+        # and the batches of the same book wait for the previous one, so its blocks keep their order
+        in_flight = threading.BoundedSemaphore(2 * jobs)
+        last_batch = {}
+        pending = []
+
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            for title, quotes in batches:
+                in_flight.acquire()
+                future = executor.submit(self.__upload_in_turn, last_batch.get(title), title, quotes)
+                future.add_done_callback(lambda future: in_flight.release())
+                last_batch[title] = future
+
+                # Stop at the first failure
+                pending = [running for running in pending + [future] if not running.done() or running.exception() is not None]
+                for running in pending:
+                    if running.done():
+                        running.result()
+
+            for future in pending:
+                future.result()
+
+    def __load_shards(self, highlights:dict = None):
+        """ Load the index of the shards of the target page, if the books are sharded (the `notion.shards` config).
+        It is only rebuilt (from the page's children) if the page or the mode changed since the last upload. When rebuilding it, the books
+        still on the page itself (uploaded before it was sharded) and, if the mode changed, the ones in the shards of the old mode are
+        moved to their shard
+
+        Args:
+            highlights (dict, optional): The highlights of each book, setting the shard of the `date` mode. Defaults to None (i.e the ones in the `kindle.log`).
+
+        Raises:
+            ValueError: If the `notion.shards` config is not one of `SHARD_MODES`
 
+        Returns:
+            ShardIndex: `None` if the books are not sharded
+        """
+        from booknote.shards import ShardIndex
+
+        self.shards = None
+        mode = self.config_values.get('notion.shards', 'none')
+        if mode == 'none':
+            return None
+
+        self.shards = ShardIndex(self.shards_file, self.page_id, mode)
+        if self.shards.load(self.__page_content()):
+            return self.shards
+
+        logger.info('The index of the shards is missing or out of date, rebuilding it')
+        records = self.backend.load_records(self.__page_content())
+        books = self.__root_books(records)
+        previous = self.shards.build([record for record in records if record and record['id'] not in books])
+        moves = [(self.page_id, section) for section in self.__sections(records, books)]
+
+        # The books already in a shard are found from its title blocks, so they stay there even if the index was lost
+        for page in self.backend.load_records(self.shards.pages()):
+            if not page:
+                continue
+            children = PageSnapshot(self.snapshot_dir, page['id']).records(page, self.backend, self.header_type, save = not self.backend.dry_run)
+            headers = {record['id'] for record in children if record['type'] == self.header_type and block_title(record) is not None}
+            for section in self.__sections(children, headers):
+                if previous is not None and previous != mode:
+                    moves.append((page['id'], section))
+                else:
+                    self.shards.assign(block_title(section[0]), block_title(page))
+
+        if moves:
+            self.__move_books(moves, highlights)
+        if not self.backend.dry_run:
+            self.shards.save(self.__page_content())
+
+        return self.shards
+
+    def __root_books(self, records:list) -> set:
+        """ The title blocks on the target page itself, i.e the books uploaded before it was sharded
+
+        Args:
+            records (list): The records of the target page's children
 
-                # Add the titles to the notion_titles now that we have added it no notion 
-                notion_titles.append(title)
-                
-            else:
-                self.title = title
-                # If it is not the first entry, we must find the block corresponding to the title to that book
-                header_block = list(filter(self.__filter_children, self.page.children))[0]
+        Returns:
+            set: The ids of the title blocks
+        """
+        books = [record for record in records if record and record.get('alive', True) and record.get('type') == self.header_type
+                 and block_title(record) is not None]
 
-                # Now that we have the parent block, we can iterate through the quotes and add them
-                for quote in highlights[title]:
-                    quote_block = self.page.children.add_new(quote_type, title=quote['quote'], color=quote_color)
-                    page_info_block = self.page.children.add_new(location_type, title=quote['book location'].replace('-',''), color=location_color)
-                    divider_block = self.page.children.add_new(DividerBlock)
+        # With `PageBlock` titles the books are child pages as well, told apart from the shards by their first child (a shard's are titles)
+        if self.header_type == 'page':
+            books = [record for record in books if record.get('content')]
+            firsts = self.backend.load_records([record['content'][0] for record in books])
+            books = [record for record, first in zip(books, firsts) if first and first.get('type') != 'page']
 
-                    # Now move the blocks to the correct location 
-                    quote_block.move_to(header_block, "last-child")
-                    page_info_block.move_to(quote_block, "last-child")
-                    divider_block.move_to(page_info_block, "last-child")
+        return {record['id'] for record in books}
 
-    def __filter_children(self, child) -> bool:
-        """ Checks if the Notion block is the target one. To be used with the `filter` function.
+    def __sections(self, records:list, headers:set) -> list:
+        """ Split the children of a page in the sections of its books: the title block, followed (in the flat layout) by the blocks up
+        to the next title or child page
 
         Args:
-            child (Block): The target block
+            records (list): The records of the page's children, in order
+            headers (set): The ids of the title blocks of the books
 
         Returns:
-            bool: `True` if child's title equals desired title
+            list: The records of each section
         """
+        sections = []
+        section = None
+        for record in records:
+            if not record:
+                continue
+            if record['id'] in headers:
+                section = [record]
+                sections.append(section)
+            elif self.nested or record.get('type') in (self.header_type, 'page'):
+                section = None
+            elif section is not None:
+                section.append(record)
+
+        return sections
+
+    def __move_books(self, moves:list, highlights:dict = None) -> None:
+        """ Move the sections of some books to their shard, creating the shards that are not on the page yet
 
-        try:
-            if child.title == self.title:
-                return True
-        except:
-            return False
+        Args:
+            moves (list): The id of the page each section is on, and the records of the section
+            highlights (dict, optional): The highlights of each book, setting the shard of the `date` mode. Defaults to None (i.e the ones in the `kindle.log`).
+
+        Raises:
+            NotionRequestError
+
+        Returns:
+            None
+        """
+        from booknote.notion_batch import BlockBatch
+
+        if highlights is None and self.shards.mode == 'date':
+            highlights = group_by_book((self.journal or self.__open_journal()).records())
+        highlights = highlights or {}
+
+        moved = 0
+        batch = BlockBatch(self.backend)
+        for parent_id, section in moves:
+            title = block_title(section[0])
+            name = self.shards.shard(title, highlights.get(title, []))
+            page_id = self.shards.page(name)
+            if page_id == parent_id:
+                continue
+            if page_id is None:
+                page_id = batch.add_block(self.page_id, 'page', title=name)
+                self.shards.add(name, page_id)
+
+            # The blocks keep their order, after whatever the shard already holds
+            after = None
+            for record in section:
+                batch.move_block(record['id'], parent_id, page_id, after=after)
+                after = record['id']
+            batch.end_group()
+            moved += 1
+        batch.flush()
+
+        if moved:
+            logger.info('Moved %d books to their shard', moved)
+
+    def __load_target(self, page_id:str, records:list = None, new:bool = False) -> TitleIndex:
+        """ Load the index of the titles on a page the books are uploaded to (the target page or one of its shards), keeping it in `targets`
+        along with the page's snapshot and its children before the upload
+
+        Args:
+            page_id (str)
+            records (list, optional): The records of the page's children, if they were already requested. Defaults to None.
+            new (bool, optional): Rather or not the page is being created by the upload (so it has no children yet). Defaults to False.
+
+        Returns:
+            TitleIndex
+        """
+        # The index of the last upload is kept, and used again if it was saved for the page's current children
+        titles = self.title_indexes.get(page_id)
+        if new or titles is None or titles.header_type != self.header_type:
+            titles = TitleIndex(self.index_file, page_id, self.header_type)
+            self.title_indexes[page_id] = titles
+
+        snapshot = PageSnapshot(self.snapshot_dir, page_id)
+        self.targets[page_id] = (titles, snapshot, set() if new else set(self.__page_content(page_id)))
+        if new:
+            return titles
+
+        # To rebuild it, only the children that might have changed since the snapshot of the page was taken are requested
+        if records is not None:
+            titles.build(records)
+        elif titles.current(self.__page_content(page_id)):
+            logger.debug('Using the index of the page titles kept from the last upload')
+        elif not titles.load(self.__page_content(page_id)):
+            logger.info('The index of the page titles is missing or out of date, rebuilding it')
+            page = self.backend.get_record(page_id)
+            titles.build(snapshot.records(page, self.backend, self.header_type, save = not self.backend.dry_run))
+
+        return titles
+
+    def __target(self, title:str, quotes:list, batch) -> tuple:
+        """ The page a book is uploaded to and the index of its titles: the target page itself, or the book's shard (which is created
+        if it is not on the page yet). To be called with the `titles_lock`
+
+        Args:
+            title (str): The book's title
+            quotes (list): The book's highlights being uploaded
+            batch (BlockBatch): The batch of the book's blocks
+
+        Returns:
+            tuple: The id of the page and its `TitleIndex`
+        """
+        from booknote.notion_batch import BlockBatch
+
+        if self.shards is None:
+            return self.page_id, self.targets[self.page_id][0]
+
+        name = self.shards.shard(title, quotes)
+        page_id = self.shards.page(name)
+        if page_id is None:
+            # The books of different workers can go to the same shard, so its page is created right away. Only one book goes to each
+            # shard of the `book` mode, so its page can be created along with its blocks
+            shared = self.jobs > 1 and self.shards.mode != 'book'
+            creation = BlockBatch(self.backend) if shared else batch
+            page_id = creation.add_block(self.page_id, 'page', title=name)
+            if shared:
+                creation.flush()
+
+            self.shards.add(name, page_id)
+            self.__load_target(page_id, new=True)
+
+        elif page_id not in self.targets:
+            # The shard's own record is requested again, since it might have been edited since the last upload
+            with self.metrics.stage('children fetch'):
+                self.backend.load_records([page_id])
+                self.__load_target(page_id)
+
+        return page_id, self.targets[page_id][0]
+
+    def __upload_in_turn(self, previous, title:str, quotes:list) -> None:
+        """ Upload a batch of a book's quotes once the previous batch of the same book is done
+
+        Args:
+            previous (Future): The upload of the book's previous batch, `None` if it is the first one
+            title (str): The book's title
+            quotes (list): The book's highlights in the batch
+
+        Returns:
+            None
+        """
+        if previous is not None:
+            previous.result()
+
+        with self.metrics.stage('block creation'):
+            self.__upload_book(title, quotes)
+
+    def __upload_book(self, title:str, quotes:list, batch = None) -> None:
+        """ Upload the quotes of a single book, creating its title block if it is not on the page yet
+
+        Args:
+            title (str): The book's title
+            quotes (list): The book's highlights, in the order they will be added
+            batch (BlockBatch, optional): The batch to queue the blocks in, if not given a new one is created and flushed at the end. Defaults to None.
+
+        Returns:
+            None
+        """
+        from booknote.notion_batch import BlockBatch
+
+        own_batch = batch is None
+        if own_batch:
+            batch = BlockBatch(self.backend, on_flush=self.__confirm_highlights, on_failure=self.__queue_transaction)
+
+        with self.titles_lock:
+            # The page the book goes to, which is the target page itself unless the books are sharded
+            page_id, titles = self.__target(title, quotes, batch)
+
+            # First we need to check rather or not the book already has an entry 
+            if title not in titles:
+                # Since there are no previous entries, we can simply add the title and the quotes at the end of the page
+                header_id = batch.add_block(page_id, self.header_type, title=title, color=self.header_color)
+
+                # Add the title to the index now that we have added it no notion 
+                titles.add(title, header_id)
+
+            # Now we have the block corresponding to the title of the book, and (if the quotes are not nested in it) the end of its section
+            header_id = titles.header(title)
+            parent_id = header_id if self.nested else page_id
+            last_id = None if self.nested else titles.section_end(title)
+
+        # Now that we have the parent block, we can iterate through the quotes and add them in order
+        for quote in quotes:
+            last_id = batch.add_block(parent_id, self.quote_type, title=quote['quote'], color=self.quote_color, after=last_id,
+                                      properties={HASH_PROPERTY: [[highlight_hash(quote)]]})
+            last_id = batch.add_block(parent_id, self.location_type, title=quote['book location'].lstrip('- '), color=self.location_color, after=last_id)
+            last_id = batch.add_block(parent_id, self.divider_type, after=last_id)
+            batch.end_group(quote)
+
+        if not self.nested and quotes:
+            with self.titles_lock:
+                titles.extend(title, last_id)
+
+        if own_batch:
+            batch.flush()
 
 
 
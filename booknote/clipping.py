@@ -0,0 +1,238 @@
+from datetime import datetime
+import hashlib
+import re
+import sys
+
+
+HIGHLIGHT = 'highlight'
+NOTE = 'note'
+BOOKMARK = 'bookmark'
+CLIP = 'clip'
+KINDS = {kind: kind for kind in (HIGHLIGHT, NOTE, BOOKMARK, CLIP)}
+
+# The pieces of the metadata line, e.g. `- Your Highlight on page 12 | Location 180-182 | Added on Monday, January 5, 2015 10:11:12 AM`.
+# Older kindles write `- Highlight Loc. 1102-05 | Added on ...`, abbreviating the end of the location
+KIND_PATTERN = re.compile(r'\b(highlight|note|bookmark|clip)\b', re.IGNORECASE)
+PAGE_PATTERN = re.compile(r'\bpage (\d+)', re.IGNORECASE)
+LOCATION_PATTERN = re.compile(r'\b(?:location|loc\.)\s*(\d+)(?:-(\d+))?', re.IGNORECASE)
+ADDED_PATTERN = re.compile(r'Added on \w+, (?:([a-z]+) (\d{1,2})|(\d{1,2}) ([a-z]+)),? (\d{4}),? (\d{1,2}):(\d{2})(?::(\d{2}))?\s*([AP]M)?', re.IGNORECASE)
+
+# The line as written by the current kindles in english, matched at once before falling back to finding each piece on its own
+METADATA_PATTERN = re.compile(r'- Your (Highlight|Note|Bookmark|Clip) (?:on page (\d+) \| |on |at )?[Ll]ocation (\d+)(?:-(\d+))? \| '
+                              r'Added on \w+, ([A-Z][a-z]+) (\d{1,2}), (\d{4}) (\d{1,2}):(\d{2}):(\d{2}) ([AP]M)$')
+
+MONTHS = {name: number for number, name in enumerate(['january', 'february', 'march', 'april', 'may', 'june', 'july',
+                                                      'august', 'september', 'october', 'november', 'december'], 1)}
+
+# The names the metadata line is rebuilt with, regardless of the locale
+MONTH_NAMES = [None] + [name.title() for name in MONTHS]
+WEEKDAYS = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+KIND_NAMES = {kind: kind.title() for kind in KINDS}
+
+
+class Clipping:
+    """ A single entry of the `My Clippings.txt` file, with its metadata already parsed into typed fields.
+    The book titles are interned, so all the clippings of a book share the same string.
+
+    It can still be read as the json formatted highlight (`clipping['book title']`, `clipping['book location']` and `clipping['quote']`),
+    and its `digest` is the same content hash the `kindle.log` used before the clippings were parsed into fields.
+
+    Args:
+        title (str): The book's title (and author)
+        kind (str): `highlight`, `note`, `bookmark` or `clip`, `None` if the metadata line could not be parsed
+        page (int): The page in the book, `None` if the book has no page numbers
+        location_start (int): The first location of the clipping
+        location_end (int): The last location of the clipping (the same as the start for notes and bookmarks)
+        added_on (datetime): When the clipping was made
+        text (str): The clipping's content, including all its paragraphs
+        digest (bytes): The sha1 digest identifying the clipping
+        raw (str, optional): The original metadata line, only kept if the one rebuilt from the fields is written differently. Defaults to None.
+    """
+
+    __slots__ = ('title', 'kind', 'page', 'location_start', 'location_end', 'added_on', 'text', 'sha1', 'raw')
+
+    def __init__(self, title:str, kind:str, page:int, location_start:int, location_end:int, added_on:datetime, text:str, digest:bytes, raw:str = None):
+        self.title = sys.intern(title)
+        self.kind = kind
+        self.page = page
+        self.location_start = location_start
+        self.location_end = location_end
+        self.added_on = added_on
+        self.text = text
+        self.sha1 = digest
+        self.raw = raw
+
+    @property
+    def digest(self) -> str:
+        """ The hex digest of the clipping, as stored in the `kindle.log`
+
+        Returns:
+            str
+        """
+        return self.sha1.hex()
+
+    @property
+    def location(self) -> str:
+        """ A readable description of where (and when) the clipping was made: the kindle's metadata line (without the leading `- `),
+        rebuilt from the parsed fields the way the kindles write it in english unless the original line was kept
+
+        Returns:
+            str
+        """
+        if self.raw is not None:
+            return self.raw.lstrip('- ')
+
+        line = 'Your ' + KIND_NAMES[self.kind]
+        if self.page is not None:
+            line += ' on page %d' % self.page
+        if self.location_start is not None:
+            # The highlights and clips always have a range, even a single location one (e.g. `Location 180-180`)
+            ranged = self.location_end != self.location_start or self.kind in (HIGHLIGHT, CLIP)
+            locations = '%d-%d' % (self.location_start, self.location_end) if ranged else str(self.location_start)
+            # The books without page numbers only have the location, e.g. `Your Note on Location 180`
+            line += (' on Location ' if self.page is None else ' | Location ') + locations
+        if self.added_on is not None:
+            # The kindles pad neither the day nor the hour
+            added_on = self.added_on
+            line += ' | Added on %s, %s %d, %d %d:%02d:%02d %s' % (WEEKDAYS[added_on.weekday()], MONTH_NAMES[added_on.month], added_on.day, added_on.year,
+                                                                 added_on.hour % 12 or 12, added_on.minute, added_on.second, 'PM' if added_on.hour >= 12 else 'AM')
+
+        return line
+
+    def __getstate__(self) -> tuple:
+        return tuple(getattr(self, slot) for slot in self.__slots__)
+
+    def __setstate__(self, state:tuple) -> None:
+        # Clippings parsed in another process are unpickled with their own copy of the title, so it is interned again
+        for slot, value in zip(self.__slots__, state):
+            setattr(self, slot, value)
+        self.title = sys.intern(self.title)
+
+    def __getitem__(self, key:str):
+        if key == 'book title':
+            return self.title
+        if key == 'book location':
+            return self.location
+        if key == 'quote':
+            return self.text
+        raise KeyError(key)
+
+    def as_dict(self) -> dict:
+        """ The clipping as a json formatted highlight
+
+        Returns:
+            dict
+        """
+        return {'book title': self.title, 'book location': self.location, 'quote': self.text}
+
+    def __repr__(self) -> str:
+        return 'Clipping({!r}, {}, location {}-{})'.format(self.title, self.kind, self.location_start, self.location_end)
+
+def parse_metadata(line:str) -> tuple:
+    """ Parse the metadata line of a clipping
+
+    Args:
+        line (str): e.g. `- Your Highlight on page 12 | Location 180-182 | Added on Monday, January 5, 2015 10:11:12 AM`
+
+    Returns:
+        tuple: The kind, page, location start, location end and date the clipping was added on (each one `None` if not found)
+    """
+    metadata = METADATA_PATTERN.match(line)
+    if metadata:
+        kind, page, start, end, month, day, year, hour, minute, second, period = metadata.groups()
+        return KINDS[kind.lower()], int(page) if page else None, int(start), int(end or start), build_date(year, month, day, hour, minute, second, period)
+
+    # The kind is always described before the first `|`
+    kind = KIND_PATTERN.search(line.split('|', 1)[0])
+    kind = KINDS[kind.group(1).lower()] if kind else None
+
+    page = PAGE_PATTERN.search(line)
+    page = int(page.group(1)) if page else None
+
+    location_start = location_end = None
+    location = LOCATION_PATTERN.search(line)
+    if location:
+        location_start = int(location.group(1))
+        location_end = location_start
+        if location.group(2):
+            # An abbreviated end only holds the last digits of the location, e.g. `1102-05`
+            end = location.group(2)
+            location_end = int(location.group(1)[:-len(end)] + end) if len(end) < len(location.group(1)) else int(end)
+
+    return kind, page, location_start, location_end, parse_date(line)
+
+def parse_date(line:str) -> datetime:
+    """ Parse the date a clipping was added on, from its metadata line
+
+    Args:
+        line (str)
+
+    Returns:
+        datetime: `None` if it is not in english
+    """
+    added = ADDED_PATTERN.search(line)
+    if not added:
+        return None
+
+    # Both the US (`January 5, 2015`) and the UK (`5 January 2015`) orders are used
+    month, day, uk_day, uk_month, year, hour, minute, second, period = added.groups()
+    if not month:
+        month, day = uk_month, uk_day
+
+    return build_date(year, month, day, hour, minute, second, period)
+
+def build_date(year:str, month:str, day:str, hour:str, minute:str, second:str = None, period:str = None) -> datetime:
+    """ Build the date from the pieces matched in the metadata line
+
+    Args:
+        year (str)
+        month (str): The month's name, in english
+        day (str)
+        hour (str)
+        minute (str)
+        second (str, optional): Defaults to None.
+        period (str, optional): `AM` or `PM`, if the hour is in the 12-hour clock. Defaults to None.
+
+    Returns:
+        datetime: `None` if it is not a valid date
+    """
+    hour = int(hour)
+    if period:
+        hour = hour % 12 + (12 if period.upper() == 'PM' else 0)
+
+    try:
+        return datetime(int(year), MONTHS[month.lower()], int(day), hour, int(minute), int(second or 0))
+    except (KeyError, ValueError):
+        return None
+
+def parse_clipping(lines:list) -> Clipping:
+    """ Build a clipping from the lines of its entry
+
+    Args:
+        lines (list): The entry's lines (title, metadata line, an empty line and then its content), without the separator
+
+    Returns:
+        Clipping: `None` if the entry is malformed
+    """
+    if len(lines) < 4:
+        return None
+
+    title, metadata = lines[0], lines[1]
+
+    # The content can span several paragraphs, only the trailing empty lines are dropped
+    content = lines[3:]
+    while len(content) > 1 and not content[-1].strip():
+        content.pop()
+
+    # The digest is built from the first paragraph and the raw metadata line, so it matches the records already in the `kindle.log`
+    digest = hashlib.sha1('\x1f'.join((title, metadata, content[0])).encode('utf-8')).digest()
+
+    kind, page, location_start, location_end, added_on = parse_metadata(metadata)
+    clipping = Clipping(title, kind, page, location_start, location_end, added_on, '\n'.join(content), digest)
+
+    # The line itself is only kept if it cannot be rebuilt from the fields (e.g. a kindle in another language), so it is still shown
+    # exactly as the kindle wrote it
+    if kind is None or clipping.location != metadata.lstrip('- '):
+        clipping.raw = metadata
+
+    return clipping
@@ -0,0 +1,231 @@
+from booknote.clipping import parse_metadata
+from booknote.highlight_journal import highlight_hash
+from concurrent.futures import ThreadPoolExecutor
+import csv
+import hashlib
+import io
+import json
+import os
+
+
+FORMATS = ('md', 'json', 'csv')
+MANIFEST = '.booknote-export.json'
+
+# How each notion block type (as named in the `style.json`) is written in markdown
+MARKDOWN = {'HeaderBlock': '# {}',
+            'SubheaderBlock': '## {}',
+            'SubsubheaderBlock': '### {}',
+            'QuoteBlock': '> {}',
+            'BulletedListBlock': '- {}',
+            'TodoBlock': '- [ ] {}',
+            'CalloutBlock': '> **{}**',
+            'ToggleBlock': '**{}**',
+            'PageBlock': '# {}',
+            'TextBlock': '{}'}
+
+CSV_COLUMNS = ['book title', 'quote', 'location', 'kind', 'page', 'location start', 'location end', 'added on']
+
+# Changes whenever the fields exported for the same highlights do, so the files written before are written again
+FIELDS_VERSION = 2
+
+
+def highlight_fields(highlight) -> dict:
+    """ The fields of a highlight that are exported, whether it was parsed from the clippings or read from the `kindle.log`
+
+    Args:
+        highlight (Clipping or dict)
+
+    Returns:
+        dict
+    """
+    location = highlight['book location'].lstrip('- ')
+
+    # The records of the log only hold the metadata line, so its fields are parsed back from it
+    if hasattr(highlight, 'added_on'):
+        kind, page, location_start, location_end, added_on = highlight.kind, highlight.page, highlight.location_start, highlight.location_end, highlight.added_on
+    else:
+        kind, page, location_start, location_end, added_on = parse_metadata(location)
+
+    return {'book title': highlight['book title'],
+            'quote': highlight['quote'],
+            'location': location,
+            'kind': kind,
+            'page': page,
+            'location start': location_start,
+            'location end': location_end,
+            'added on': added_on.isoformat() if added_on is not None else None}
+
+def render_markdown(title:str, highlights:list, style:dict) -> str:
+    """ A book's highlights in markdown, each element written as the block type it has in the `style.json`
+
+    Args:
+        title (str): The book's title
+        highlights (list): The exported fields of its highlights
+        style (dict): The contents of the `style.json` file
+
+    Returns:
+        str
+    """
+    def element(name:str, text:str) -> str:
+        template = MARKDOWN.get(style[name]['block.type'], '{}')
+        return '\n'.join(template.format(line) if line else template.format('').rstrip() for line in text.split('\n'))
+
+    lines = [element('title', title), '']
+    for highlight in highlights:
+        lines += [element('quote', highlight['quote']), '', element('annotation', highlight['location']), '', '---', '']
+
+    return '\n'.join(lines)
+
+def render_json(title:str, highlights:list, style:dict) -> str:
+    """ A book's highlights in json
+
+    Args:
+        title (str): The book's title
+        highlights (list): The exported fields of its highlights
+        style (dict): The contents of the `style.json` file (not used)
+
+    Returns:
+        str
+    """
+    return json.dumps({'book title': title, 'highlights': [{key: value for key, value in highlight.items() if key != 'book title'} for highlight in highlights]},
+                      ensure_ascii=False, indent=4)
+
+def render_csv(title:str, highlights:list, style:dict) -> str:
+    """ A book's highlights in csv, one row for each
+
+    Args:
+        title (str): The book's title
+        highlights (list): The exported fields of its highlights
+        style (dict): The contents of the `style.json` file (not used)
+
+    Returns:
+        str
+    """
+    output = io.StringIO()
+    writer = csv.DictWriter(output, fieldnames=CSV_COLUMNS)
+    writer.writeheader()
+    writer.writerows(highlights)
+    return output.getvalue()
+
+RENDERERS = {'md': render_markdown, 'json': render_json, 'csv': render_csv}
+
+class Exporter:
+    """ Writes the highlights of each book to its own file in the output directory.
+
+    A manifest of the files written (and of what went into each of them) is kept in the directory, so the books that did not change
+    since the last export are skipped. The files are rendered and written by several threads.
+
+    Args:
+        out (str): The output directory
+        file_format (str): `md`, `json` or `csv`
+        style (dict): The contents of the `style.json` file
+        jobs (int, optional): How many files are written in parallel. Defaults to 4.
+    """
+
+    def __init__(self, out:str, file_format:str, style:dict, jobs:int = 4):
+        self.out = out
+        self.format = file_format
+        self.style = style
+        self.jobs = jobs
+        self.manifest = {}
+        self.written = 0
+        self.skipped = 0
+
+    def export(self, books:dict) -> tuple:
+        """ Export the books, skipping the ones whose file is up to date
+
+        Args:
+            books (dict): The highlights of each book, indexed by the book's title
+
+        Returns:
+            tuple: How many files were written and how many were skipped
+        """
+        os.makedirs(self.out, exist_ok=True)
+        previous = self.__load_manifest()
+
+        # Books whose file would have the same name are told apart by the hash of their title
+        names = {}
+        used = set()
+        for title in sorted(books):
+            name = self.__file_name(title)
+            if name in used:
+                name = '{}-{}'.format(name, hashlib.sha1(title.encode('utf-8')).hexdigest()[:8])
+            names[title] = name
+            used.add(name)
+
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            results = executor.map(lambda title: self.__export_book(title, books[title], names[title], previous), books)
+            for file_name, digest, written in results:
+                self.manifest[file_name] = digest
+                if written:
+                    self.written += 1
+                else:
+                    self.skipped += 1
+
+        self.__save_manifest(previous)
+        return self.written, self.skipped
+
+    def __export_book(self, title:str, highlights:list, name:str, previous:dict) -> tuple:
+        """ Write the file of a single book, unless it is up to date
+
+        Args:
+            title (str): The book's title
+            highlights (list): The book's highlights
+            name (str): The name of its file, without the extension
+            previous (dict): The manifest of the last export
+
+        Returns:
+            tuple: The file's name, the digest of its contents and rather or not it was written
+        """
+        file_name = '{}.{}'.format(name, self.format)
+
+        # The digest covers everything that goes into the file, so if it did not change neither did the file
+        digest = hashlib.sha1('\n'.join([self.format, str(FIELDS_VERSION), json.dumps(self.style, sort_keys=True), title] + [highlight_hash(highlight) for highlight in highlights]).encode('utf-8')).hexdigest()
+        if previous.get(file_name) == digest and os.path.exists(os.path.join(self.out, file_name)):
+            return file_name, digest, False
+
+        text = RENDERERS[self.format](title, [highlight_fields(highlight) for highlight in highlights], self.style)
+        with open(os.path.join(self.out, file_name), 'w', encoding='utf-8', newline='') as f:
+            f.write(text)
+
+        return file_name, digest, True
+
+    def __file_name(self, title:str) -> str:
+        """ A file name for the book, safe for any file system
+
+        Args:
+            title (str)
+
+        Returns:
+            str
+        """
+        from slugify import slugify
+        return slugify(title, max_length=100) or hashlib.sha1(title.encode('utf-8')).hexdigest()[:8]
+
+    def __load_manifest(self) -> dict:
+        """ Load the manifest of the last export to the directory, an empty dict if there is none
+
+        Returns:
+            dict: The digest of each file
+        """
+        try:
+            with open(os.path.join(self.out, MANIFEST), 'r', encoding='utf-8') as f:
+                return json.loads(f.read())
+        except (OSError, ValueError):
+            return {}
+
+    def __save_manifest(self, previous:dict) -> None:
+        """ Save the manifest of the export, keeping the entries of the files it did not touch (e.g. exported in another format)
+
+        Args:
+            previous (dict): The manifest of the last export
+
+        Returns:
+            None
+        """
+        manifest = dict(previous)
+        manifest.update(self.manifest)
+
+        with open(os.path.join(self.out, MANIFEST + '.tmp'), 'w', encoding='utf-8') as f:
+            f.write(json.dumps(manifest, ensure_ascii=False, indent=4))
+        os.replace(os.path.join(self.out, MANIFEST + '.tmp'), os.path.join(self.out, MANIFEST))
@@ -0,0 +1,132 @@
+from booknote.json_lines import append_records, read_records, replace_records
+import hashlib
+import json
+import os
+
+
+def highlight_hash(highlight) -> str:
+    """ Content hash identifying a highlight, built from its book title, location and quote.
+    Parsed clippings and journal records already carry it, so it is only computed for the plain json formatted highlights
+
+    Args:
+        highlight (Clipping or dict): The highlight
+
+    Returns:
+        str: The hex digest of the highlight
+    """
+    digest = getattr(highlight, 'digest', None)
+    if digest is not None:
+        return digest
+    if 'hash' in highlight:
+        return highlight['hash']
+
+    content = '\x1f'.join((highlight['book title'], highlight['book location'], highlight['quote']))
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+class HighlightJournal:
+    """ Append-only journal of the already uploaded highlights (the `kindle.log` file).
+    Each line is a json record holding the highlight and its content hash, and the hashes are kept in a set at load time
+    so checking if a highlight was already uploaded is a single lookup.
+    """
+
+    def __init__(self, path:str):
+        self.path = path
+        self.index = set()
+        self.__load()
+
+    def __contains__(self, highlight:dict) -> bool:
+        return highlight_hash(highlight) in self.index
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def __load(self) -> None:
+        """ Load the hash index from the journal, creating the file if it does not exist yet and migrating it if it is still in the old json format
+
+        Returns:
+            None
+        """
+        if not os.path.exists(self.path):
+            open(self.path, 'a').close()
+            return
+
+        # The old log was a single indented json list, which always starts with `[`
+        with open(self.path, 'r', encoding='utf-8') as f:
+            start = f.read(64).lstrip()
+        if start.startswith('['):
+            self.__migrate()
+            return
+
+        for record in self.records():
+            self.index.add(record['hash'])
+
+    def __migrate(self) -> None:
+        """ One time migration from the old json list to the journal format. The old file is kept alongside it with the `.bak` extension
+
+        Returns:
+            None
+        """
+        with open(self.path, 'r', encoding='utf-8') as f:
+            highlights = json.loads(f.read())
+
+        os.replace(self.path, self.path + '.bak')
+        open(self.path, 'a').close()
+        self.append(highlights)
+
+    def records(self):
+        """ Iterate through the records of the journal, skipping any line that was not completely written (e.g. the program was interrupted)
+
+        Yields:
+            dict: The record, with the highlight fields and its `hash`
+        """
+        for record, _ in read_records(self.path):
+            yield record
+
+    def append(self, highlights:list) -> int:
+        """ Append the highlights not yet in the journal to the end of the file
+
+        Args:
+            highlights (list): The json formatted highlights
+
+        Returns:
+            int: How many records were written
+        """
+        records = []
+        for highlight in highlights:
+            digest = highlight_hash(highlight)
+            if digest in self.index:
+                continue
+
+            self.index.add(digest)
+            records.append({'hash': digest, 'book title': highlight['book title'], 'book location': highlight['book location'], 'quote': highlight['quote']})
+
+        append_records(self.path, records)
+        return len(records)
+
+    def compact(self) -> tuple:
+        """ Rewrite the journal without duplicated or corrupted records. The new file replaces the old one atomically
+
+        Returns:
+            tuple: The number of records kept and dropped
+        """
+        seen = set()
+
+        def unique():
+            for record in self.records():
+                try:
+                    digest = highlight_hash(record)
+                except (KeyError, TypeError):
+                    continue
+
+                if digest not in seen:
+                    seen.add(digest)
+                    record['hash'] = digest
+                    yield record
+
+        # Every line that is not kept (duplicated, corrupted or not completely written) is dropped
+        with open(self.path, 'rb') as f:
+            lines = sum(1 for _ in f)
+        replace_records(self.path, unique())
+
+        self.index = seen
+        return len(seen), lines - len(seen)
@@ -0,0 +1,75 @@
+import json
+import os
+
+
+def read_records(path:str, offset:int = 0):
+    """ Iterate through the records of a json lines file (one json record per line), starting at `offset`. The lines that are not valid
+    json are skipped, and so is the last line if it was not completely written (e.g. the program was interrupted, or the append is still
+    going on). A missing file has no records
+
+    Args:
+        path (str)
+        offset (int, optional): Where to start reading from, the end of one of its lines. Defaults to 0.
+
+    Yields:
+        tuple: Each record, and the offset right after its line
+    """
+    try:
+        f = open(path, 'rb')
+    except FileNotFoundError:
+        return
+
+    with f:
+        f.seek(offset)
+        for line in f:
+            if not line.endswith(b'\n'):
+                break
+            offset += len(line)
+
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            yield record, offset
+
+def append_records(path:str, records:list) -> None:
+    """ Append records to the end of a json lines file, making sure they are on disk before returning. If the last append was
+    interrupted mid line they start on a new one, so only the torn record is lost
+
+    Args:
+        path (str)
+        records (list): The json serializable records
+
+    Returns:
+        None
+    """
+    lines = [json.dumps(record, ensure_ascii=False) + '\n' for record in records]
+    if not lines:
+        return
+
+    with open(path, 'a+b') as f:
+        if f.tell() > 0:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b'\n':
+                lines.insert(0, '\n')
+
+        f.write(''.join(lines).encode('utf-8'))
+        f.flush()
+        os.fsync(f.fileno())
+
+def replace_records(path:str, records) -> None:
+    """ Replace a json lines file with the records, atomically (it is written aside and then moved over the old one)
+
+    Args:
+        path (str)
+        records (iterable): The json serializable records
+
+    Returns:
+        None
+    """
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + '.tmp', path)
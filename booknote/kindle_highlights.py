@@ -1,47 +1,198 @@
+from booknote.clipping import parse_clipping
+import glob
+import hashlib
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+
+SEPARATOR = b'=========='
+
+def clippings_file(source:str) -> str:
+    """The path to the clippings file of a source, which can be either the mount point of a kindle or the clippings file itself (e.g. an exported copy)
+
+    Args:
+        source (str)
+
+    Returns:
+        str
+    """
+    if os.path.isfile(source):
+        return source
+    return source + '/documents/My Clippings.txt'
+
+def find_clippings_files(sources:list) -> tuple:
+    """Resolve the sources (mount points, files or glob patterns) to the clippings files they hold, each file only once
+
+    Args:
+        sources (list)
+
+    Returns:
+        tuple: The list of clippings files found, and the list of the sources without any
+    """
+    files = []
+    missing = []
+    seen = set()
+
+    for source in sources:
+        # Sources that are not glob patterns are taken as they are (glob would also drop them if they do not exist)
+        paths = sorted(glob.glob(source)) if glob.has_magic(source) else [source]
+        found = [clippings_file(path) for path in paths if os.path.isfile(clippings_file(path))]
+        if not found:
+            missing.append(source)
+
+        for file_name in found:
+            if os.path.realpath(file_name) not in seen:
+                seen.add(os.path.realpath(file_name))
+                files.append(file_name)
+
+    return files, missing
+
+def parse_clippings_file(file_name:str, checkpoint:dict = None) -> tuple:
+    """Parse a whole clippings file at once, meant to be run in a worker process
+
+    Args:
+        file_name (str): The path to the clippings file (or to the kindle it is in)
+        checkpoint (dict, optional): The checkpoint saved after the last sync. Defaults to None (i.e full scan).
+
+    Returns:
+        tuple: The list of highlights and the new checkpoint of the file
+    """
+    highlights = Highlights()
+    return highlights.get_kindle_highlights(file_name, checkpoint), highlights.checkpoint
+
 class Highlights:
-    
-    def get_kindle_highlights(self, kindle_path:str = '/Volumes/Kindle') -> list:
+
+    def __init__(self):
+        # The checkpoint reached by the last parse, only to be persisted by the caller once the highlights are safely stored
+        self.checkpoint = None
+
+    def get_kindle_highlights(self, kindle_path:str = '/Volumes/Kindle', checkpoint:dict = None) -> list:
         """Read and parse the Highlights from the user's kindle device
 
         Args:
-            kindle_path (str, optional): The path to the mounter kindle device. Defaults to '/Volumes/Kindle'.
+            kindle_path (str, optional): The path to the mounter kindle device (or to a clippings file). Defaults to '/Volumes/Kindle'.
+            checkpoint (dict, optional): The checkpoint saved after the last sync, if given only the entries appended after it are parsed. Defaults to None (i.e full scan).
 
         Returns:
-            list: The json formatted Highlights 
-        """        
+            list: The parsed Highlights (see `booknote.clipping.Clipping`)
+        """
+        return list(self.iter_kindle_highlights(kindle_path, checkpoint))
+
+    def iter_kindle_highlights(self, kindle_path:str = '/Volumes/Kindle', checkpoint:dict = None):
+        """Read and parse the Highlights from the user's kindle device one at a time, as the file is streamed.
+        The new checkpoint is only available once all highlights were read.
+
+        Args:
+            kindle_path (str, optional): The path to the mounter kindle device (or to a clippings file). Defaults to '/Volumes/Kindle'.
+            checkpoint (dict, optional): The checkpoint saved after the last sync, if given only the entries appended after it are parsed. Defaults to None (i.e full scan).
+
+        Yields:
+            Clipping: The parsed Highlight
+        """
         self.path = kindle_path
-        return self.__parse_file()
+        return self.__parse_file(checkpoint)
+
+    def __clippings_file(self) -> str:
+        """The path to the `My Clippings.txt` file inside the kindle
 
-    def __parse_file(self) -> list:
-        """Parse and format the MyClippings.txt file from the kindle
+        Returns:
+            str
+        """
+        return clippings_file(self.path)
+
+    def __valid_checkpoint(self, data_file, checkpoint:dict) -> bool:
+        """Checks if the file still matches the checkpoint, i.e it was only appended to since the last sync.
+        Only the trailing entry before the checkpoint's offset is read, so it takes constant time regardless of the file's size.
+
+        Args:
+            data_file (BinaryIO): The opened clippings file
+            checkpoint (dict): The saved checkpoint
+
+        Returns:
+            bool: `True` if it is safe to resume from the checkpoint, `False` if the file was truncated or rewritten
+        """
+        try:
+            offset = checkpoint['offset']
+            tail_size = checkpoint['tail size']
+            tail_hash = checkpoint['tail hash']
+        except (KeyError, TypeError):
+            return False
+
+        # If the file is now smaller than the offset, it was truncated (or replaced)
+        if offset < tail_size or os.fstat(data_file.fileno()).st_size < offset:
+            return False
+
+        data_file.seek(offset - tail_size)
+        return hashlib.sha1(data_file.read(tail_size)).hexdigest() == tail_hash
+
+    def __parse_file(self, checkpoint:dict = None):
+        """Stream and parse the MyClippings.txt file from the kindle, starting from the checkpoint when it is still valid
+
+        Args:
+            checkpoint (dict, optional): The checkpoint saved after the last sync. Defaults to None.
+
+        Yields:
+            Clipping: each entry of the file, parsed
+        """
+        with open(self.__clippings_file(), 'rb') as data_file:
+
+            # Resume from the checkpoint if the file was only appended to, otherwise fall back to a full rescan
+            offset = 0
+            tail = b''
+            if checkpoint and self.__valid_checkpoint(data_file, checkpoint):
+                offset = checkpoint['offset']
+                logger.debug('Resuming %s from byte %d', self.__clippings_file(), offset)
+            elif checkpoint:
+                logger.info('%s changed since the last sync, reading it from the start', self.__clippings_file())
+            data_file.seek(offset)
+
+            # Read the file line by line, only committing an entry (and advancing the offset) once its separator is found
+            entry = []
+            entry_size = 0
+            for line in data_file:
+                entry_size += len(line)
+
+                if line.rstrip() != SEPARATOR:
+                    entry.append(line)
+                    continue
+
+                quote_structure = self.__parse_entry(b''.join(entry))
+                tail = b''.join(entry) + line
+                offset += entry_size
+                entry = []
+                entry_size = 0
+
+                if quote_structure is not None:
+                    yield quote_structure
+
+        # Save where we stopped, so the next sync only needs to read what was appended after it
+        if tail:
+            self.checkpoint = {'offset': offset, 'tail size': len(tail), 'tail hash': hashlib.sha1(tail).hexdigest()}
+        else:
+            self.checkpoint = checkpoint if offset else None
+
+    def __parse_entry(self, raw_entry:bytes):
+        """Dissect the structure of a single saved entry
+
+        Args:
+            raw_entry (bytes): The entry's lines, without its separator
 
         Returns:
-            list: format the contents of the file in json
-        """            
-        # Read the file that contains the kindle's highlights 
-        with open(self.path+'/documents/My Clippings.txt', 'r') as data_file:
-            data = data_file.read()
-            data = data.split('==========')
-
-        # Now that we have a list of highlights, we can make a list of dictionaries to dissect the structure of the saved data 
-        quotes = []
-        for quote in data:
-            quote = quote.splitlines()
-            try:
-                quote_structure = {'book title':quote[1], 'book location':quote[2], 'quote':quote[4]}
-                quotes.append(quote_structure)
-                print(quote_structure)
-                print('#' * 10)
-            except:
-                continue
-
-        # Now we can return the list of quotes 
-        return quotes
-        
+            Clipping: The parsed entry, `None` if it is malformed
+        """
+        # The very first entry of the file starts with the utf-8 BOM
+        lines = raw_entry.decode('utf-8', errors='replace').lstrip('\ufeff').splitlines()
+
+        # Drop the empty line left over from the previous separator
+        while lines and not lines[0].strip():
+            lines.pop(0)
+
+        return parse_clipping(lines)
 
 
 
 if __name__ == '__main__':
     highlights = Highlights()
     quotes = highlights.get_kindle_highlights()
-
@@ -0,0 +1,129 @@
+from contextlib import contextmanager
+import threading
+import time
+
+
+class Metrics:
+    """ Wall time of each stage of an upload, and counters of what it did.
+
+    The stages can be nested (e.g. the parse runs inside the dedup, since they are chained generators), so each stage only
+    counts its own time, without the time of the stages inside it. The stages run by the workers of a parallel upload are summed
+    across all of them, so they can add up to more than the total.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.end = None
+        self.stages = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    @contextmanager
+    def stage(self, name:str):
+        """ Time the code run inside the `with` block as part of the stage `name`
+
+        Args:
+            name (str)
+        """
+        stack = self.__stack()
+
+        # Each level of the stack holds the time spent in the stages nested in it
+        stack.append(0)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.__record(name, start, stack)
+
+    def timed(self, iterable, name:str):
+        """ Time how long it takes to produce each item of `iterable` as part of the stage `name`.
+        It is called for every highlight, so it does the same as `stage` without the overhead of a context manager
+
+        Args:
+            iterable (iterable)
+            name (str)
+
+        Yields:
+            Each item of `iterable`
+        """
+        iterator = iter(iterable)
+        stack = self.__stack()
+
+        while True:
+            stack.append(0)
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.__record(name, start, stack)
+                return
+
+            self.__record(name, start, stack)
+            yield item
+
+    def __stack(self) -> list:
+        """ The stack of stages running in the current thread
+
+        Returns:
+            list
+        """
+        try:
+            return self.local.stack
+        except AttributeError:
+            self.local.stack = []
+            return self.local.stack
+
+    def __record(self, name:str, start:float, stack:list) -> None:
+        """ Add the time since `start` to the stage `name`, without the time of the stages nested in it
+
+        Args:
+            name (str)
+            start (float): When the stage started, from `time.perf_counter`
+            stack (list): The stack of stages of the current thread, with this stage on top
+
+        Returns:
+            None
+        """
+        elapsed = time.perf_counter() - start
+        nested = stack.pop()
+        if stack:
+            stack[-1] += elapsed
+
+        with self.lock:
+            self.stages[name] = self.stages.get(name, 0) + elapsed - nested
+
+    def count(self, name:str, amount:int = 1) -> None:
+        """ Add `amount` to the counter `name`
+
+        Args:
+            name (str)
+            amount (int, optional): Defaults to 1.
+
+        Returns:
+            None
+        """
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def stop(self) -> None:
+        """ Mark the end of the upload
+
+        Returns:
+            None
+        """
+        self.end = time.perf_counter()
+
+    def report(self) -> dict:
+        """ The measurements, in a json friendly format
+
+        Returns:
+            dict: The `total seconds`, the seconds of each stage, the counters and the `highlights per second` uploaded
+        """
+        total = (self.end or time.perf_counter()) - self.start
+        highlights = self.counters.get('highlights', 0)
+
+        return {'total seconds': total,
+                'stages': dict(self.stages),
+                'counters': dict(self.counters),
+                'highlights per second': highlights / total if total else 0}
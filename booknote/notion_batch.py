@@ -0,0 +1,205 @@
+from booknote.backends import NotionRequestError
+from datetime import datetime
+import uuid
+
+
+def now() -> int:
+    """ The current time in milliseconds, as Notion stores it
+
+    Returns:
+        int
+    """
+    return int(datetime.now().timestamp() * 1000)
+
+def build_operation(id:str, path:list, args:dict, command:str = 'set', table:str = 'block') -> dict:
+    """ Build one of the operations sent in a transaction
+
+    Args:
+        id (str): The id of the record the operation changes
+        path (list): The path inside the record
+        args (dict): The arguments of the command
+        command (str, optional): `set`, `update`, `listAfter`, `listBefore` or `listRemove`. Defaults to 'set'.
+        table (str, optional): The table of the record. Defaults to 'block'.
+
+    Returns:
+        dict
+    """
+    return {'id': id, 'path': path, 'args': args, 'command': command, 'table': table}
+
+def operation_update_last_edited(user_id:str, block_id:str) -> dict:
+    """ Build the operation updating the last edited fields of a block, as the Notion web UI sends with every change
+
+    Args:
+        user_id (str)
+        block_id (str)
+
+    Returns:
+        dict
+    """
+    return build_operation(id=block_id, path=[], args={'last_edited_by_id': user_id, 'last_edited_by_table': 'notion_user', 'last_edited_time': now()}, command='update')
+
+class BlockBatch:
+    """ Buffers the creation of blocks directly under their final parent (as well as the changes and deletions of existing blocks), and sends
+    them to Notion in a few bulk transactions instead of creating (and moving) each block with its own requests. A batch is not thread safe,
+    each worker must have its own.
+
+    Blocks are grouped (e.g. the quote, annotation and divider of a highlight), and a transaction is only sent at the end of a group,
+    so a group is never split between transactions. Once a transaction is confirmed, the items of its groups are passed to `on_flush`,
+    and if it failed its operations and items are passed to `on_failure` (before the error is raised).
+
+    Args:
+        backend (NotionBackend): Where the transactions are sent
+        max_blocks (int, optional): How many blocks a transaction holds before it is sent. Defaults to 100.
+        on_flush (callable, optional): Called with the list of confirmed items after each transaction. Defaults to None.
+        on_failure (callable, optional): Called with the operations, the list of items and the error of a failed transaction. Defaults to None.
+    """
+
+    def __init__(self, backend, max_blocks:int = 100, on_flush = None, on_failure = None):
+        self.backend = backend
+        self.max_blocks = max_blocks
+        self.on_flush = on_flush
+        self.on_failure = on_failure
+        self.operations = []
+        self.parents = set()
+        self.pending = []
+        self.blocks = 0
+
+    def add_block(self, parent_id:str, block_type:str, title:str = None, color:str = None, after:str = None, properties:dict = None) -> str:
+        """ Queue the creation of a new block as the last child of `parent_id` (or right after its `after` child)
+
+        Args:
+            parent_id (str): The id of the parent block
+            block_type (str): The notion type of the block (e.g `quote`, `divider`)
+            title (str, optional): The text of the block. Defaults to None.
+            color (str, optional): The color of the block. Defaults to None.
+            after (str, optional): The id of the sibling the block will be placed after. Defaults to None (i.e last child).
+            properties (dict, optional): Other properties of the block, besides its title. Defaults to None.
+
+        Returns:
+            str: The id of the new block, that can already be used as parent or sibling of the next ones
+        """
+        block_id = str(uuid.uuid4())
+
+        args = {'id': block_id,
+                'version': 1,
+                'alive': True,
+                'type': block_type,
+                'created_by_id': self.backend.user_id,
+                'created_by_table': 'notion_user',
+                'created_time': now(),
+                'parent_id': parent_id,
+                'parent_table': 'block'}
+        properties = dict(properties or {})
+        if title is not None:
+            properties['title'] = [[title]]
+        if properties:
+            args['properties'] = properties
+        if color is not None:
+            args['format'] = {'block_color': color}
+
+        list_args = {'id': block_id}
+        if after is not None:
+            list_args['after'] = after
+
+        self.operations.append(build_operation(id=block_id, path=[], args=args, command='set'))
+        self.operations.append(build_operation(id=parent_id, path=['content'], args=list_args, command='listAfter'))
+        self.parents.add(parent_id)
+        self.blocks += 1
+
+        return block_id
+
+    def update_block(self, block_id:str, properties:dict) -> None:
+        """ Queue the change of some of the properties of an existing block (e.g. its `title`)
+
+        Args:
+            block_id (str)
+            properties (dict): The new value of each property, as Notion stores it (e.g. `[['text']]`)
+
+        Returns:
+            None
+        """
+        for name, value in properties.items():
+            self.operations.append(build_operation(id=block_id, path=['properties', name], args=value, command='set'))
+        self.parents.add(block_id)
+        self.blocks += 1
+
+    def remove_block(self, block_id:str, parent_id:str) -> None:
+        """ Queue the deletion of a block, as the Notion web UI does it: the block is marked as no longer alive and taken out of its parent
+
+        Args:
+            block_id (str)
+            parent_id (str): The id of its parent block
+
+        Returns:
+            None
+        """
+        self.operations.append(build_operation(id=block_id, path=[], args={'alive': False}, command='update'))
+        self.operations.append(build_operation(id=parent_id, path=['content'], args={'id': block_id}, command='listRemove'))
+        self.parents.add(parent_id)
+        self.blocks += 1
+
+    def move_block(self, block_id:str, parent_id:str, new_parent_id:str, after:str = None) -> None:
+        """ Queue the move of a block (along with its children) to another parent, as the Notion web UI does it
+
+        Args:
+            block_id (str)
+            parent_id (str): The id of its current parent block
+            new_parent_id (str): The id of the block it is moved to
+            after (str, optional): The id of the sibling the block will be placed after. Defaults to None (i.e last child).
+
+        Returns:
+            None
+        """
+        list_args = {'id': block_id}
+        if after is not None:
+            list_args['after'] = after
+
+        self.operations.append(build_operation(id=block_id, path=[], args={'parent_id': new_parent_id, 'parent_table': 'block'}, command='update'))
+        self.operations.append(build_operation(id=parent_id, path=['content'], args={'id': block_id}, command='listRemove'))
+        self.operations.append(build_operation(id=new_parent_id, path=['content'], args=list_args, command='listAfter'))
+        self.parents.update((parent_id, new_parent_id))
+        self.blocks += 1
+
+    def end_group(self, item = None) -> None:
+        """ Mark the end of a group of blocks, sending the transaction if it is big enough
+
+        Args:
+            item (optional): What the group represents (e.g. a highlight), to be passed to `on_flush` once it is confirmed. Defaults to None.
+
+        Returns:
+            None
+        """
+        if item is not None:
+            self.pending.append(item)
+
+        if self.blocks >= self.max_blocks:
+            self.flush()
+
+    def flush(self) -> None:
+        """ Send all the queued operations as a single transaction
+
+        Raises:
+            NotionRequestError: If the transaction failed
+
+        Returns:
+            None
+        """
+        if not self.operations:
+            return
+
+        # Only update the last edited time of the parents (and of the blocks changed), not of every new block
+        operations = self.operations + [operation_update_last_edited(self.backend.user_id, parent_id) for parent_id in self.parents]
+        try:
+            self.backend.submit_transaction(operations)
+        except NotionRequestError as error:
+            if self.on_failure is not None:
+                self.on_failure(operations, self.pending, error)
+            raise
+
+        if self.on_flush is not None and self.pending:
+            self.on_flush(self.pending)
+
+        self.operations = []
+        self.parents = set()
+        self.pending = []
+        self.blocks = 0
@@ -0,0 +1,119 @@
+from booknote.json_lines import append_records, read_records, replace_records
+from booknote.title_index import block_title
+import os
+
+
+class PageSnapshot:
+    """ Local copy of the structure of the target page: the type, title and parent of each of its children, along with the page's
+    last edited time. It is kept as a journal (one json record per line) in its own file for each page, so the blocks created by an
+    upload are simply appended to it.
+
+    When the page changed since the last upload, only the blocks the snapshot cannot vouch for are requested: the ones it does not know,
+    and (if the page was edited by someone else) the title blocks, in case they were renamed.
+
+    Args:
+        directory (str): The directory of the snapshots
+        page_id (str): The id of the target page
+    """
+
+    def __init__(self, directory:str, page_id:str):
+        self.path = os.path.join(directory, page_id + '.snapshot')
+        self.page_id = page_id
+        self.blocks = {}
+        self.last_edited = None
+
+    def load(self) -> None:
+        """ Load the snapshot, skipping any record that was not completely written
+
+        Returns:
+            None
+        """
+        self.blocks = {}
+        self.last_edited = None
+
+        for record, _ in read_records(self.path):
+            if 'last edited' in record:
+                self.last_edited = record['last edited']
+            elif 'id' in record:
+                self.blocks[record['id']] = record
+
+    def records(self, page:dict, backend, header_type:str, save:bool = True) -> list:
+        """ The records of the page's children, only requesting the ones that might have changed since the snapshot was taken
+
+        Args:
+            page (dict): The page's record, as just loaded from Notion
+            backend (NotionBackend): The backend to request the records through
+            header_type (str): The type of the title blocks
+            save (bool, optional): Rather or not to rewrite the snapshot with the page's current children. Defaults to True.
+
+        Raises:
+            NotionRequestError
+
+        Returns:
+            list: The records of the page's children, in order (with only their id, type, title and parent)
+        """
+        self.load()
+        content = page.get('content') or []
+
+        # If nobody else edited the page, the blocks already in the snapshot are the same
+        edited = page.get('last_edited_time') != self.last_edited
+        stale = [block_id for block_id in content if block_id not in self.blocks or (edited and self.blocks[block_id]['type'] == header_type)]
+
+        for record in backend.load_records(stale):
+            if record:
+                self.blocks[record['id']] = self.__block(record)
+
+        # Only the current children are kept, the blocks removed from the page are dropped
+        self.blocks = {block_id: self.blocks[block_id] for block_id in content if block_id in self.blocks}
+        self.last_edited = page.get('last_edited_time')
+        if save:
+            self.__rewrite()
+
+        return [self.__record(self.blocks[block_id]) for block_id in content if block_id in self.blocks]
+
+    def append(self, records:list, last_edited:int) -> None:
+        """ Add the blocks created on the page to the end of the snapshot
+
+        Args:
+            records (list): The records of the new blocks
+            last_edited (int): The page's last edited time after they were created
+
+        Returns:
+            None
+        """
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        append_records(self.path, [self.__block(record) for record in records if record] + [{'last edited': last_edited}])
+
+    def __rewrite(self) -> None:
+        """ Replace the snapshot's file with the blocks currently in it, atomically
+
+        Returns:
+            None
+        """
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        replace_records(self.path, list(self.blocks.values()) + [{'last edited': self.last_edited}])
+
+    def __block(self, record:dict) -> dict:
+        """ What the snapshot keeps of a block
+
+        Args:
+            record (dict): The block's record
+
+        Returns:
+            dict
+        """
+        return {'id': record['id'], 'type': record.get('type'), 'title': block_title(record), 'parent': record.get('parent_id', self.page_id)}
+
+    def __record(self, block:dict) -> dict:
+        """ A record built back from the snapshot of a block
+
+        Args:
+            block (dict)
+
+        Returns:
+            dict
+        """
+        record = {'id': block['id'], 'type': block['type'], 'parent_id': block['parent']}
+        if block['title'] is not None:
+            record['properties'] = {'title': [[block['title']]]}
+        return record
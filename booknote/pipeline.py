@@ -0,0 +1,212 @@
+from booknote.clipping import HIGHLIGHT, parse_metadata
+from booknote.highlight_journal import highlight_hash
+from bisect import bisect_right
+from datetime import datetime
+from itertools import accumulate, groupby
+
+
+def deduplicate(highlights, known:set = frozenset()):
+    """ Drop the highlights that are already known (e.g. in the `kindle.log`) or that were already seen in the stream itself
+
+    Args:
+        highlights (iterable): The json formatted highlights
+        known (set, optional): The hashes of the highlights to be dropped. Defaults to an empty set.
+
+    Yields:
+        dict: Each highlight not seen before
+    """
+    seen = set()
+    for highlight in highlights:
+        digest = highlight_hash(highlight)
+        if digest not in known and digest not in seen:
+            seen.add(digest)
+            yield highlight
+
+def highlight_interval(highlight) -> tuple:
+    """ The location range of a highlight and the date it was added on, whether it was parsed from the clippings or read from the `kindle.log`
+
+    Args:
+        highlight (Clipping or dict)
+
+    Returns:
+        tuple: The start, end and date (`datetime.min` if unknown) of the highlight, `None` if it is not a highlight or has no location
+    """
+    if hasattr(highlight, 'kind'):
+        kind, start, end, added_on = highlight.kind, highlight.location_start, highlight.location_end, highlight.added_on
+    else:
+        # The records of the log only hold the metadata line, so its fields are parsed back from it
+        kind, _, start, end, added_on = parse_metadata(highlight['book location'])
+
+    if kind != HIGHLIGHT or start is None:
+        return None
+    return start, end, added_on or datetime.min
+
+def superseded(highlights:list) -> set:
+    """ Find the highlights that were extended or edited afterwards. The kindle does not change the old clipping in that case, it adds a
+    new one whose location range overlaps it, so a highlight is superseded when a more recent highlight of the same book covers its
+    whole range. Highlights that only partly overlap are both kept, since neither holds all of the text of the other.
+
+    Only the highlights with a location are compared (never the notes or bookmarks), the records of the `kindle.log` included.
+    The most recent is the one added last, or the one further in the list if they were added at the same time (or the date is unknown).
+
+    Args:
+        highlights (list): The parsed clippings or records of the `kindle.log`
+
+    Returns:
+        set: The positions in `highlights` of the superseded ones
+    """
+    books = {}
+    for position, highlight in enumerate(highlights):
+        interval = highlight_interval(highlight)
+        if interval is not None:
+            books.setdefault(highlight['book title'], []).append(interval + (position,))
+
+    dropped = set()
+    for intervals in books.values():
+        if len(intervals) > 1:
+            dropped.update(covered_intervals(intervals))
+
+    return dropped
+
+def overlapping(highlights:list, records) -> list:
+    """ Keep the records that overlap the location range of a highlight of the same book, the only ones that can supersede
+    (or be superseded by) any of them. The other records are never held in memory
+
+    Args:
+        highlights (list): The parsed clippings or records of the `kindle.log`
+        records (iterable): The records to be filtered, e.g. read from the `kindle.log`
+
+    Returns:
+        list: The overlapping records, in the same order
+    """
+    # The ranges of each book sorted by their start, along with the furthest end of the ones before each of them
+    books = {}
+    for highlight in highlights:
+        interval = highlight_interval(highlight)
+        if interval is not None:
+            books.setdefault(highlight['book title'], []).append(interval[:2])
+
+    ranges = {}
+    for title, intervals in books.items():
+        intervals.sort()
+        ends = list(accumulate((end for _, end in intervals), max))
+        ranges[title] = ([start for start, _ in intervals], ends)
+
+    kept = []
+    for record in records:
+        if record['book title'] not in ranges:
+            continue
+
+        interval = highlight_interval(record)
+        if interval is None:
+            continue
+
+        # Some range starting before the record ends also ends after it starts
+        starts, ends = ranges[record['book title']]
+        position = bisect_right(starts, interval[1])
+        if position and ends[position - 1] >= interval[0]:
+            kept.append(record)
+
+    return kept
+
+def covered_intervals(intervals:list) -> list:
+    """ Find the intervals covered by a more recent one, in a single sweep through them sorted by their start.
+    The intervals already swept all start before the current one, so it is covered if any of them ends after it and is more recent,
+    which is a prefix maximum over their ends (kept in a Fenwick tree, with the ends in descending order).
+
+    Args:
+        intervals (list): The start, end, date and position of each interval. The date and then the position tell which one is more recent
+
+    Returns:
+        list: The positions of the covered intervals
+    """
+    # The recency of each interval as a rank, so it can be compared by the tree
+    recency = {interval[3]: rank for rank, interval in enumerate(sorted(intervals, key=lambda interval: (interval[2], interval[3])))}
+    slots = {end: slot for slot, end in enumerate(sorted({interval[1] for interval in intervals}, reverse=True), 1)}
+    tree = [-1] * (len(slots) + 1)
+
+    covered = []
+    for _, group in groupby(sorted(intervals), key=lambda interval: interval[0]):
+        group = [(slots[end], recency[position], position) for _, end, _, position in group]
+
+        # The intervals with the same start cover each other as well, so they are all added before any of them is checked
+        for slot, rank, _ in group:
+            while slot < len(tree):
+                tree[slot] = max(tree[slot], rank)
+                slot += slot & -slot
+
+        for slot, rank, position in group:
+            latest = -1
+            while slot > 0:
+                latest = max(latest, tree[slot])
+                slot -= slot & -slot
+            if latest > rank:
+                covered.append(position)
+
+    return covered
+
+def group_by_book(highlights) -> dict:
+    """ Separate the highlights by their book, in a single pass
+
+    Args:
+        highlights (iterable): The json formatted highlights
+
+    Returns:
+        dict: The highlights of each book, indexed by the book's title (in the order the books first appear)
+    """
+    books = {}
+    for highlight in highlights:
+        books.setdefault(highlight['book title'], []).append(highlight)
+    return books
+
+def book_batches(highlights, batch_size:int = 100, max_buffered:int = 5000):
+    """ Group the stream of highlights into per-book batches ready to be uploaded, without holding the whole stream in memory.
+    A book's batch is released once it is full, and when too many highlights are buffered the biggest books' batches are released early,
+    until only half of `max_buffered` is left (so the books have room to fill their next batches). The batches of a book always come
+    in the same order as its highlights.
+
+    The books are kept in buckets by how many highlights they have buffered, so the biggest one is found without going through all of them.
+
+    Args:
+        highlights (iterable): The json formatted highlights
+        batch_size (int, optional): Maximum number of highlights in a batch. Defaults to 100.
+        max_buffered (int, optional): Maximum number of highlights waiting for their batch to be released. Defaults to 5000.
+
+    Yields:
+        tuple: The book's title and a list of its highlights
+    """
+    books = {}
+    buffered = 0
+
+    # The titles of the books with each number of buffered highlights (a dict keeps them in the order they got there), and the biggest number
+    sizes = [{} for _ in range(batch_size + 1)]
+    largest = 0
+
+    for highlight in highlights:
+        title = highlight['book title']
+        batch = books.setdefault(title, [])
+        if batch:
+            del sizes[len(batch)][title]
+        batch.append(highlight)
+        buffered += 1
+
+        if len(batch) >= batch_size:
+            buffered -= len(batch)
+            yield title, books.pop(title)
+            continue
+
+        sizes[len(batch)][title] = None
+        largest = max(largest, len(batch))
+
+        if buffered > max_buffered:
+            while buffered > max_buffered // 2:
+                while not sizes[largest]:
+                    largest -= 1
+                title = next(iter(sizes[largest]))
+                del sizes[largest][title]
+                buffered -= largest
+                yield title, books.pop(title)
+
+    # Release what is left, in the order the books started buffering
+    for title, batch in books.items():
+        yield title, batch
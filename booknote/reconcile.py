@@ -0,0 +1,182 @@
+from booknote.highlight_journal import highlight_hash
+from booknote.title_index import block_title
+
+
+# The property of the quote blocks holding the content hash of their highlight, so they can be matched to the local history
+HASH_PROPERTY = 'booknote_hash'
+
+
+def block_hash(record:dict) -> str:
+    """ The content hash stored in a quote block
+
+    Args:
+        record (dict): The block's record
+
+    Returns:
+        str: `None` if the block has none (e.g. it was uploaded before the hashes were stored)
+    """
+    try:
+        return record['properties'][HASH_PROPERTY][0][0]
+    except (KeyError, TypeError, IndexError):
+        return None
+
+def fetch_sections(backend, page:dict, header_type:str, nested:bool) -> dict:
+    """ Request the blocks of each book's section of the page: the blocks following its title block on the page itself, or the children
+    of its title block if the highlights are nested in it. A title that appears more than once on the page has all of its sections merged
+
+    Args:
+        backend (NotionBackend): The backend to request the records through
+        page (dict): The page's record
+        header_type (str): The type of the title blocks
+        nested (bool): Rather or not the highlights are nested in their title block
+
+    Raises:
+        NotionRequestError
+
+    Returns:
+        dict: The records of each section (in order) and the id of their parent, indexed by the book's title
+    """
+    sections = {}
+    current = None
+    headers = []
+
+    for record in backend.load_records(page.get('content') or []):
+        if not record:
+            continue
+
+        title = block_title(record)
+        if record.get('type') == header_type and title is not None:
+            current = sections.setdefault(title, [])
+            headers.append((title, record))
+        elif current is not None and not nested:
+            current.append((record, page['id']))
+
+    if nested:
+        # The children of all the title blocks are requested at once
+        children = backend.load_records([block_id for _, header in headers for block_id in header.get('content') or []])
+        position = 0
+        for title, header in headers:
+            count = len(header.get('content') or [])
+            sections[title] += [(record, header['id']) for record in children[position:position + count] if record]
+            position += count
+
+    return sections
+
+def highlight_groups(blocks:list, quote_type:str, location_type:str) -> list:
+    """ Find the highlights in the blocks of a section, as the upload creates them: a quote block right before a location block,
+    usually followed by a divider. The other blocks (e.g. the notes added on Notion) are not part of any group
+
+    Args:
+        blocks (list): The records of the section and the id of their parent, as returned by `fetch_sections`
+        quote_type (str): The type of the quote blocks
+        location_type (str): The type of the location blocks
+
+    Returns:
+        list: A dict for each highlight on the page, with the `parent` id and the records of its `quote`, `location` and `divider` (if any)
+    """
+    groups = []
+    group = None
+
+    for record, parent_id in blocks:
+        block_type = record.get('type')
+
+        # The location is checked first, since both blocks might have the same type
+        if group is not None and 'location' not in group and block_type == location_type:
+            group['location'] = record
+            groups.append(group)
+        elif group is not None and 'location' in group and 'divider' not in group and block_type == 'divider':
+            group['divider'] = record
+            group = None
+        elif block_type == quote_type:
+            group = {'parent': parent_id, 'quote': record}
+        else:
+            group = None
+
+    return groups
+
+def location_text(highlight) -> str:
+    """ The text of the location block of a highlight
+
+    Args:
+        highlight (Clipping or dict)
+
+    Returns:
+        str
+    """
+    return highlight['book location'].lstrip('- ')
+
+def diff_book(groups:list, highlights:list, superseded:list = (), prune:bool = False) -> tuple:
+    """ Compare the highlights of a book on the page with the local ones, finding the least changes that bring the page up to date.
+
+    The groups are matched to the local highlights by the hash stored in their quote block. The ones uploaded before the hashes were stored
+    are matched by their text instead, or only by their quote (in which case they are updated with the current location and the hash).
+    A group whose quote was edited on the page is restored, while duplicated groups and the ones of superseded highlights are deleted.
+    The groups that are not in the local history at all are kept, unless `prune` is set.
+
+    Args:
+        groups (list): The book's highlights on the page, as returned by `highlight_groups`
+        highlights (list): The book's local highlights, in order
+        superseded (list, optional): The book's local highlights that were extended or edited afterwards. Defaults to ().
+        prune (bool, optional): Also delete the groups not in the local history. Defaults to False.
+
+    Returns:
+        tuple: The groups to be updated (each along with its highlight), the groups to be deleted, the highlights to be created
+               and how many groups were not found in the local history
+    """
+    wanted = {}
+    by_text = {}
+    by_quote = {}
+    for highlight in highlights:
+        digest = highlight_hash(highlight)
+        wanted.setdefault(digest, highlight)
+        by_text.setdefault((highlight['quote'], location_text(highlight)), digest)
+        by_quote.setdefault(highlight['quote'], digest)
+
+    stale = {highlight_hash(highlight) for highlight in superseded}
+    stale_text = {(highlight['quote'], location_text(highlight)) for highlight in superseded}
+
+    matched = set()
+    updates = []
+    deletes = []
+    unknown = 0
+
+    # The groups with a hash are matched first, so the ones matched by their text can not take their highlight
+    hashed = [group for group in groups if block_hash(group['quote']) is not None]
+    legacy = [group for group in groups if block_hash(group['quote']) is None]
+
+    for group in hashed:
+        digest = block_hash(group['quote'])
+        if digest in wanted and digest not in matched:
+            matched.add(digest)
+            highlight = wanted[digest]
+            if block_title(group['quote']) != highlight['quote'] or block_title(group['location']) != location_text(highlight):
+                updates.append((group, highlight))
+        elif digest in wanted or digest in stale:
+            deletes.append(group)
+        else:
+            unknown += 1
+            if prune:
+                deletes.append(group)
+
+    for group in legacy:
+        text = (block_title(group['quote']), block_title(group['location']))
+        digest = by_text.get(text)
+        if digest is not None and digest not in matched:
+            matched.add(digest)
+            continue
+        if digest is not None or text in stale_text:
+            deletes.append(group)
+            continue
+
+        # The location is written differently than it used to be, the quote is enough to tell them apart (but not for the empty ones, e.g. bookmarks)
+        digest = by_quote.get(text[0]) if text[0] else None
+        if digest is not None and digest not in matched:
+            matched.add(digest)
+            updates.append((group, wanted[digest]))
+        else:
+            unknown += 1
+            if prune:
+                deletes.append(group)
+
+    missing = [highlight for digest, highlight in wanted.items() if digest not in matched]
+    return updates, deletes, missing, unknown
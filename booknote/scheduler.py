@@ -0,0 +1,200 @@
+from collections import deque
+import logging
+import random
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+# The statuses worth retrying: rate limited, conflicting transactions and the server errors (`None` is a request that got no response)
+TRANSIENT_STATUSES = (None, 408, 409, 429, 500, 502, 503, 504)
+
+def is_transient(error:Exception) -> bool:
+    """ Checks if a failed request might succeed if it is sent again
+
+    Args:
+        error (Exception)
+
+    Returns:
+        bool
+    """
+    from booknote.backends import NotionRequestError
+    return isinstance(error, NotionRequestError) and error.status_code in TRANSIENT_STATUSES
+
+class RequestScheduler:
+    """ Paces the requests to Notion and retries the ones that fail with a transient error, shared by all the workers of an upload.
+
+    The pace is set by a token bucket whose rate adapts to Notion: there is no limit until Notion rate limits a request (429) or the
+    requests get too slow, then the rate drops to a fraction of what was being sent and slowly climbs back up with each request that goes
+    through (so it settles right below the limit). A failed request is retried after an exponential backoff with full jitter,
+    or after the time Notion asked for, if it did.
+
+    Args:
+        rate (float, optional): Requests per second allowed at first, `None` for no limit. Defaults to None.
+        min_rate (float, optional): The rate never drops below it. Defaults to 0.5.
+        burst (float, optional): How many requests can be sent at once when the rate allows it. Defaults to 3.
+        increase (float, optional): How many requests per second the rate climbs back up each second. Defaults to 0.5.
+        decrease (float, optional): The fraction of the rate kept when it drops. Defaults to 0.7.
+        slow (float, optional): Seconds after which a request is considered too slow, and the rate drops. Defaults to 5.
+        retries (int, optional): How many times a request is retried before giving up. Defaults to 6.
+        backoff (float, optional): Seconds of the first backoff, which doubles on each retry. Defaults to 0.5.
+        max_backoff (float, optional): The longest backoff, in seconds. Defaults to 30.
+        on_retry (callable, optional): Called before every retry. Defaults to None.
+    """
+
+    def __init__(self, rate:float = None, min_rate:float = 0.5, burst:float = 3, increase:float = 0.5, decrease:float = 0.7, slow:float = 5,
+                 retries:int = 6, backoff:float = 0.5, max_backoff:float = 30, on_retry = None):
+        self.rate = rate
+        self.min_rate = min_rate
+        self.burst = burst
+        self.increase = increase
+        self.decrease = decrease
+        self.slow = slow
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.on_retry = on_retry
+
+        self.lock = threading.Lock()
+        self.random = random.Random()
+        self.tokens = burst
+        self.refilled = time.monotonic()
+        self.paused_until = 0
+        self.slowed_down = 0
+        self.sent = deque()
+
+        # Counters, for the metrics of the upload
+        self.throttled = 0
+        self.waited = 0
+
+    def call(self, function, *args):
+        """ Call `function` (which sends a request) when the rate allows it, retrying it if it fails with a transient error
+
+        Args:
+            function (callable): Raises a `NotionRequestError` if the request fails
+            *args: Passed to `function`
+
+        Raises:
+            NotionRequestError: If the request failed with an error that is not transient, or it failed too many times
+
+        Returns:
+            What `function` returns
+        """
+        attempt = 0
+        while True:
+            self.__acquire()
+
+            start = time.monotonic()
+            try:
+                result = function(*args)
+            except Exception as error:
+                if not is_transient(error) or attempt >= self.retries:
+                    raise
+
+                delay = self.__failed(error, attempt)
+                logger.info('Request failed (%s), retrying in %.1f seconds', error, delay)
+                if self.on_retry is not None:
+                    self.on_retry()
+
+                self.__sleep(delay)
+                attempt += 1
+                continue
+
+            self.__succeeded(time.monotonic() - start)
+            return result
+
+    def __acquire(self) -> None:
+        """ Wait for a token of the bucket (and for the pause asked by Notion, if there is one)
+
+        Returns:
+            None
+        """
+        with self.lock:
+            now = time.monotonic()
+            wait = max(0, self.paused_until - now)
+
+            if self.rate is not None:
+                self.tokens = min(self.burst, self.tokens + (now - self.refilled) * self.rate)
+                self.refilled = now
+
+                # The token is taken right away (the bucket can go negative), so the waiting requests are served in order
+                self.tokens -= 1
+                if self.tokens < 0:
+                    wait = max(wait, -self.tokens / self.rate)
+
+            # The requests sent in the last second tell how fast they were going when Notion started to complain
+            self.sent.append(now + wait)
+            while self.sent and self.sent[0] < now - 1:
+                self.sent.popleft()
+
+        self.__sleep(wait)
+
+    def __succeeded(self, latency:float) -> None:
+        """ Let the rate climb back up after a request went through, or drop if it was too slow
+
+        Args:
+            latency (float): How long the request took, in seconds
+
+        Returns:
+            None
+        """
+        if latency > self.slow:
+            logger.info('Request took %.1f seconds, slowing down', latency)
+            self.__slow_down()
+            return
+
+        with self.lock:
+            # Additive increase, about `increase` requests per second for every second at the current rate
+            if self.rate is not None:
+                self.rate += self.increase / max(self.rate, 1)
+
+    def __failed(self, error:Exception, attempt:int) -> float:
+        """ React to a failed request, slowing down if Notion is rate limiting
+
+        Args:
+            error (NotionRequestError)
+            attempt (int): How many times the request was already retried
+
+        Returns:
+            float: How many seconds to wait before retrying it
+        """
+        # Full jitter, so the workers that failed at the same time do not retry at the same time
+        delay = self.random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+        if getattr(error, 'status_code', None) == 429:
+            with self.lock:
+                self.throttled += 1
+            self.__slow_down()
+
+            retry_after = getattr(error, 'retry_after', None)
+            if retry_after:
+                delay = max(delay, retry_after)
+                with self.lock:
+                    self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+
+        return delay
+
+    def __slow_down(self) -> None:
+        """ Multiplicative decrease of the rate, from what was being sent. The requests that were already on their way fail as well,
+        so it only happens once a second
+
+        Returns:
+            None
+        """
+        with self.lock:
+            now = time.monotonic()
+            if now - self.slowed_down < 1:
+                return
+            self.slowed_down = now
+
+            current = len(self.sent) if self.rate is None else min(self.rate, len(self.sent))
+            self.rate = max(self.min_rate, current * self.decrease)
+            self.tokens = min(self.tokens, 0)
+            logger.info('Limiting the requests to Notion to %.1f per second', self.rate)
+
+    def __sleep(self, seconds:float) -> None:
+        if seconds > 0:
+            with self.lock:
+                self.waited += seconds
+            time.sleep(seconds)
@@ -0,0 +1,194 @@
+from booknote.clipping import parse_metadata
+from booknote.highlight_journal import highlight_hash
+from booknote.json_lines import read_records
+from datetime import date, timedelta
+import json
+import os
+import sqlite3
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS highlights (id INTEGER PRIMARY KEY, hash TEXT NOT NULL UNIQUE, title TEXT NOT NULL, location TEXT,
+                                       kind TEXT, page INTEGER, added_on TEXT, quote TEXT NOT NULL);
+CREATE VIRTUAL TABLE IF NOT EXISTS highlights_text USING fts5 (quote, title, content='highlights', content_rowid='id',
+                                                               tokenize='unicode61 remove_diacritics 2');
+CREATE TRIGGER IF NOT EXISTS highlights_insert AFTER INSERT ON highlights BEGIN
+    INSERT INTO highlights_text (rowid, quote, title) VALUES (new.id, new.quote, new.title);
+END;
+CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value);
+"""
+
+SEARCH = """
+SELECT highlights.title, highlights.location, highlights.added_on, highlights.quote,
+       snippet(highlights_text, 0, ?, ?, '...', ?), bm25(highlights_text) AS score
+FROM highlights_text JOIN highlights ON highlights.id = highlights_text.rowid
+WHERE highlights_text MATCH ? {}
+ORDER BY score LIMIT ?
+"""
+
+
+def search_row(highlight) -> tuple:
+    """ The row of a highlight in the index, whether it was parsed from the clippings or read from the `kindle.log`
+
+    Args:
+        highlight (Clipping or dict)
+
+    Returns:
+        tuple: The hash, title, location, kind, page, date (in iso format) and quote of the highlight
+    """
+    location = highlight['book location'].lstrip('- ')
+
+    # The records of the log only hold the metadata line, so its fields are parsed back from it
+    if hasattr(highlight, 'added_on'):
+        kind, page, added_on = highlight.kind, highlight.page, highlight.added_on
+    else:
+        kind, page, _, _, added_on = parse_metadata(location)
+
+    return highlight_hash(highlight), highlight['book title'], location, kind, page, added_on.isoformat() if added_on else None, highlight['quote']
+
+def fts_query(query:str) -> str:
+    """ The query with each of its terms quoted, so it has no special meaning to FTS5 (e.g. `self-help` or `C++`)
+
+    Args:
+        query (str)
+
+    Returns:
+        str
+    """
+    return ' '.join('"{}"'.format(term.replace('"', '""')) for term in query.split())
+
+class SearchIndex:
+    """ Persistent full-text index of the highlights (the `search.db` file), backed by an SQLite FTS5 table.
+
+    The records appended to the `kindle.log` are added after each upload and before each search, reading the log only from the offset
+    already indexed (which is kept in the database). The rows are never changed once added,
+    so keeping it up to date is just a matter of inserting the new highlights.
+
+    Args:
+        path (str): The path to the database
+    """
+
+    def __init__(self, path:str):
+        self.path = path
+
+        # The capsule keeps the index open between uploads, which may run on another thread than the one that opened it (e.g. in a `SessionPool`)
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.executescript(SCHEMA)
+
+    def __len__(self) -> int:
+        return self.connection.execute('SELECT count(*) FROM highlights').fetchone()[0]
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def add(self, highlights, batch_size:int = 10000) -> int:
+        """ Add the highlights that are not in the index yet
+
+        Args:
+            highlights (iterable): The highlights (parsed clippings or records of the `kindle.log`)
+            batch_size (int, optional): How many rows are inserted at once. Defaults to 10000.
+
+        Returns:
+            int: How many highlights were added
+        """
+        added = 0
+        rows = []
+        for highlight in highlights:
+            rows.append(search_row(highlight))
+            if len(rows) >= batch_size:
+                added += self.__insert(rows)
+                rows = []
+
+        return added + self.__insert(rows)
+
+    def __insert(self, rows:list) -> int:
+        """ Insert the rows in a single transaction
+
+        Args:
+            rows (list): As built by `search_row`
+
+        Returns:
+            int: How many of them were new
+        """
+        if not rows:
+            return 0
+
+        # The rows already in the index are ignored, so they are not counted
+        with self.connection:
+            return self.connection.executemany('INSERT OR IGNORE INTO highlights (hash, title, location, kind, page, added_on, quote) VALUES (?, ?, ?, ?, ?, ?, ?)', rows).rowcount
+
+    def sync_journal(self, path:str) -> int:
+        """ Add the records appended to the `kindle.log` since it was last synced. The whole log is read again if it was rewritten
+        (e.g. compacted) in the meantime
+
+        Args:
+            path (str): The path to the `kindle.log`
+
+        Returns:
+            int: How many highlights were added
+        """
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return 0
+
+        # The log is only ever appended to, unless it is replaced by a new file
+        synced = self.__state('journal')
+        offset = synced['offset'] if synced and synced['inode'] == stat.st_ino and synced['offset'] <= stat.st_size else 0
+        if offset == stat.st_size:
+            return 0
+
+        # A torn record at the end is read again once it is complete
+        records = []
+        for record, offset in read_records(path, offset):
+            records.append(record)
+
+        added = self.add(records)
+        self.__set_state('journal', {'inode': stat.st_ino, 'offset': offset})
+        return added
+
+    def search(self, query:str, book:str = None, since:date = None, until:date = None, limit:int = 20, marks:tuple = ('[', ']'), words:int = 24) -> list:
+        """ Search the highlights, the best matches first (ranked by bm25)
+
+        Args:
+            query (str): The terms to look for, in the FTS5 query syntax (e.g. `freedom NOT fear`, `"exact phrase"` or `empir*`)
+            book (str, optional): Only the highlights of the books whose title contains it (ignoring the case). Defaults to None.
+            since (date, optional): Only the highlights added on or after that day. Defaults to None.
+            until (date, optional): Only the highlights added on or before that day. Defaults to None.
+            limit (int, optional): Maximum number of results. Defaults to 20.
+            marks (tuple, optional): What goes around the matched terms in the snippets. Defaults to ('[', ']').
+            words (int, optional): Maximum number of words in the snippets. Defaults to 24.
+
+        Returns:
+            list: A dict for each result, with the `book title`, `book location`, `added on`, `quote`, `snippet` and `score`
+        """
+        filters = []
+        parameters = []
+        if book:
+            filters.append("AND highlights.title LIKE ? ESCAPE '\\'")
+            parameters.append('%{}%'.format(book.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')))
+        if since:
+            filters.append('AND highlights.added_on >= ?')
+            parameters.append(since.isoformat())
+        if until:
+            # The dates also hold the time, so the whole day is included
+            filters.append('AND highlights.added_on < ?')
+            parameters.append((until + timedelta(days=1)).isoformat())
+
+        statement = SEARCH.format(' '.join(filters))
+        try:
+            rows = self.connection.execute(statement, [marks[0], marks[1], words, query] + parameters + [limit]).fetchall()
+        except sqlite3.OperationalError:
+            # Not a valid FTS5 query, so its terms are searched as they are
+            rows = self.connection.execute(statement, [marks[0], marks[1], words, fts_query(query)] + parameters + [limit]).fetchall()
+
+        return [{'book title': title, 'book location': location, 'added on': added_on, 'quote': quote, 'snippet': snippet, 'score': score}
+                for title, location, added_on, quote, snippet, score in rows]
+
+    def __state(self, key:str):
+        row = self.connection.execute('SELECT value FROM state WHERE key = ?', (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def __set_state(self, key:str, value) -> None:
+        with self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)', (key, json.dumps(value)))
@@ -0,0 +1,212 @@
+from booknote.backends import NotionClientBackend, NotionRequestError
+from booknote.booknote import NotionCredentialError, TimeCapsule
+from collections import OrderedDict
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class SessionPool:
+    """ Keeps the authenticated Notion sessions and the capsules of the accounts synced by a long running process (e.g. a service syncing
+    the highlights of many users), so a sync neither logs in again nor reloads the account's state (the index of its `kindle.log`,
+    the records of its page, its search index...). Both are kept in LRU order, and the least recently used ones are dropped when
+    there are too many of them.
+
+    The sessions are shared by all the capsules with the same token, so their requests are paced together (see `RequestScheduler`).
+    The records a session loaded are forgotten once none of its syncs is running, so its memory does not grow with every sync.
+    The pool is thread safe: the syncs of different accounts run at the same time, while the syncs of the same account wait for each other.
+
+    Args:
+        max_sessions (int, optional): How many Notion sessions are kept. Defaults to 16.
+        max_capsules (int, optional): How many capsules are kept. Defaults to 64.
+        backend_factory (callable, optional): Builds the backend of a token. Defaults to NotionClientBackend.
+    """
+
+    def __init__(self, max_sessions:int = 16, max_capsules:int = 64, backend_factory = NotionClientBackend):
+        self.max_sessions = max_sessions
+        self.max_capsules = max_capsules
+        self.backend_factory = backend_factory
+        self.sessions = OrderedDict()
+        self.capsules = OrderedDict()
+        self.lock = threading.Lock()
+
+        # How many syncs are running through each session (even the ones no longer in the pool)
+        self.active = {}
+
+        # Counters, to size the pool
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self.capsules)
+
+    def session(self, token:str):
+        """ The authenticated backend of a token, logging in only if it is not in the pool yet
+
+        Args:
+            token (str): The v2 token of the account
+
+        Raises:
+            NotionRequestError: If the login failed
+
+        Returns:
+            NotionBackend
+        """
+        with self.lock:
+            entry = self.sessions.get(token)
+            if entry is None:
+                entry = (self.backend_factory(token), threading.Lock())
+                self.sessions[token] = entry
+                while len(self.sessions) > self.max_sessions:
+                    self.sessions.popitem(last=False)
+                    self.evictions += 1
+            self.sessions.move_to_end(token)
+
+        # The login happens outside of the pool's lock, so a slow login does not hold up the other accounts
+        backend, login_lock = entry
+        with login_lock:
+            if backend.user_id is None:
+                backend.login()
+
+        return backend
+
+    def capsule(self, key:str, config:dict, style:dict = None, state_dir:str = None) -> TimeCapsule:
+        """ The capsule of an account, creating it if it is not in the pool yet (or its config or style changed)
+
+        Args:
+            key (str): What identifies the account, e.g. the id of the user
+            config (dict): The config variables of the account
+            style (dict, optional): The style of the account. Defaults to None (i.e the default style).
+            state_dir (str, optional): Where the state files of the account are kept. Defaults to None (i.e `~/.config/booknote`).
+
+        Returns:
+            TimeCapsule
+        """
+        return self.__entry(key, config, style, state_dir)[0]
+
+    def sync(self, key:str, config:dict, style:dict = None, state_dir:str = None, sources:list = None, jobs:int = 1, keep_all:bool = False,
+             reconcile:bool = False) -> TimeCapsule:
+        """ Upload the new highlights of an account (or reconcile its page, see `TimeCapsule.reconcile_highlights`) through the pooled session
+
+        Args:
+            key (str): What identifies the account, e.g. the id of the user
+            config (dict): The config variables of the account
+            style (dict, optional): The style of the account. Defaults to None (i.e the default style).
+            state_dir (str, optional): Where the state files of the account are kept. Defaults to None (i.e `~/.config/booknote`).
+            sources (list, optional): Kindles mount points, clippings files or glob patterns to read from. Defaults to None (i.e the `kindle.location`).
+            jobs (int, optional): How many books are uploaded in parallel. Defaults to 1.
+            keep_all (bool, optional): Also keep the highlights that were extended or edited afterwards. Defaults to False.
+            reconcile (bool, optional): Reconcile the page instead of only uploading the new highlights. Defaults to False.
+
+        Raises:
+            NotionCredentialError: If the token was rejected (its session is dropped from the pool)
+            NotionRequestError: If a request to Notion failed, even after being retried (the session is dropped if it was rejected)
+
+        Returns:
+            TimeCapsule: The account's capsule, with the counters (`uploaded`, `resumed`...) and `metrics` of the sync
+        """
+        capsule, lock = self.__entry(key, config, style, state_dir)
+        token = capsule.config_values['notion.v2token']
+
+        with lock:
+            try:
+                backend = self.__acquire(token)
+                try:
+                    if reconcile:
+                        capsule.reconcile_highlights(sources, jobs, backend, keep_all)
+                    else:
+                        capsule.upload_highlights(capsule.iter_kindle_highlights(True, sources, keep_all), jobs, backend)
+                finally:
+                    self.__release(backend)
+            except NotionCredentialError:
+                self.discard(token)
+                raise
+            except NotionRequestError as e:
+                # The session expired (or was revoked) in the middle of the sync
+                if e.status_code in (401, 403):
+                    self.discard(token)
+                raise
+
+        return capsule
+
+    def __acquire(self, token:str):
+        """ The session of a token, counting it as in use by one more sync
+
+        Args:
+            token (str)
+
+        Raises:
+            NotionRequestError: If the login failed
+
+        Returns:
+            NotionBackend
+        """
+        backend = self.session(token)
+        with self.lock:
+            self.active[backend] = self.active.get(backend, 0) + 1
+        return backend
+
+    def __release(self, backend) -> None:
+        """ Count a sync of the session as done, forgetting the records it loaded once none of its syncs is running
+
+        Args:
+            backend (NotionBackend): The session, as returned by `__acquire`
+
+        Returns:
+            None
+        """
+        with self.lock:
+            self.active[backend] -= 1
+            if self.active[backend] > 0:
+                return
+            del self.active[backend]
+
+            # Cleared while holding the lock, so a sync starting right now does not lose the records it loads
+            backend.clear_records()
+
+    def discard(self, token:str) -> None:
+        """ Drop the session of a token (e.g. it expired), so the next sync logs in again
+
+        Args:
+            token (str)
+
+        Returns:
+            None
+        """
+        with self.lock:
+            self.sessions.pop(token, None)
+
+    def __entry(self, key:str, config:dict, style:dict, state_dir:str) -> tuple:
+        """ The capsule of an account and the lock its syncs hold, creating it if needed and evicting the least recently used ones
+
+        Returns:
+            tuple: The capsule and its lock
+        """
+        settings = (dict(config), dict(style) if style is not None else None, state_dir)
+
+        evicted = []
+        with self.lock:
+            entry = self.capsules.get(key)
+            if entry is not None and entry[2] == settings:
+                self.hits += 1
+            else:
+                self.misses += 1
+                if entry is not None:
+                    evicted.append(entry)
+
+                # Creating a capsule from explicit settings does not touch any file, so it is cheap enough to do while holding the lock
+                entry = (TimeCapsule(config, style, state_dir), threading.Lock(), settings)
+                self.capsules[key] = entry
+                while len(self.capsules) > self.max_capsules:
+                    evicted.append(self.capsules.popitem(last=False)[1])
+                    self.evictions += 1
+            self.capsules.move_to_end(key)
+
+        # An evicted capsule might still be syncing, so it is only closed once it is done
+        for capsule, lock, _ in evicted:
+            with lock:
+                capsule.close()
+
+        return entry[0], entry[1]
@@ -0,0 +1,190 @@
+from booknote.clipping import parse_date
+from booknote.title_index import block_title, content_hash
+import json
+import os
+import unicodedata
+
+
+# `none` keeps every book on the target page itself
+SHARD_MODES = ('none', 'book', 'alphabetical', 'date')
+
+
+def shard_name(mode:str, title:str, highlights:list) -> str:
+    """ The name of the shard (i.e the title of the child page) a book goes to
+
+    Args:
+        mode (str): `book`, `alphabetical` or `date`
+        title (str): The book's title
+        highlights (list): The book's highlights being uploaded, the oldest one sets the shard of the `date` mode
+
+    Returns:
+        str: The book's title, its initial (`0-9` for the numbers, `#` for the other symbols) or the year its first highlight was added on
+    """
+    if mode == 'book':
+        return title
+
+    if mode == 'alphabetical':
+        # The accents are dropped, so `É` goes along with `E`
+        for char in unicodedata.normalize('NFKD', title):
+            if char.isalpha():
+                return char.upper()
+            if char.isdigit():
+                return '0-9'
+        return '#'
+
+    # The records of the `kindle.log` only hold the metadata line, so the date is parsed back from it
+    dates = [getattr(highlight, 'added_on', None) or parse_date(highlight['book location']) for highlight in highlights]
+    dates = [added_on for added_on in dates if added_on is not None]
+    return str(min(dates).year) if dates else 'Undated'
+
+class ShardIndex:
+    """ Index of the shards of the target page (the child pages the books are put in), mapping the name of each shard to its page
+    and each book to its shard, so a book stays in the same shard no matter how its highlights change. It is persisted between runs
+    for each target page (along with the mode it was built for), and rebuilt from the titles of the child pages when the page's
+    children or the mode changed.
+
+    Args:
+        path (str): The path to the index (the `shards.index` file)
+        page_id (str): The id of the target page
+        mode (str): `book`, `alphabetical` or `date`
+
+    Raises:
+        ValueError: If the mode is not one of `SHARD_MODES`
+    """
+
+    def __init__(self, path:str, page_id:str, mode:str):
+        if mode not in SHARD_MODES or mode == 'none':
+            raise ValueError('Unknown sharding mode {!r}, it must be one of {}'.format(mode, ', '.join(SHARD_MODES)))
+
+        self.path = path
+        self.page_id = page_id
+        self.mode = mode
+        self.shards = {}
+        self.books = {}
+
+    def __load_all(self) -> dict:
+        """ Load the indexes of all pages, an empty dict if there are none (or they are unreadable)
+
+        Returns:
+            dict: The indexes by page id
+        """
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                return json.loads(f.read())
+        except (OSError, ValueError):
+            return {}
+
+    def load(self, content:list) -> bool:
+        """ Load the saved index of the page, if it is still valid for its current children
+
+        Args:
+            content (list): The ids of the page's children, in order
+
+        Returns:
+            bool: `True` if the index was loaded, `False` if it needs to be rebuilt
+        """
+        saved = self.__load_all().get(self.page_id)
+        if not saved or saved.get('mode') != self.mode or saved.get('content hash') != content_hash(content):
+            return False
+
+        self.shards = saved['shards']
+        self.books = saved['books']
+        return True
+
+    def build(self, records:list) -> str:
+        """ Build the index from the records of the page's children, each child page being the shard named after its title.
+        The books already assigned to a shard that is still on the page keep it, unless the page was sharded with another mode
+
+        Args:
+            records (list): The records of the page's children
+
+        Returns:
+            str: The mode of the saved index, `None` if there is none (or it was saved before the mode was kept)
+        """
+        saved = self.__load_all().get(self.page_id) or {}
+
+        self.shards = {}
+        for record in records:
+            title = block_title(record) if record else None
+            if record and record.get('type') == 'page' and record.get('alive', True) and title is not None:
+                self.shards.setdefault(title, record['id'])
+
+        if saved.get('mode') == self.mode:
+            self.books = {title: name for title, name in saved.get('books', {}).items() if name in self.shards}
+        else:
+            self.books = {}
+
+        return saved.get('mode')
+
+    def save(self, content:list) -> None:
+        """ Persist the index of the page along with the hash of its current children
+
+        Args:
+            content (list): The ids of the page's children, in order
+
+        Returns:
+            None
+        """
+        indexes = self.__load_all()
+        indexes[self.page_id] = {'mode': self.mode, 'content hash': content_hash(content), 'shards': self.shards, 'books': self.books}
+
+        with open(self.path + '.tmp', 'w', encoding='utf-8') as f:
+            f.write(json.dumps(indexes, ensure_ascii=False))
+        os.replace(self.path + '.tmp', self.path)
+
+    def pages(self) -> list:
+        """ The ids of the shards' pages
+
+        Returns:
+            list
+        """
+        return list(self.shards.values())
+
+    def shard(self, title:str, highlights:list) -> str:
+        """ The name of the shard of a book, assigning it to one if it has none yet
+
+        Args:
+            title (str): The book's title
+            highlights (list): The book's highlights being uploaded
+
+        Returns:
+            str
+        """
+        if title not in self.books:
+            self.books[title] = shard_name(self.mode, title, highlights)
+        return self.books[title]
+
+    def assign(self, title:str, name:str) -> None:
+        """ Assign a book to the shard it is already in (e.g. found on the shard's page), unless it has one
+
+        Args:
+            title (str): The book's title
+            name (str): The name of the shard
+
+        Returns:
+            None
+        """
+        self.books.setdefault(title, name)
+
+    def page(self, name:str) -> str:
+        """ The id of the shard's page
+
+        Args:
+            name (str)
+
+        Returns:
+            str: `None` if the shard was not created yet
+        """
+        return self.shards.get(name)
+
+    def add(self, name:str, page_id:str) -> None:
+        """ Add a new shard to the index
+
+        Args:
+            name (str)
+            page_id (str): The id of its page
+
+        Returns:
+            None
+        """
+        self.shards[name] = page_id
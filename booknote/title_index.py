@@ -0,0 +1,195 @@
+import hashlib
+import json
+import os
+
+
+def content_hash(content:list) -> str:
+    """ Hash of the list of children ids of a page, used to check if the page changed since the index was saved
+
+    Args:
+        content (list): The ids of the page's children, in order
+
+    Returns:
+        str: The hex digest of the list
+    """
+    return hashlib.sha1('\n'.join(content).encode('utf-8')).hexdigest()
+
+def block_title(record:dict) -> str:
+    """ Plain text title of a block record
+
+    Args:
+        record (dict): The block's record, as stored by the notion client
+
+    Returns:
+        str: The title, `None` if the block has no title
+    """
+    try:
+        return ''.join(segment[0] for segment in record['properties']['title'])
+    except (KeyError, TypeError, IndexError):
+        return None
+
+def load_title_indexes(path:str) -> dict:
+    """ Load the title indexes of all pages, an empty dict if there are none (or they are unreadable)
+
+    Args:
+        path (str): The path to the indexes (the `titles.index` file)
+
+    Returns:
+        dict: The indexes by page id
+    """
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.loads(f.read())
+    except (OSError, ValueError):
+        return {}
+
+def save_title_indexes(path:str, indexes:list) -> None:
+    """ Persist the title indexes of several pages at once, so the file is only rewritten once
+
+    Args:
+        path (str): The path to the indexes (the `titles.index` file)
+        indexes (list): Tuples of a `TitleIndex` and the ids of its page's children, in order
+
+    Returns:
+        None
+    """
+    saved = load_title_indexes(path)
+    for index, content in indexes:
+        index.content_hash = content_hash(content)
+        saved[index.page_id] = {'header type': index.header_type, 'content hash': index.content_hash, 'titles': index.titles}
+
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        f.write(json.dumps(saved, ensure_ascii=False))
+    os.replace(path + '.tmp', path)
+
+class TitleIndex:
+    """ Index of the book titles on the target page, mapping each title to the id of its title block and of the last block of its section.
+    It is persisted between runs for each page, and only rebuilt when the page's children changed (or the title block type did).
+    It can also be kept in memory between uploads, as long as it is `current` for the page's children.
+    """
+
+    def __init__(self, path:str, page_id:str, header_type:str):
+        self.path = path
+        self.page_id = page_id
+        self.header_type = header_type
+        self.titles = {}
+
+        # The hash of the children it was saved (or loaded) for, `None` once it is changed
+        self.content_hash = None
+
+    def __contains__(self, title:str) -> bool:
+        return title in self.titles
+
+    def load(self, content:list) -> bool:
+        """ Load the saved index of the page, if it is still valid for its current children
+
+        Args:
+            content (list): The ids of the page's children, in order
+
+        Returns:
+            bool: `True` if the index was loaded, `False` if it needs to be rebuilt
+        """
+        saved = load_title_indexes(self.path).get(self.page_id)
+        if not saved or saved.get('header type') != self.header_type or saved.get('content hash') != content_hash(content):
+            return False
+
+        self.titles = saved['titles']
+        self.content_hash = saved['content hash']
+        return True
+
+    def current(self, content:list) -> bool:
+        """ Checks if the index is the one saved for the page's current children, so it does not need to be loaded again
+
+        Args:
+            content (list): The ids of the page's children, in order
+
+        Returns:
+            bool
+        """
+        return self.content_hash is not None and self.content_hash == content_hash(content)
+
+    def build(self, records:list) -> None:
+        """ Build the index from a single pass through the records of the page's children
+
+        Args:
+            records (list): The records of the page's children, in order
+
+        Returns:
+            None
+        """
+        self.titles = {}
+        self.content_hash = None
+        current = None
+
+        for record in records:
+            if not record:
+                continue
+
+            # Every title block starts the section of a new book, every other block extends the current one
+            title = block_title(record)
+            if record.get('type') == self.header_type and title is not None:
+                # If the same title appears twice on the page only its first section is used, as the upload always did
+                current = title if title not in self.titles else None
+                if current is not None:
+                    self.titles[title] = [record['id'], record['id']]
+            elif current is not None:
+                self.titles[current][1] = record['id']
+
+    def save(self, content:list) -> None:
+        """ Persist the index of the page along with the hash of its current children
+
+        Args:
+            content (list): The ids of the page's children, in order
+
+        Returns:
+            None
+        """
+        save_title_indexes(self.path, [(self, content)])
+
+    def header(self, title:str) -> str:
+        """ The id of the title block of the book
+
+        Args:
+            title (str)
+
+        Returns:
+            str
+        """
+        return self.titles[title][0]
+
+    def section_end(self, title:str) -> str:
+        """ The id of the last block in the book's section of the page
+
+        Args:
+            title (str)
+
+        Returns:
+            str
+        """
+        return self.titles[title][1]
+
+    def add(self, title:str, header_id:str) -> None:
+        """ Add a new book to the index
+
+        Args:
+            title (str)
+            header_id (str): The id of its title block
+
+        Returns:
+            None
+        """
+        self.titles[title] = [header_id, header_id]
+        self.content_hash = None
+
+    def extend(self, title:str, block_id:str) -> None:
+        """ Register a new last block for the book's section
+
+        Args:
+            title (str)
+            block_id (str)
+
+        Returns:
+            None
+        """
+        self.titles[title][1] = block_id
+        self.content_hash = None
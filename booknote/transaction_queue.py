@@ -0,0 +1,66 @@
+from booknote.json_lines import append_records, read_records, replace_records
+import os
+import threading
+
+
+class TransactionQueue:
+    """ Durable queue of the transactions that could not be sent to Notion (the `upload.queue` file), replayed at the start of the next upload.
+    Each line is a json record with the operations of a transaction and the highlights whose blocks it creates.
+
+    The blocks keep the ids they were given, so replaying a transaction is safe even if Notion did apply it after all
+    (e.g. the request timed out after it was received).
+
+    Args:
+        path (str): The path to the queue
+    """
+
+    def __init__(self, path:str):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.entries())
+
+    def append(self, operations:list, highlights:list) -> None:
+        """ Add a failed transaction to the end of the queue
+
+        Args:
+            operations (list): The operations of the transaction
+            highlights (list): The highlights whose blocks it creates
+
+        Returns:
+            None
+        """
+        from booknote.highlight_journal import highlight_hash
+
+        records = [{'hash': highlight_hash(highlight), 'book title': highlight['book title'], 'book location': highlight['book location'],
+                    'quote': highlight['quote']} for highlight in highlights]
+
+        # The workers of a parallel upload can fail at the same time
+        with self.lock:
+            append_records(self.path, [{'operations': operations, 'highlights': records}])
+
+    def entries(self) -> list:
+        """ The queued transactions, in the order they failed, skipping any line that was not completely written
+
+        Returns:
+            list: A dict for each transaction, with its `operations` and `highlights`
+        """
+        return [entry for entry, _ in read_records(self.path)]
+
+    def replace(self, entries:list) -> None:
+        """ Replace the queue with the `entries` (e.g. the ones that were not replayed yet), atomically. An empty queue is removed
+
+        Args:
+            entries (list): As returned by `entries`
+
+        Returns:
+            None
+        """
+        with self.lock:
+            if not entries:
+                if os.path.exists(self.path):
+                    os.remove(self.path)
+                return
+
+            replace_records(self.path, entries)
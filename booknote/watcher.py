@@ -0,0 +1,132 @@
+from booknote.kindle_highlights import clippings_file
+import os
+import time
+
+
+class ClippingsWatcher:
+    """ Watches the clippings file of a kindle, telling when it shows up (i.e the kindle was mounted) or changes.
+
+    On Linux, with `inotify_simple` installed, the closest existing directory of the file is watched so a change is noticed right away,
+    otherwise (and to catch mounts that do not create any directory) the file is checked again every `interval` seconds.
+
+    Args:
+        source (str): The kindle's mount point or the clippings file itself
+        interval (float, optional): Seconds between each check of the file. Defaults to 2.
+        settle (float, optional): Seconds the file must stay the same before a change is reported, so the kindle can finish writing it. Defaults to 1.
+    """
+
+    # Events of the watched directory that may mean the clippings file changed
+    EVENTS = ('CREATE', 'MODIFY', 'CLOSE_WRITE', 'MOVED_TO', 'DELETE_SELF', 'MOVE_SELF', 'UNMOUNT')
+
+    def __init__(self, source:str, interval:float = 2, settle:float = 1):
+        self.source = source
+        self.interval = interval
+        self.settle = settle
+        self.signature = None
+        self.watched = None
+        self.watch = None
+
+        try:
+            from inotify_simple import INotify, flags
+            self.inotify = INotify()
+            self.lost = flags.IGNORED | flags.UNMOUNT
+            self.mask = 0
+            for event in self.EVENTS:
+                self.mask |= getattr(flags, event)
+        except (ImportError, OSError):
+            self.inotify = None
+
+    def changes(self):
+        """ Wait for the clippings file to show up or change, forever. If it is already there it counts as a change
+
+        Yields:
+            str: The path to the clippings file, each time it changed
+        """
+        while True:
+            signature = self.__signature()
+
+            if signature is not None and signature != self.signature:
+                # Only report it once the kindle stopped writing to it
+                time.sleep(self.settle)
+                if self.__signature() != signature:
+                    continue
+
+                self.signature = signature
+                yield self.__file_name()
+
+            self.wait()
+
+    def wait(self) -> None:
+        """ Wait until something happens to the clippings file, or at most `interval` seconds
+
+        Returns:
+            None
+        """
+        if self.inotify is None:
+            time.sleep(self.interval)
+            return
+
+        self.__watch(self.__closest_directory())
+        try:
+            events = self.inotify.read(timeout=int(self.interval * 1000))
+        except OSError:
+            time.sleep(self.interval)
+            return
+
+        # Once its directory is unmounted (or removed) the watch is dropped by the kernel, so it has to be added again
+        if any(event.mask & self.lost for event in events):
+            self.watched = None
+            self.watch = None
+
+    def __file_name(self) -> str:
+        return clippings_file(self.source)
+
+    def __signature(self) -> tuple:
+        """ What identifies the current version of the clippings file
+
+        Returns:
+            tuple: The device, inode, size and modification time of the file, `None` if it does not exist
+        """
+        try:
+            stat = os.stat(self.__file_name())
+        except OSError:
+            return None
+
+        return stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+    def __closest_directory(self) -> str:
+        """ The deepest directory in the path to the clippings file that currently exists
+
+        Returns:
+            str
+        """
+        directory = os.path.dirname(os.path.abspath(self.__file_name()))
+        while not os.path.isdir(directory) and os.path.dirname(directory) != directory:
+            directory = os.path.dirname(directory)
+        return directory
+
+    def __watch(self, directory:str) -> None:
+        """ Move the inotify watch to `directory`, if it is not already there
+
+        Args:
+            directory (str)
+
+        Returns:
+            None
+        """
+        if directory == self.watched:
+            return
+
+        # The old watch is already gone if its directory was unmounted
+        if self.watch is not None:
+            try:
+                self.inotify.rm_watch(self.watch)
+            except OSError:
+                pass
+
+        try:
+            self.watch = self.inotify.add_watch(directory, self.mask)
+            self.watched = directory
+        except OSError:
+            self.watch = None
+            self.watched = None
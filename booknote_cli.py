@@ -1,10 +1,16 @@
 import click
-from click.decorators import pass_context
 from booknote.booknote import NotionCredentialError, TimeCapsule
+from booknote.backends import FakeNotionBackend, NotionRequestError
+from booknote.shards import SHARD_MODES
+import logging
+import json
+import time
 
 @click.group()
+@click.option('-v', '--verbose', count=True, help="Log what BookNote is doing (-vv for debug messages)")
 @click.pass_context
-def cli(ctx):
+def cli(ctx, verbose):
+    logging.basicConfig(level=[logging.WARNING, logging.INFO, logging.DEBUG][min(verbose, 2)], format='%(asctime)s %(levelname)s %(name)s: %(message)s')
     ctx.obj = TimeCapsule()
     
 
@@ -27,6 +33,10 @@ def config(capsule, name, value):
         
         notion.page
             The Url for the notion page you want the Highlights to be stored
+
+        notion.shards
+            Put the books in child pages of notion.page instead of on the page itself: one page per book, per
+            initial or per year (none|book|alphabetical|date), defaults to none
         
         notion.v2token
             The V2 token for authentication
@@ -39,6 +49,10 @@ def config(capsule, name, value):
         Token V2
             To get the v2 token from notion, follow this tutorial: https://www.redgregory.com/notion/2020/6/15/9zuzav95gwzwewdu1dspweqbv481s5
     """
+    if name == 'notion.shards' and value not in SHARD_MODES:
+        click.echo('[ERROR] notion.shards must be one of {}'.format('|'.join(SHARD_MODES)))
+        exit(1)
+
     capsule.config(name, value)
 
 @cli.command()
@@ -87,20 +101,187 @@ def setstyle(capsule, element, variable ,value):
 
 @cli.command()
 @click.option('--all', default=False, help="Upload all the Kindle's Highlights, NOT only the new ones")
+@click.option('--source', 'sources', multiple=True, help="Kindle mount point, clippings file or glob pattern to read from (can be repeated). Defaults to the kindle.location")
+@click.option('--jobs', default=1, type=click.IntRange(min=1), help="How many books are uploaded to Notion in parallel")
+@click.option('--keep-all', is_flag=True, help="Also upload the highlights that were extended or edited afterwards, not only their latest version")
+@click.option('--reconcile', is_flag=True, help="Compare the page with every highlight known locally, creating, updating or deleting only what differs (e.g. to recover a lost kindle.log)")
+@click.option('--prune', is_flag=True, help="With --reconcile, also delete the highlights on the page that are not known locally")
+@click.option('--dry-run', is_flag=True, help="Upload to a local stand-in for Notion, without changing the page or the kindle.log")
+@click.option('--latency', default=0.0, type=click.FloatRange(min=0), help="Seconds each request takes during a dry run")
+@click.option('--failure-rate', default=0.0, type=click.FloatRange(0, 1), help="Probability of each request failing during a dry run")
+@click.option('--rate-limit', default=None, type=click.FloatRange(min=0.1), help="Requests per second accepted during a dry run, the others are rate limited")
+@click.option('--profile', is_flag=True, help="Show how long each stage of the upload took and the requests made to Notion")
+@click.option('--metrics-json', type=click.Path(dir_okay=False, writable=True), help="Write the upload's timings and counters to this json file")
 @click.pass_obj
-def upload(capsule, all):
+def upload(capsule, all, sources, jobs, keep_all, reconcile, prune, dry_run, latency, failure_rate, rate_limit, profile, metrics_json):
     """ Upload to Notion 
     """
-    # Get the highlights on the system, and if the user wants to only get the new ones or all of them
-    highlights = capsule.get_kindle_highlights(only_new = not all)
+    if prune and not reconcile:
+        click.echo('[ERROR] --prune only works along with --reconcile')
+        exit(1)
+
+    backend = None
+    if dry_run:
+        backend = FakeNotionBackend(latency=latency, failure_rate=failure_rate, rate_limit=rate_limit)
 
     # Now try to upload
     try: 
-        capsule.upload_highlights(highlights)
+        start = time.perf_counter()
+        if reconcile:
+            requests = capsule.reconcile_highlights(sources, jobs, backend, keep_all, prune)
+        else:
+            # Stream the highlights on the system, and if the user wants to only get the new ones or all of them (they are parsed as they are uploaded)
+            highlights = capsule.iter_kindle_highlights(only_new = not all, sources = sources, keep_all = keep_all)
+            requests = capsule.upload_highlights(highlights, jobs, backend)
+        elapsed = time.perf_counter() - start
+
+        for source in capsule.missing_sources:
+            click.echo('[WARNING] No clippings file found in {}'.format(source))
+        if capsule.replayed:
+            click.echo('Sent again {} highlights whose transaction failed in the last upload'.format(capsule.replayed))
+        if capsule.resumed:
+            click.echo('Resumed the last upload, skipping {} highlights already in Notion'.format(capsule.resumed))
+        if capsule.superseded:
+            click.echo('Skipped {} highlights that were extended or edited afterwards (use --keep-all to upload them too)'.format(capsule.superseded))
+        if capsule.deleted and not reconcile:
+            click.echo('Removed {} highlights from the page that were extended or edited afterwards'.format(capsule.deleted))
+        if reconcile:
+            click.echo('Updated {} and deleted {} highlights already on the page'.format(capsule.updated, capsule.deleted))
+            if capsule.unknown and not prune:
+                click.echo('Kept {} highlights on the page that are not known locally (use --prune to delete them)'.format(capsule.unknown))
+        click.echo('Uploaded {} highlights in {} requests'.format(capsule.uploaded, requests))
+
+        if dry_run:
+            endpoints = ', '.join('{} {}'.format(count, endpoint) for endpoint, count in backend.summary().items())
+            click.echo('[DRY RUN] {:.3f}s ({})'.format(elapsed, endpoints))
     
     except NotionCredentialError:
             click.echo('[ERROR] There was an error during the upload, make sure your config information is correct by running: notebook list config.json')
 
+    except NotionRequestError as e:
+            click.echo('[ERROR] The upload was interrupted ({}), run it again to resume from where it stopped'.format(e))
+            if capsule.queued:
+                click.echo('The last transaction ({} highlights) was queued, it will be sent again first'.format(capsule.queued))
+
+    # The metrics are reported even if the upload failed
+    report = capsule.metrics.report()
+    if profile:
+        show_profile(report)
+    if metrics_json:
+        with open(metrics_json, 'w') as f:
+            f.write(json.dumps(report, indent=4))
+
+def show_profile(report:dict) -> None:
+    """ Print the timings and counters of an upload
+
+    Args:
+        report (dict): As returned by `Metrics.report`
+
+    Returns:
+        None
+    """
+    total = report['total seconds']
+    click.echo('{:<16} {:>10} {:>7}'.format('stage', 'seconds', 'share'))
+    for stage, seconds in sorted(report['stages'].items(), key=lambda item: -item[1]):
+        click.echo('{:<16} {:>10.3f} {:>6.1f}%'.format(stage, seconds, 100 * seconds / total if total else 0))
+    click.echo('{:<16} {:>10.3f}'.format('total', total))
+
+    for counter, value in report['counters'].items():
+        click.echo('{:<28} {:>8}'.format(counter, value))
+    click.echo('{:<28} {:>8.1f}'.format('highlights per second', report['highlights per second']))
+
+@cli.command()
+@click.option('--source', default=None, help="Kindle mount point or clippings file to watch. Defaults to the kindle.location")
+@click.option('--interval', default=2.0, type=click.FloatRange(min=0.1), help="Seconds between each check of the clippings file")
+@click.option('--jobs', default=1, type=click.IntRange(min=1), help="How many books are uploaded to Notion in parallel")
+@click.option('--keep-all', is_flag=True, help="Also upload the highlights that were extended or edited afterwards, not only their latest version")
+@click.option('--dry-run', is_flag=True, help="Upload to a local stand-in for Notion, without changing the page or the kindle.log")
+@click.pass_obj
+def watch(capsule, source, interval, jobs, keep_all, dry_run):
+    """ Keep running, uploading the new highlights whenever the kindle is plugged in or its clippings change
+    """
+    from booknote.watcher import ClippingsWatcher
+
+    backend = FakeNotionBackend() if dry_run else None
+    source = source or capsule.config_values['kindle.location']
+    watcher = ClippingsWatcher(source, interval)
+    click.echo('Watching {} (press Ctrl-C to stop)'.format(source))
+
+    # The notion session and the kindle.log index are kept by the capsule between uploads, so only the new tail of the clippings is read and sent
+    try:
+        for _ in watcher.changes():
+            try:
+                requests = capsule.upload_highlights(capsule.iter_kindle_highlights(only_new = True, sources = [source], keep_all = keep_all), jobs, backend)
+                if capsule.uploaded or capsule.resumed:
+                    click.echo('[{}] Uploaded {} highlights in {} requests'.format(time.strftime('%H:%M:%S'), capsule.uploaded, requests))
+
+            except NotionCredentialError:
+                click.echo('[ERROR] There was an error during the upload, make sure your config information is correct by running: notebook list config.json')
+                return
+
+            except NotionRequestError as e:
+                # Try again on the next check, resuming from where it stopped
+                click.echo('[ERROR] The upload was interrupted ({}), retrying in {} seconds'.format(e, interval))
+                watcher.signature = None
+
+            except OSError as e:
+                # The kindle was unplugged while its clippings were read, they are read again once it is back
+                click.echo('[ERROR] The clippings could not be read ({}), waiting for the kindle to be plugged in again'.format(e))
+                watcher.signature = None
+
+    except KeyboardInterrupt:
+        click.echo('Stopped watching {}'.format(source))
+
+@cli.command()
+@click.option('--format', 'file_format', default='md', type=click.Choice(['md', 'json', 'csv']), help="The format of the files")
+@click.option('--out', required=True, type=click.Path(file_okay=False), help="The directory the files are written to")
+@click.option('--source', 'sources', multiple=True, help="Kindle mount point, clippings file or glob pattern to read from (can be repeated). Defaults to the kindle.location")
+@click.option('--jobs', default=4, type=click.IntRange(min=1), help="How many files are written in parallel")
+@click.pass_obj
+def export(capsule, file_format, out, sources, jobs):
+    """ Export the highlights to local files, one for each book
+    """
+    start = time.perf_counter()
+    written, skipped = capsule.export_highlights(out, file_format, jobs, sources)
+    click.echo('Exported {} books to {} in {:.2f}s ({} unchanged)'.format(written, out, time.perf_counter() - start, skipped))
+
+@cli.command()
+@click.argument('query')
+@click.option('--book', help="Only search the books whose title contains it")
+@click.option('--since', type=click.DateTime(formats=['%Y-%m-%d']), help="Only the highlights added on or after that day (YYYY-MM-DD)")
+@click.option('--until', type=click.DateTime(formats=['%Y-%m-%d']), help="Only the highlights added on or before that day (YYYY-MM-DD)")
+@click.option('--limit', default=20, type=click.IntRange(min=1), help="Maximum number of results")
+@click.pass_obj
+def search(capsule, query, book, since, until, limit):
+    """ Search the highlights, the best matches first
+    """
+    import sqlite3
+
+    # The matched terms are highlighted in the terminal
+    marks = tuple(click.style('\0', fg='yellow', bold=True).split('\0'))
+
+    start = time.perf_counter()
+    try:
+        results = capsule.search_highlights(query, book, since and since.date(), until and until.date(), limit, marks)
+    except sqlite3.Error as e:
+        click.echo('[ERROR] The search index could not be read ({})'.format(e))
+        return
+    elapsed = time.perf_counter() - start
+
+    for result in results:
+        click.echo(click.style(result['book title'], bold=True))
+        click.echo('  {}'.format(result['book location']))
+        click.echo('  {}\n'.format(result['snippet'].replace('\n', ' ')))
+    click.echo('{} results in {:.0f}ms'.format(len(results), elapsed * 1000))
+
+@cli.command()
+@click.pass_obj
+def compact(capsule):
+    """ Compact the kindle.log, dropping duplicated and corrupted records
+    """
+    kept, dropped = capsule.compact_log()
+    click.echo('Kept {} records, dropped {}'.format(kept, dropped))
+
 @cli.command()
 @click.argument('file')
 @click.pass_obj
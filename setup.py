@@ -18,8 +18,9 @@ setup(
     long_description_content_type = "text/markdown",
     url = 'https://github.com/Pedro4064/Kindle_Notion',
     py_modules = ['booknote_cli', 'booknote'],
-    packages = find_packages(),
+    packages = find_packages(exclude=['benchmarks', 'benchmarks.*', 'tests', 'tests.*']),
     install_requires = [requirements],
+    extras_require = {'watch': ['inotify_simple']},
     python_requires='>=3.5',
     include_package_data=True,
 
@@ -0,0 +1,43 @@
+from datetime import datetime
+
+from booknote.clipping import BOOKMARK, HIGHLIGHT, NOTE, parse_clipping, parse_date, parse_metadata
+
+
+def test_us_metadata_line():
+    line = '- Your Highlight on page 12 | Location 180-182 | Added on Monday, January 5, 2015 10:11:12 PM'
+    assert parse_metadata(line) == (HIGHLIGHT, 12, 180, 182, datetime(2015, 1, 5, 22, 11, 12))
+
+def test_uk_metadata_line():
+    line = '- Your Note on page 3 | Location 47 | Added on Monday, 5 January 2015 09:11:12'
+    assert parse_metadata(line) == (NOTE, 3, 47, 47, datetime(2015, 1, 5, 9, 11, 12))
+
+def test_abbreviated_location():
+    line = '- Highlight Loc. 1102-05 | Added on Monday, January 5, 2015, 12:03 AM'
+    assert parse_metadata(line) == (HIGHLIGHT, None, 1102, 1105, datetime(2015, 1, 5, 0, 3))
+
+def test_abbreviated_location_crossing_a_digit():
+    assert parse_metadata('- Highlight Loc. 998-1003 | Added on Monday, January 5, 2015 1:00:00 AM')[2:4] == (998, 1003)
+
+def test_location_without_page():
+    line = '- Your Bookmark on Location 1520 | Added on Sunday, March 1, 2020 1:02:03 AM'
+    assert parse_metadata(line) == (BOOKMARK, None, 1520, 1520, datetime(2020, 3, 1, 1, 2, 3))
+
+def test_dates_in_other_languages_are_unknown():
+    assert parse_date('- La subrayado en la posición 180-182 | Añadido el lunes, 5 de enero de 2015 10:11:12') is None
+    assert parse_metadata('- Votre surlignement sur la page 12')[4] is None
+
+def test_invalid_date():
+    assert parse_date('Added on Monday, February 30, 2015 10:11:12 AM') is None
+
+def test_location_is_rebuilt_as_written_by_the_kindle():
+    for line in ('- Your Highlight on page 12 | Location 180-180 | Added on Monday, January 5, 2015 1:02:03 PM',
+                 '- Your Note on Location 180 | Added on Monday, January 5, 2015 12:02:03 AM'):
+        clipping = parse_clipping(['Title', line, '', 'Text'])
+        assert clipping.raw is None
+        assert clipping['book location'] == line[2:]
+
+def test_raw_line_is_kept_when_it_cannot_be_rebuilt():
+    line = '- Your Highlight on page 12 | Location 180-182 | Added on Monday, January 05, 2015 01:02:03 PM'
+    clipping = parse_clipping(['Title', line, '', 'Text'])
+    assert clipping.raw == line
+    assert clipping['book location'] == line[2:]
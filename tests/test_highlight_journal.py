@@ -0,0 +1,42 @@
+import json
+import os
+
+from booknote.highlight_journal import HighlightJournal, highlight_hash
+
+
+HIGHLIGHTS = [{'book title': 'Book', 'book location': 'Your Highlight on page 1 | Location 10-11 | Added on Monday, January 5, 2015 10:11:12 AM', 'quote': 'first'},
+              {'book title': 'Book', 'book location': 'Your Highlight on page 2 | Location 20-21 | Added on Monday, January 5, 2015 10:12:12 AM', 'quote': 'second'}]
+
+
+def test_migrate_old_log(tmp_path):
+    path = os.path.join(str(tmp_path), 'kindle.log')
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(json.dumps(HIGHLIGHTS + HIGHLIGHTS[:1], indent=4))
+
+    journal = HighlightJournal(path)
+    assert len(journal) == 2
+    assert all(highlight in journal for highlight in HIGHLIGHTS)
+    assert [record['quote'] for record in journal.records()] == ['first', 'second']
+
+    # The old log is kept, and the new one is loaded as a journal from then on
+    with open(path + '.bak', encoding='utf-8') as f:
+        assert json.loads(f.read()) == HIGHLIGHTS + HIGHLIGHTS[:1]
+    assert len(HighlightJournal(path)) == 2
+
+def test_append_skips_known_highlights(tmp_path):
+    path = os.path.join(str(tmp_path), 'kindle.log')
+    journal = HighlightJournal(path)
+    assert journal.append(HIGHLIGHTS[:1]) == 1
+    assert journal.append(HIGHLIGHTS) == 1
+    assert [record['hash'] for record in HighlightJournal(path).records()] == [highlight_hash(highlight) for highlight in HIGHLIGHTS]
+
+def test_torn_last_line_is_skipped(tmp_path):
+    path = os.path.join(str(tmp_path), 'kindle.log')
+    HighlightJournal(path).append(HIGHLIGHTS[:1])
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write('{"book title": "Bo')
+
+    journal = HighlightJournal(path)
+    assert len(journal) == 1
+    assert journal.append(HIGHLIGHTS) == 1
+    assert [record['quote'] for record in HighlightJournal(path).records()] == ['first', 'second']
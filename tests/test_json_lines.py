@@ -0,0 +1,42 @@
+import os
+
+from booknote.json_lines import append_records, read_records, replace_records
+
+
+def test_missing_file_has_no_records(tmp_path):
+    assert list(read_records(os.path.join(str(tmp_path), 'missing'))) == []
+
+def test_torn_last_line(tmp_path):
+    path = os.path.join(str(tmp_path), 'records')
+    append_records(path, [{'a': 1}, {'b': 'é'}])
+    with open(path, 'ab') as f:
+        f.write(b'{"c": 3}')
+
+    # The last line is only read once it is complete, even if it is valid json already
+    assert [record for record, _ in read_records(path)] == [{'a': 1}, {'b': 'é'}]
+
+    # The next append starts on a new line, so only the torn record is lost
+    append_records(path, [{'d': 4}])
+    assert [record for record, _ in read_records(path)] == [{'a': 1}, {'b': 'é'}, {'c': 3}, {'d': 4}]
+
+def test_invalid_lines_are_skipped(tmp_path):
+    path = os.path.join(str(tmp_path), 'records')
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('{"a": 1}\nnot json\n\n{"b": 2}\n')
+    assert [record for record, _ in read_records(path)] == [{'a': 1}, {'b': 2}]
+
+def test_resume_from_offset(tmp_path):
+    path = os.path.join(str(tmp_path), 'records')
+    append_records(path, [{'a': 1}])
+    (_, offset), = read_records(path)
+
+    append_records(path, [{'b': 2}, {'c': 3}])
+    assert [record for record, _ in read_records(path, offset)] == [{'b': 2}, {'c': 3}]
+    assert list(read_records(path, os.path.getsize(path))) == []
+
+def test_replace(tmp_path):
+    path = os.path.join(str(tmp_path), 'records')
+    append_records(path, [{'a': 1}])
+    replace_records(path, iter([{'b': 2}]))
+    assert [record for record, _ in read_records(path)] == [{'b': 2}]
+    assert not os.path.exists(path + '.tmp')
@@ -0,0 +1,64 @@
+import os
+
+from booknote.kindle_highlights import Highlights
+
+
+def entry(title:str, location:int, text:str) -> str:
+    return '{}\r\n- Your Highlight on page 1 | Location {}-{} | Added on Monday, January 5, 2015 10:11:12 AM\r\n\r\n{}\r\n==========\r\n'.format(title, location, location + 1, text)
+
+def write(path:str, entries:list, mode:str = 'w') -> None:
+    with open(path, mode, encoding='utf-8', newline='') as f:
+        f.write(''.join(entries))
+
+def parse(path:str, checkpoint:dict = None) -> tuple:
+    highlights = Highlights()
+    return [clipping['quote'] for clipping in highlights.get_kindle_highlights(path, checkpoint)], highlights.checkpoint
+
+def test_resume_after_append(tmp_path):
+    path = os.path.join(str(tmp_path), 'My Clippings.txt')
+    write(path, [entry('Book', 10, 'first'), entry('Book', 20, 'second')])
+    quotes, checkpoint = parse(path)
+    assert quotes == ['first', 'second']
+
+    write(path, [entry('Book', 30, 'third')], 'a')
+    quotes, checkpoint = parse(path, checkpoint)
+    assert quotes == ['third']
+
+    # Nothing new, the same checkpoint is kept
+    quotes, again = parse(path, checkpoint)
+    assert quotes == [] and again == checkpoint
+
+def test_unfinished_entry_is_read_once_complete(tmp_path):
+    path = os.path.join(str(tmp_path), 'My Clippings.txt')
+    write(path, [entry('Book', 10, 'first'), entry('Book', 20, 'second')[:-12]])
+    quotes, checkpoint = parse(path)
+    assert quotes == ['first']
+
+    write(path, ['==========\r\n'], 'a')
+    quotes, _ = parse(path, checkpoint)
+    assert quotes == ['second']
+
+def test_full_scan_after_truncation(tmp_path):
+    path = os.path.join(str(tmp_path), 'My Clippings.txt')
+    write(path, [entry('Book', 10, 'first'), entry('Book', 20, 'second')])
+    _, checkpoint = parse(path)
+
+    write(path, [entry('Book', 10, 'first')])
+    quotes, _ = parse(path, checkpoint)
+    assert quotes == ['first']
+
+def test_full_scan_after_rewrite(tmp_path):
+    path = os.path.join(str(tmp_path), 'My Clippings.txt')
+    write(path, [entry('Book', 10, 'first'), entry('Book', 20, 'second')])
+    _, checkpoint = parse(path)
+
+    # The same size as before, but the last entry changed
+    write(path, [entry('Book', 10, 'first'), entry('Book', 20, 'SECOND'), entry('Book', 30, 'third')])
+    quotes, _ = parse(path, checkpoint)
+    assert quotes == ['first', 'SECOND', 'third']
+
+def test_invalid_checkpoint(tmp_path):
+    path = os.path.join(str(tmp_path), 'My Clippings.txt')
+    write(path, [entry('Book', 10, 'first')])
+    quotes, _ = parse(path, {'offset': 3})
+    assert quotes == ['first']
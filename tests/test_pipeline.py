@@ -0,0 +1,42 @@
+from datetime import datetime
+
+from booknote.pipeline import covered_intervals, deduplicate, superseded
+
+
+def highlight(title:str, start:int, end:int, added_on:str = 'Monday, January 5, 2015 10:11:12 AM', quote:str = 'text', kind:str = 'Highlight') -> dict:
+    return {'book title': title, 'book location': 'Your {} on page 1 | Location {}-{} | Added on {}'.format(kind, start, end, added_on), 'quote': quote}
+
+def test_extended_highlight_supersedes_the_old_one():
+    highlights = [highlight('Book', 10, 12, quote='old'), highlight('Book', 10, 15, 'Monday, January 5, 2015 10:20:00 AM', quote='new')]
+    assert superseded(highlights) == {0}
+
+def test_equal_dates_keep_the_last_one():
+    highlights = [highlight('Book', 10, 15, quote='first'), highlight('Book', 10, 15, quote='second')]
+    assert superseded(highlights) == {0}
+
+def test_equal_dates_covered_range():
+    highlights = [highlight('Book', 10, 20, quote='wide'), highlight('Book', 12, 14, quote='narrow')]
+    assert superseded(highlights) == set()
+    assert superseded(highlights[::-1]) == {0}
+
+def test_partial_overlap_keeps_both():
+    highlights = [highlight('Book', 10, 15), highlight('Book', 12, 20, 'Monday, January 5, 2015 10:20:00 AM')]
+    assert superseded(highlights) == set()
+
+def test_other_books_and_notes_are_not_compared():
+    highlights = [highlight('Book', 10, 15), highlight('Other', 10, 20, 'Monday, January 5, 2015 10:20:00 AM'),
+                  highlight('Book', 10, 20, 'Monday, January 5, 2015 10:20:00 AM', kind='Note')]
+    assert superseded(highlights) == set()
+
+def test_covered_intervals_with_equal_dates():
+    date = datetime(2015, 1, 5)
+    # The one further in the list is the most recent, and an unknown date is older than any other
+    intervals = [(10, 20, date, 0), (10, 20, date, 1), (12, 15, date, 2), (5, 25, datetime.min, 3)]
+    assert sorted(covered_intervals(intervals)) == [0]
+
+    intervals.append((5, 25, datetime(2016, 1, 1), 4))
+    assert sorted(covered_intervals(intervals)) == [0, 1, 2, 3]
+
+def test_deduplicate():
+    highlights = [highlight('Book', 10, 15), highlight('Book', 10, 15), highlight('Book', 20, 25)]
+    assert list(deduplicate(highlights, {'unknown'})) == [highlights[0], highlights[2]]